@@ -1,69 +1,217 @@
-from deepdiff import DeepDiff
-
-from app.cache import cache_container, get_cache_value
-from app.database import connect_to_db
-import pandas as pd
-
-from app.model import job_store
-
-
-def process_items(batch_id: str ):
-    source_table = get_cache_value("source_table")
-    target_table = get_cache_value("target_table")
-    excluded_column = get_cache_value("excluded_column")
-    db_name = get_cache_value("db_name")
-    s_conn, s_cursor = connect_to_db('source')
-    t_conn, t_cursor = connect_to_db('target')
-    conn, cursor = connect_to_db(db_name)
-    cursor.execute(f"PRAGMA table_info({db_name})")
-    columns = [row[1] for row in cursor.fetchall() if row[1] not in[ 'batch_id', 'result']]
-    comb_query = f"SELECT {', '.join(columns)} FROM {db_name} WHERE batch_id=?"
-    cursor.execute(comb_query, (batch_id,))
-    results = cursor.fetchall()
-    condition = ' AND '.join([f"{col} = ?" for col in columns if col != 'id'])
-    for result in results:
-        s_data = execute_query(condition, result, s_cursor, source_table)
-        t_data = execute_query(condition, result, t_cursor, target_table)
-        diff = DeepDiff(s_data, t_data, ignore_order=True)
-        differences = []
-        for key, value in diff.get("values_changed", {}).items():
-            row_index = key.split("[")[1].split("]")[0]  # Extract row index from DeepDiff key
-            column_name = key.split("'")[1] # Extract column name from DeepDiff key
-            if column_name in excluded_column:
-                continue
-            old_value = value["old_value"]
-            new_value = value["new_value"]
-            differences.append({
-                "run_id": result[0],
-                "row_index": int(row_index),
-                "column_name": column_name,
-                "old_value": str(old_value),
-                "new_value": str(new_value)
-            })
-        # Insert differences into the table
-        cursor.executemany("""
-            INSERT INTO differences (run_id, row_index, column_name, old_value, new_value)
-            VALUES (:run_id, :row_index, :column_name, :old_value, :new_value)
-        """, differences)
-        status = "Pass" if len(differences) == 0 else "Fail"
-        update_sql = f"""
-        UPDATE {db_name}
-        SET result = ?
-        WHERE {condition}
-        """
-        cursor.execute(update_sql, (status, *result[1:]))
-        conn.commit()
-    job_store[batch_id] = "completed"
-
-
-def execute_query(condition, result, cursor, table):
-    source_query = f"SELECT * FROM {table} where {condition}"
-    cursor.execute(source_query, result[1:])
-    columns = [desc[0] for desc in cursor.description]
-    rows = cursor.fetchall()
-    df = pd.DataFrame(rows, columns=columns)
-
-    # Convert the DataFrame to a list of dictionaries
-    return df.to_dict(orient="records")
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from contextlib import nullcontext
 
+from app.compare_engine import process_items_hash_join, session_key_columns, compare_columns_for, PENDING, \
+    CHUNK_SIZE
+from app.connectors import SheetConnector, open_connector, key_strings, KEY_SEPARATOR
+from app.constants import Constants
+from app.counters import get_result_counts
+from app.database import db_connection, quote
+from app.db_writer import ResultWriter
+from app.diff import DiffOptions, diff_record_groups
+from app.excel_to_db import add_new_keys
+from app.fingerprint import refresh_fingerprints, clear_fingerprints, precheck
+from app.job_store import JobStore, JobCancelled, JobStopped, COMPLETED, FAILED, CANCELLED, STOPPED, FULL, \
+    INCREMENTAL
+from app.metrics import SamplingProfiler, inc, job_phase, merge_profiles, profile_path, track_job
+from app.partitions import setup_partitions, update_partition, get_partition_status, partition_filter
+from app.sampling import draw_sample, sample_filter
 
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        if Constants.COMPARE_EXECUTOR == "dask":
+            from distributed import Client, LocalCluster
+            cluster = LocalCluster(n_workers=Constants.COMPARE_WORKERS, threads_per_worker=1)
+            _executor = Client(cluster).get_executor()
+        else:
+            # spawn, not fork: the API process holds open SQLite connections and threads
+            _executor = ProcessPoolExecutor(max_workers=Constants.COMPARE_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def process_items(batch_id: str, partitions: int = 1, mode: str = FULL) -> str:
+    # Compares the rows of the job that are still pending, so a requeued job resumes where it
+    # stopped. Returns the final job state.
+    job_store = JobStore()
+    profiler = SamplingProfiler(profile_path(batch_id, "main")) if Constants.PROFILE_JOBS else nullcontext()
+    with track_job(lambda phases: job_store.add_timings(batch_id, phases)), profiler, job_phase("total"):
+        state = run_job(job_store, batch_id, partitions, mode)
+    if Constants.PROFILE_JOBS:
+        merge_profiles(profile_path(batch_id),
+                       [profile_path(batch_id, "main")] + [profile_path(batch_id, f"p{index}") for index in range(partitions)])
+    # Partitions may have run in other processes, so the job's phases reach /metrics from its saved timings
+    for phase, (seconds, rows) in job_store.get_timings(batch_id).items():
+        if not phase.startswith("setup."):
+            inc("compare_phase_seconds_total", seconds, phase=phase)
+            if rows:
+                inc("compare_phase_rows_total", rows, phase=phase)
+    inc("compare_jobs_total", state=state)
+    return state
+
+
+def run_job(job_store: JobStore, batch_id: str, partitions: int, mode: str) -> str:
+    config = job_store.get_config(batch_id)
+    db_name = config["db_name"]
+    with db_connection(db_name) as (conn, cursor):
+        key_columns = session_key_columns(cursor, db_name)
+    if mode == INCREMENTAL:
+        with job_phase("new_keys"):
+            added = add_new_keys(db_name, batch_id, config["source_table"], key_columns, config["target_table"],
+                                 config.get("include_target_keys", False), config.get("source_url"),
+                                 config.get("target_url"))
+        print(f"Job {batch_id}: {added} new keys")
+    sampled = bool(config.get("sample_size"))
+    if sampled:
+        with job_phase("sample"):
+            size = draw_sample(db_name, batch_id, config["sample_size"], config.get("sample_seed"))
+        print(f"Job {batch_id}: comparing a sample of {size} keys")
+    # Key hashes are only computed for incremental runs and the pre-check. Sampled runs keep
+    # comparing their sample keys, so their estimate stays a real comparison.
+    checked_first = config.get("precheck", False) and not sampled
+    if mode == INCREMENTAL or checked_first:
+        with job_phase("fingerprint"):
+            fingerprints = refresh_fingerprints(batch_id, config, incremental=mode == INCREMENTAL)
+        print(f"Job {batch_id} ({mode}): {fingerprints['changed']} of {fingerprints['keys']} keys to compare")
+        if checked_first:
+            with job_phase("precheck"):
+                checked = precheck(batch_id, db_name)
+            print(f"Job {batch_id}: pre-check passed {checked['passed']} keys, {checked['matchingBuckets']} of "
+                  f"{checked['buckets']} buckets match" + (" (identical tables)" if checked["identical"] else ""))
+    else:
+        # Results now postdate the stored hashes, so the next incremental run compares every key again
+        clear_fingerprints(db_name, batch_id)
+    with job_phase("partitions_setup"):
+        setup_partitions(db_name, batch_id, key_columns, partitions, sampled)
+    if partitions == 1:
+        process_partition(batch_id, config, 0, 1)
+    else:
+        executor = get_executor()
+        wait([executor.submit(process_partition, batch_id, config, index, partitions, Constants.PROFILE_JOBS)
+              for index in range(partitions)])
+    statuses = [partition["status"] for partition in get_partition_status(db_name, batch_id)]
+    if CANCELLED in statuses:
+        return CANCELLED
+    if STOPPED in statuses:
+        return STOPPED
+    return COMPLETED if statuses and all(status == COMPLETED for status in statuses) else FAILED
+
+
+def process_partition(batch_id: str, config: dict, index: int, partitions: int, profile: bool = False):
+    # profile is only set for partitions running in their own worker; inline ones are covered by the job profile
+    job_store = JobStore()
+    profiler = SamplingProfiler(profile_path(batch_id, f"p{index}")) if profile else nullcontext()
+    with track_job(lambda phases: job_store.add_timings(batch_id, phases)), profiler:
+        compare_partition(job_store, batch_id, config, index, partitions)
+
+
+def compare_partition(job_store: JobStore, batch_id: str, config: dict, index: int, partitions: int):
+    db_name = config["db_name"]
+    partition = None if partitions == 1 else (index, partitions)
+    options = DiffOptions(**config["diff_options"])
+    sampled = bool(config.get("sample_size"))
+    fail_fast = config.get("fail_after") is not None or config.get("max_mismatch_rate") is not None
+
+    def progress(processed: int):
+        with job_phase("progress"):
+            update_partition(db_name, batch_id, index, processed=processed)
+            job_store.check_cancelled(batch_id)
+            check_fail_fast(db_name, batch_id, config)
+
+    update_partition(db_name, batch_id, index, status="running")
+    try:
+        if config["compare_engine"] == "row":
+            process_items_row_by_row(batch_id, db_name, config["source_table"], config["target_table"],
+                                     config["excluded_column"], partition, progress, options,
+                                     config.get("source_url"), config.get("target_url"), sampled,
+                                     config.get("fail_after"))
+        else:
+            process_items_hash_join(batch_id, db_name, config["source_table"], config["target_table"],
+                                    config["excluded_column"], partition, progress, options,
+                                    Constants.FAIL_FAST_CHUNK_ROWS if fail_fast else CHUNK_SIZE,
+                                    source_url=config.get("source_url"), target_url=config.get("target_url"),
+                                    sampled=sampled, flush_fails=config.get("fail_after"))
+        update_partition(db_name, batch_id, index, status="completed")
+    except JobCancelled:
+        update_partition(db_name, batch_id, index, status="cancelled")
+    except JobStopped as e:
+        # A limit reached on the partition's last results skipped nothing, so the partition is complete
+        state = get_partition_status(db_name, batch_id)[index]
+        stopped = state["processed"] < state["total"]
+        print(f"Partition {index}/{partitions} of job {batch_id} {'stopped' if stopped else 'completed'}: {e}")
+        update_partition(db_name, batch_id, index, status=STOPPED if stopped else "completed")
+    except Exception as e:
+        print(f"Partition {index}/{partitions} of job {batch_id} failed: {e}")
+        update_partition(db_name, batch_id, index, status="failed")
+
+
+def check_fail_fast(db_name: str, batch_id: str, config: dict):
+    # Fail-fast jobs stop once failAfter keys failed, or once the mismatch rate of the keys
+    # compared so far (at least FAIL_FAST_MIN_KEYS) exceeds maxMismatchRate. Checked after each
+    # result flush against the job-wide counters, so every partition stops at its next flush;
+    # failAfter jobs also flush as soon as a partition's results reach the limit.
+    fail_after, max_rate = config.get("fail_after"), config.get("max_mismatch_rate")
+    if fail_after is None and max_rate is None:
+        return
+    with db_connection(db_name) as (conn, cursor):
+        counts = get_result_counts(cursor, batch_id)
+    failed = counts.get("Fail", 0)
+    compared = failed + counts.get("Pass", 0)
+    if fail_after is not None and failed >= fail_after:
+        raise JobStopped(f"{failed} keys failed (failAfter={fail_after})")
+    if max_rate is not None and compared >= Constants.FAIL_FAST_MIN_KEYS and failed / compared > max_rate:
+        raise JobStopped(f"mismatch rate {failed / compared:.4f} over {compared} keys (maxMismatchRate={max_rate})")
+
+
+# Original per-row engine: two key lookups per combination. Kept as a fallback to cross-check
+# the hash-join engine; both diff through app.diff so their results are comparable.
+def process_items_row_by_row(batch_id: str, db_name: str, source_table: str, target_table: str, excluded_column,
+                             partition=None, progress=None, options: DiffOptions = DiffOptions(),
+                             source_url: str = None, target_url: str = None, sampled: bool = False,
+                             flush_fails: int = None):
+    external = bool(source_url or target_url)
+    with open_connector('source', source_table, source_url, external) as source_side, \
+            open_connector('target', target_table, target_url, external) as target_side, \
+            db_connection(db_name) as (conn, cursor), ResultWriter(conn, cursor, db_name, progress, flush_fails=flush_fails) as writer:
+        key_columns = session_key_columns(cursor, db_name)
+        compare_columns = compare_columns_for(source_side, target_side, key_columns, excluded_column)
+        where, params = partition_filter(key_columns, partition)
+        sample, sample_params = sample_filter(batch_id if sampled else None)
+        comb_query = f"SELECT id, {', '.join(quote(col) for col in key_columns)} FROM {db_name} WHERE batch_id=? AND {PENDING} AND {where} AND {sample}"
+        cursor.execute(comb_query, (batch_id, *params, *sample_params))
+        results = cursor.fetchall()
+        source_rows = key_row_lookup(source_side, key_columns, compare_columns, partition)
+        target_rows = key_row_lookup(target_side, key_columns, compare_columns, partition)
+        for result in results:
+            with job_phase("source_lookup", 1):
+                s_data = source_rows(result)
+            with job_phase("target_lookup", 1):
+                t_data = target_rows(result)
+            with job_phase("diff", 1):
+                differences = diff_record_groups(result[0], s_data, t_data, compare_columns, options)
+                status = "Pass" if len(differences) == 0 else "Fail"
+            writer.add(differences, [(status, result[0])])
+
+
+def key_row_lookup(connector, key_columns, compare_columns, partition=None):
+    # Returns rows_of(result) for session rows (id, *key values). SQLite sheets are queried per key;
+    # snapshot sheets, external tables and sheets paired by values are read once and grouped by key.
+    if isinstance(connector, SheetConnector) and connector.snapshot is None and not connector.pair_by_values:
+        condition = ' AND '.join([f"{quote(col)} = ?" for col in key_columns])
+        return lambda result: execute_query(condition, result, connector.cursor, connector.table, compare_columns)
+    frame = connector.read(key_columns + compare_columns, key_columns, partition)
+    groups = frame.groupby(key_strings(frame, key_columns).to_numpy(), sort=False).indices
+    values = frame[compare_columns].to_numpy(dtype=object)
+    return lambda result: [tuple(row) for row in values[groups.get(KEY_SEPARATOR.join(result[1:]), [])]]
+
+
+def execute_query(condition, result, cursor, table, columns):
+    # Rows of one key in storage order, projected to the compared columns
+    select_list = ''.join(f", {quote(col)}" for col in columns)
+    cursor.execute(f"SELECT rowid{select_list} FROM {quote(table)} WHERE {condition} ORDER BY rowid", result[1:])
+    return [row[1:] for row in cursor.fetchall()]
@@ -0,0 +1,114 @@
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from app.connectors import KEY_SEPARATOR, CHUNK_SIZE, table_columns, key_strings, open_connector
+from app.database import db_connection, quote
+from app.db_writer import ResultWriter
+from app.diff import DiffOptions, diff_aligned, missing_rows
+from app.metrics import job_phase, job_phase_iter, job_rows
+from app.partitions import partition_filter
+from app.sampling import sample_filter
+
+# Session rows without a committed result
+PENDING = "(result IS NULL OR result = '')"
+
+
+def session_key_columns(cursor, db_name: str) -> List[str]:
+    return [col for col in table_columns(cursor, db_name) if col not in ['id', 'batch_id', 'result']]
+
+
+def compare_columns_for(source, target, key_columns: List[str], excluded_column: List[str]) -> List[str]:
+    # Columns present on both sides (see app.connectors), minus keys and exclusions, so excluded
+    # data is never read
+    target_columns = target.columns()
+    return [col for col in source.columns()
+            if col in target_columns and col not in key_columns and col not in excluded_column]
+
+
+def process_items_hash_join(batch_id: str, db_name: str, source_table: str, target_table: str,
+                            excluded_column: List[str], partition=None, progress=None,
+                            options: DiffOptions = DiffOptions(), chunk_size: int = CHUNK_SIZE,
+                            source_url: str = None, target_url: str = None, sampled: bool = False,
+                            flush_fails: int = None):
+    external = bool(source_url or target_url)
+    with open_connector('source', source_table, source_url, external) as source_side, \
+            open_connector('target', target_table, target_url, external) as target_side, \
+            db_connection(db_name) as (conn, cursor), ResultWriter(conn, cursor, db_name, progress, flush_fails=flush_fails) as writer:
+        key_columns = session_key_columns(cursor, db_name)
+        compare_columns = compare_columns_for(source_side, target_side, key_columns, excluded_column)
+        columns = key_columns + compare_columns
+        order_by = ', '.join(quote(col) for col in key_columns)
+        where, params = partition_filter(key_columns, partition)
+        sample, sample_params = sample_filter(batch_id if sampled else None)
+
+        with job_phase("session_load"):
+            cursor.execute(f"SELECT id, {order_by} FROM {db_name} WHERE batch_id=? AND {PENDING} AND {where} "
+                           f"AND {sample}", (batch_id, *params, *sample_params))
+            session = pd.DataFrame(cursor.fetchall(), columns=['id', *key_columns])
+            run_ids = pd.Series(session['id'].to_numpy(), index=key_strings(session, key_columns))
+            run_ids = run_ids[~run_ids.index.duplicated()]
+        if run_ids.empty:
+            # Nothing pending here, e.g. every key was passed by the fingerprint pre-check
+            return
+
+        # Build side: the target table, restricted to the session keys and aligned by
+        # (key, ordinal within key) so duplicate keys pair up in storage order.
+        with job_phase("target_load"):
+            target = target_side.read(columns, key_columns, partition)
+            job_rows("target_load", len(target))
+            target_keys = key_strings(target, key_columns)
+            in_session = target_keys.isin(run_ids.index).to_numpy()
+            target, target_keys = target[in_session], target_keys[in_session]
+            target_ordinals = target_keys.groupby(target_keys).cumcount()
+            target_index = pd.Index(target_keys + KEY_SEPARATOR + target_ordinals.astype(str))
+            target_values = target[compare_columns].to_numpy(dtype=object)
+            target_counts = target_keys.value_counts()
+            del target, target_keys, target_ordinals
+
+        # Probe side: the source table, streamed once in key order.
+        seen = []
+        source_groups = source_side.iter_key_groups(columns, key_columns, partition, chunk_size)
+        for chunk, keys in job_phase_iter("source_read", source_groups):
+            job_rows("source_read", len(chunk))
+            with job_phase("diff"):
+                in_session = keys.isin(run_ids.index).to_numpy()
+                chunk, keys = chunk[in_session], keys[in_session]
+                if chunk.empty:
+                    continue
+                ordinals = keys.groupby(keys).cumcount().to_numpy()
+                positions = target_index.get_indexer(keys + KEY_SEPARATOR + ordinals.astype(str))
+                chunk_run_ids = run_ids.reindex(keys).to_numpy()
+                source_values = chunk[compare_columns].to_numpy(dtype=object)
+
+                matched = positions >= 0
+                matched_rows = np.nonzero(matched)[0]
+                differences = diff_aligned(chunk_run_ids[matched_rows], ordinals[matched_rows],
+                                           source_values[matched_rows], target_values[positions[matched_rows]],
+                                           compare_columns, options)
+                for source_row in np.nonzero(~matched)[0]:
+                    differences.extend(missing_rows(chunk_run_ids[source_row], int(ordinals[source_row]), 1, True))
+                source_counts = keys.value_counts()
+                extra = target_counts.reindex(source_counts.index, fill_value=0) - source_counts
+                for key, count in extra[extra > 0].items():
+                    differences.extend(missing_rows(run_ids[key], int(source_counts[key]), int(count), False))
+
+                failed = {difference.run_id for difference in differences}
+                results = [("Fail" if run_id in failed else "Pass", int(run_id))
+                           for run_id in pd.unique(chunk_run_ids)]
+                job_rows("diff", len(chunk))
+            writer.add(differences, results)
+            seen.append(source_counts.index)
+
+        # Session keys with no source rows: Fail if the target has them, otherwise nothing to compare.
+        if seen:
+            remaining = run_ids[~run_ids.index.isin(seen[0].append(seen[1:]))]
+        else:
+            remaining = run_ids
+        differences, results = [], []
+        for key, run_id in remaining.items():
+            count = int(target_counts.get(key, 0))
+            differences.extend(missing_rows(run_id, 0, count, False))
+            results.append(("Fail" if count else "Pass", int(run_id)))
+        writer.add(differences, results)
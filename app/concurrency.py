@@ -0,0 +1,70 @@
+import os
+import threading
+import uuid
+from functools import partial
+
+import aiofiles
+import anyio
+from fastapi import UploadFile
+
+from app.constants import Constants
+from app import metrics
+
+# Blocking work of the request path runs in worker threads so the event loop keeps serving other
+# clients. Short DB reads (status polls, listings) and heavy work (workbook parsing, job setup,
+# exports) have separate limiters, so a burst of uploads cannot starve status polls.
+db_limiter = anyio.CapacityLimiter(Constants.DB_THREADS)
+ingest_limiter = anyio.CapacityLimiter(Constants.INGEST_THREADS)
+
+
+async def run_db(func, *args, **kwargs):
+    return await anyio.to_thread.run_sync(partial(func, *args, **kwargs), limiter=db_limiter)
+
+
+async def run_ingest(func, *args, **kwargs):
+    return await anyio.to_thread.run_sync(partial(func, *args, **kwargs), limiter=ingest_limiter)
+
+
+async def iterate_ingest(iterable):
+    # A blocking iterator (an export's content) advanced on the ingest limiter, one item per call
+    iterator, done = iter(iterable), object()
+    while (item := await run_ingest(next, iterator, done)) is not done:
+        yield item
+
+
+class UploadSlots:
+    # Uploads accepted at once, counted until their parse finishes (which may be in a background
+    # task after the response). Callers reject the request instead of queueing it when none is free.
+
+    def __init__(self, slots: int = Constants.MAX_CONCURRENT_UPLOADS):
+        self.slots = slots
+        self.__used = 0
+        self.__lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self.__lock:
+            if self.__used >= self.slots:
+                metrics.inc("uploads_rejected_total")
+                return False
+            self.__used += 1
+            metrics.set_gauge("uploads_in_progress", self.__used)
+            return True
+
+    def release(self):
+        with self.__lock:
+            self.__used -= 1
+            metrics.set_gauge("uploads_in_progress", self.__used)
+
+
+upload_slots = UploadSlots()
+
+
+async def save_upload(file: UploadFile) -> str:
+    # Streams the upload to UPLOAD_DIR in chunks without blocking the loop. Every upload gets its
+    # own path, so two clients sending the same file name cannot overwrite each other.
+    os.makedirs(Constants.UPLOAD_DIR, exist_ok=True)
+    path = os.path.join(Constants.UPLOAD_DIR, f"{uuid.uuid4().hex}-{os.path.basename(file.filename)}")
+    async with aiofiles.open(path, "wb") as out:
+        while chunk := await file.read(Constants.UPLOAD_CHUNK_BYTES):
+            await out.write(chunk)
+    return path
@@ -0,0 +1,255 @@
+import threading
+from contextlib import contextmanager
+from typing import List
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+from app.constants import Constants
+from app.database import db_connection, quote, partition_of
+from app.partitions import partition_filter
+from app.snapshots import get_snapshot, snapshot_frame, float_text
+
+# Where the compared rows come from. By default each side is a sheet uploaded to the local
+# source/target database, stored as a SQLite table or an Arrow snapshot. With a SQLAlchemy URL
+# the table is read from that database instead, so it does not have to go through Excel first.
+KEY_SEPARATOR = "\x1f"
+CHUNK_SIZE = 50000
+# Byte-order collations per SQLAlchemy dialect. Key groups need equal keys next to each other, which a
+# case- or accent-insensitive column collation does not guarantee. Tables of other databases must
+# use such a collation for their text key columns.
+BINARY_COLLATIONS = {"sqlite": "BINARY", "postgresql": "C", "mssql": "Latin1_General_BIN2"}
+
+
+def table_columns(cursor, table: str) -> List[str]:
+    cursor.execute(f"PRAGMA table_info({quote(table)})")
+    return [row[1] for row in cursor.fetchall()]
+
+
+def key_strings(df: pd.DataFrame, key_columns: List[str]) -> pd.Series:
+    keys = df[key_columns[0]].astype(str)
+    for column in key_columns[1:]:
+        keys = keys + KEY_SEPARATOR + df[column].astype(str)
+    return keys
+
+
+def in_partition(frame: pd.DataFrame, key_columns: List[str], partition) -> pd.DataFrame:
+    # The rows of one key partition, for sources that cannot evaluate partition_of themselves
+    if partition is None:
+        return frame
+    index, partitions = partition
+    # Key strings are the values joined like partition_of joins them, so both give the same split
+    keep = key_strings(frame, key_columns).map(lambda key: partition_of(partitions, key)) == index
+    return frame[keep.to_numpy()].reset_index(drop=True)
+
+
+def complete_key_groups(chunks, key_columns: List[str]):
+    # chunks: frames ordered by the key columns. Rows of the last key in a chunk are carried
+    # into the next one so every yielded frame holds complete key groups.
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if chunk.empty:
+            continue
+        keys = key_strings(chunk, key_columns)
+        tail = (keys == keys.iloc[-1]).to_numpy()
+        carry = chunk[tail].reset_index(drop=True)
+        if not tail.all():
+            yield chunk[~tail].reset_index(drop=True), keys[~tail].reset_index(drop=True)
+    if carry is not None and len(carry):
+        yield carry, key_strings(carry, key_columns)
+
+
+def sort_by_values(frame: pd.DataFrame) -> pd.DataFrame:
+    # Rows ordered by their rendered values, keys first. This is how duplicate-key rows pair up when
+    # either side is an external table, since a table behind a URL has no storage order to pair by.
+    if frame.empty:
+        return frame
+    return frame.sort_values(list(frame.columns), kind='stable', ignore_index=True)
+
+
+def values_ordered(groups, key_columns: List[str]):
+    # Key groups (see complete_key_groups) with the rows of each key in sort_by_values order
+    for chunk, _ in groups:
+        chunk = sort_by_values(chunk)
+        yield chunk, key_strings(chunk, key_columns)
+
+
+def iter_key_groups(cursor, sql: str, params, columns: List[str], key_columns: List[str],
+                    chunk_size: int = CHUNK_SIZE):
+    # `sql` must be ordered by the key columns
+    cursor.execute(sql, params)
+    chunks = iter(lambda: cursor.fetchmany(chunk_size), [])
+    yield from complete_key_groups((pd.DataFrame(rows, columns=columns) for rows in chunks), key_columns)
+
+
+def sheet_columns(cursor, db_name: str, table: str) -> List[str]:
+    snapshot = get_snapshot(db_name, table)
+    return snapshot["columns"] if snapshot else table_columns(cursor, table)
+
+
+def read_table(cursor, db_name: str, table: str, columns: List[str], key_columns: List[str],
+               partition=None) -> pd.DataFrame:
+    # Rows of a sheet in storage order, restricted to one key partition, from its columnar
+    # snapshot when it has one and from SQLite otherwise
+    snapshot = get_snapshot(db_name, table)
+    if snapshot is None:
+        where, params = partition_filter(key_columns, partition)
+        cursor.execute(f"SELECT {', '.join(quote(col) for col in columns)} FROM {quote(table)} WHERE {where} "
+                       f"ORDER BY rowid", params)
+        return pd.DataFrame(cursor.fetchall(), columns=columns)
+    return in_partition(snapshot_frame(snapshot, columns), key_columns, partition)
+
+
+def iter_table_key_groups(cursor, db_name: str, table: str, columns: List[str], key_columns: List[str],
+                          partition=None, chunk_size: int = CHUNK_SIZE):
+    # Same contract as iter_key_groups (complete key groups, storage order within a key) for any sheet
+    if get_snapshot(db_name, table) is None:
+        where, params = partition_filter(key_columns, partition)
+        order_by = ', '.join(quote(col) for col in key_columns)
+        sql = f"SELECT {', '.join(quote(col) for col in columns)} FROM {quote(table)} WHERE {where} " \
+              f"ORDER BY {order_by}, rowid"
+        yield from iter_key_groups(cursor, sql, params, columns, key_columns, chunk_size)
+        return
+    frame = read_table(cursor, db_name, table, columns, key_columns, partition)
+    keys = key_strings(frame, key_columns)
+    order = np.argsort(keys.to_numpy(dtype=str), kind='stable')
+    frame, keys = frame.iloc[order].reset_index(drop=True), keys.iloc[order].reset_index(drop=True)
+    start = 0
+    while start < len(frame):
+        end = min(start + chunk_size, len(frame))
+        while end < len(frame) and keys.iloc[end] == keys.iloc[end - 1]:
+            end += 1
+        yield frame.iloc[start:end].reset_index(drop=True), keys.iloc[start:end].reset_index(drop=True)
+        start = end
+
+
+class SheetConnector:
+    # A sheet uploaded to the local `db_name` database ('source' or 'target'). Rows of a key come
+    # in storage order, or in sort_by_values order with pair_by_values (the other side is external).
+
+    def __init__(self, cursor, db_name: str, table: str, pair_by_values: bool = False):
+        self.cursor = cursor
+        self.db_name = db_name
+        self.table = table
+        self.pair_by_values = pair_by_values
+        self.snapshot = get_snapshot(db_name, table)
+
+    def columns(self) -> List[str]:
+        return sheet_columns(self.cursor, self.db_name, self.table)
+
+    def read(self, columns: List[str], key_columns: List[str], partition=None) -> pd.DataFrame:
+        frame = read_table(self.cursor, self.db_name, self.table, columns, key_columns, partition)
+        return sort_by_values(frame) if self.pair_by_values else frame
+
+    def iter_key_groups(self, columns: List[str], key_columns: List[str], partition=None,
+                        chunk_size: int = CHUNK_SIZE):
+        groups = iter_table_key_groups(self.cursor, self.db_name, self.table, columns, key_columns, partition,
+                                       chunk_size)
+        return values_ordered(groups, key_columns) if self.pair_by_values else groups
+
+    def distinct_keys(self, key_columns: List[str]) -> pd.DataFrame:
+        return self.read(key_columns, key_columns).drop_duplicates(ignore_index=True)
+
+
+def text_value(value) -> str:
+    # Database values rendered as the uploaded sheets store them (see app.snapshots.text_array),
+    # so an external table compares equal to the same data uploaded from Excel
+    if value is None:
+        return 'Null'
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        return 'Null' if value != value else float_text(value)
+    return str(value)
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(url: str) -> sa.Engine:
+    # One pooled engine per URL and process
+    with _engines_lock:
+        engine = _engines.get(url)
+        if engine is None:
+            engine = _engines[url] = sa.create_engine(url, pool_size=Constants.CONNECTOR_POOL_SIZE,
+                                                      pool_pre_ping=True)
+    return engine
+
+
+class TableConnector:
+    # A table of any database SQLAlchemy can reach ("schema.table" for another schema). Only the
+    # needed columns are selected, sorting and DISTINCT run in the database, and rows are streamed
+    # through a server-side cursor in batches of `batch_rows`. Key partitions are filtered per
+    # batch here, since partition_of is not available outside the local SQLite databases, so jobs
+    # reading one run as a single partition (see app.main.start_job). Rows of a key come in
+    # sort_by_values order.
+
+    def __init__(self, connection, table: str, batch_rows: int = Constants.CONNECTOR_BATCH_ROWS):
+        self.connection = connection
+        schema, _, name = table.rpartition(".")
+        self.table = sa.table(name, schema=schema or None)
+        self.batch_rows = batch_rows
+
+    def columns(self) -> List[str]:
+        return [column["name"] for column in
+                sa.inspect(self.connection).get_columns(self.table.name, schema=self.table.schema)]
+
+    def __select(self, columns: List[str], key_columns: List[str], distinct: bool = False):
+        query = sa.select(*[sa.column(col) for col in columns]).select_from(self.table)
+        if distinct:
+            query = query.distinct()
+        # Only the keys are ordered here: rows of a key are re-sorted on their rendered values,
+        # since the database may order numbers and text differently
+        return query.order_by(*self.__key_order(key_columns))
+
+    def __key_order(self, key_columns: List[str]):
+        collation = BINARY_COLLATIONS.get(self.connection.dialect.name)
+        if collation is None:
+            return [sa.column(col) for col in key_columns]
+        types = {column["name"]: column["type"] for column in
+                 sa.inspect(self.connection).get_columns(self.table.name, schema=self.table.schema)}
+        # SQLite collates any value; the other databases only text
+        return [sa.column(col).collate(collation)
+                if self.connection.dialect.name == "sqlite" or isinstance(types.get(col), sa.String)
+                else sa.column(col) for col in key_columns]
+
+    def __stream(self, query, columns: List[str], key_columns: List[str], partition=None, batch_rows: int = None):
+        batch_rows = batch_rows or self.batch_rows
+        result = self.connection.execution_options(stream_results=True, max_row_buffer=batch_rows).execute(query)
+        for rows in result.partitions(batch_rows):
+            frame = pd.DataFrame(rows, columns=columns, dtype=object).map(text_value)
+            yield in_partition(frame, key_columns, partition)
+
+    def read(self, columns: List[str], key_columns: List[str], partition=None) -> pd.DataFrame:
+        frames = list(self.__stream(self.__select(columns, key_columns), columns, key_columns, partition))
+        return sort_by_values(pd.concat(frames, ignore_index=True)) if frames else pd.DataFrame(columns=columns)
+
+    def iter_key_groups(self, columns: List[str], key_columns: List[str], partition=None,
+                        chunk_size: int = CHUNK_SIZE):
+        return values_ordered(complete_key_groups(self.__stream(self.__select(columns, key_columns), columns,
+                                                                key_columns, partition, chunk_size), key_columns),
+                              key_columns)
+
+    def distinct_keys(self, key_columns: List[str]) -> pd.DataFrame:
+        frames = list(self.__stream(self.__select(key_columns, key_columns, distinct=True), key_columns,
+                                    key_columns))
+        if not frames:
+            return pd.DataFrame(columns=key_columns)
+        # Values that only differ in type (1 and 1.0) render the same
+        return pd.concat(frames, ignore_index=True).drop_duplicates(ignore_index=True)
+
+
+@contextmanager
+def open_connector(db_name: str, table: str, url: str = None, pair_by_values: bool = False):
+    # `table` of the database at `url`, or of the local `db_name` ('source' or 'target') without one.
+    # Compares pass pair_by_values when either side has a URL, so both sides pair duplicates alike.
+    if url:
+        with get_engine(url).connect() as connection:
+            yield TableConnector(connection, table)
+    else:
+        with db_connection(db_name) as (conn, cursor):
+            yield SheetConnector(cursor, db_name, table, pair_by_values)
@@ -1,3 +1,64 @@
+import os
+
 
 class Constants:
-    FILE_STORE_TABLE = "FILE_UPLOAD_STATUS"
\ No newline at end of file
+    FILE_STORE_TABLE = "FILE_UPLOAD_STATUS"
+    PARTITION_TABLE = "job_partitions"
+    JOB_TABLE = "compare_jobs"
+    JOB_TIMING_TABLE = "job_timings"
+    KEY_HASH_TABLE = "key_hashes"
+    BUCKET_TABLE = "fingerprint_buckets"
+    SNAPSHOT_TABLE = "sheet_snapshots"
+    SNAPSHOT_PART_TABLE = "sheet_snapshot_parts"
+    FILE_STATUS_COUNT_TABLE = "FILE_UPLOAD_COUNTS"
+    RESULT_COUNT_TABLE = "result_counts"
+    SAMPLE_TABLE = "job_samples"
+    STRATA_TABLE = "sample_strata"
+    # Default and largest page of the paginated listing endpoints
+    PAGE_SIZE = int(os.getenv("PAGE_SIZE", 1000))
+    MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 10000))
+    # How uploaded sheets are stored: "sqlite" tables, or "arrow" columnar snapshot files under SNAPSHOT_DIR
+    SHEET_STORAGE = os.getenv("SHEET_STORAGE", "sqlite")
+    SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+    # Jobs running at once across all API workers, and how the scheduler polls for them
+    MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", 2))
+    SCHEDULER_POLL_SECONDS = float(os.getenv("SCHEDULER_POLL_SECONDS", 2))
+    JOB_HEARTBEAT_TIMEOUT = float(os.getenv("JOB_HEARTBEAT_TIMEOUT", 60))
+    # Worker pool used to run the partitions of a compare job: "process" or "dask"
+    COMPARE_EXECUTOR = os.getenv("COMPARE_EXECUTOR", "process")
+    COMPARE_WORKERS = int(os.getenv("COMPARE_WORKERS", os.cpu_count() or 1))
+    # Parser processes used by /batch/upload (1 parses in the upload's threads instead, for single-CPU
+    # hosts); writes still go through one writer per database
+    UPLOAD_PARSERS = int(os.getenv("UPLOAD_PARSERS", 4))
+    # Request-path worker threads: short DB reads, and heavy work (parsing, job setup, exports)
+    DB_THREADS = int(os.getenv("DB_THREADS", 16))
+    INGEST_THREADS = int(os.getenv("INGEST_THREADS", 4))
+    # Uploads accepted at once (more get 429), and where they are streamed to before parsing
+    MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", 4))
+    UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+    UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", 1024 * 1024))
+    # /batch/events: how often a watched job's counters are read, and the idle keepalive interval
+    PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", 1))
+    PROGRESS_KEEPALIVE = float(os.getenv("PROGRESS_KEEPALIVE", 15))
+    # Compare results are committed every RESULT_BATCH_ROWS keys or RESULT_FLUSH_SECONDS, whichever comes first
+    RESULT_BATCH_ROWS = int(os.getenv("RESULT_BATCH_ROWS", 5000))
+    RESULT_FLUSH_SECONDS = float(os.getenv("RESULT_FLUSH_SECONDS", 1))
+    # Opt-in sampling profiler: one folded-stack file per compare job under PROFILE_DIR
+    PROFILE_JOBS = os.getenv("PROFILE_JOBS", "false").lower() == "true"
+    PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+    PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+    # Sampled jobs: key-range strata per sample. Fail-fast jobs: keys compared before maxMismatchRate applies
+    SAMPLE_STRATA = int(os.getenv("SAMPLE_STRATA", 20))
+    FAIL_FAST_MIN_KEYS = int(os.getenv("FAIL_FAST_MIN_KEYS", 100))
+    # Hash-join chunk of fail-fast jobs: the failure limits are checked between chunks' result flushes
+    FAIL_FAST_CHUNK_ROWS = int(os.getenv("FAIL_FAST_CHUNK_ROWS", 1000))
+    # Fingerprint pre-check: session keys per key-range bucket
+    PRECHECK_BUCKET_KEYS = int(os.getenv("PRECHECK_BUCKET_KEYS", 1024))
+    # Tables read through a SQLAlchemy URL: rows per streamed batch, and pooled connections per URL
+    CONNECTOR_BATCH_ROWS = int(os.getenv("CONNECTOR_BATCH_ROWS", 50000))
+    CONNECTOR_POOL_SIZE = int(os.getenv("CONNECTOR_POOL_SIZE", 5))
+    # SQLite connection pool and per-connection tuning
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 16))
+    DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", 30))
+    DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", 65536))
+    DB_MMAP_BYTES = int(os.getenv("DB_MMAP_BYTES", 268435456))
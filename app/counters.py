@@ -0,0 +1,75 @@
+from typing import Dict
+
+from app.constants import Constants
+from app.database import quote
+
+# Status counts kept up to date by triggers, so status polls read a handful of rows instead of
+# scanning the tables they count. NULL and '' are both counted as '' (not processed yet).
+
+
+def _count_triggers(table: str, counts: str, group_column: str, status_column: str) -> list:
+    # INSERT/UPDATE/DELETE triggers on `table` that keep `counts` (group, status, count) in step
+    status = quote(status_column)
+    key_columns = f"{quote(group_column)}, status" if group_column else "status"
+
+    def add(row: str, delta: int) -> str:
+        values = f"COALESCE({row}.{status}, '')"
+        if group_column:
+            values = f"{row}.{quote(group_column)}, {values}"
+        return f"""
+            INSERT INTO {counts} ({key_columns}, count) VALUES ({values}, {delta})
+            ON CONFLICT ({key_columns}) DO UPDATE SET count = count + {delta};"""
+
+    prefix = f"{table}_{counts}"
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS {quote(prefix + '_insert')} AFTER INSERT ON {quote(table)}
+            BEGIN {add('NEW', 1)} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {quote(prefix + '_update')} AFTER UPDATE OF {status} ON {quote(table)}
+            WHEN COALESCE(OLD.{status}, '') != COALESCE(NEW.{status}, '')
+            BEGIN {add('OLD', -1)} {add('NEW', 1)} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {quote(prefix + '_delete')} AFTER DELETE ON {quote(table)}
+            BEGIN {add('OLD', -1)} END""",
+    ]
+
+
+def _table_exists(cursor, table: str) -> bool:
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    return cursor.fetchone() is not None
+
+
+def create_result_counters(cursor, session_table: str):
+    # Per-job Pass/Fail/pending counts of a compare session table
+    counts = Constants.RESULT_COUNT_TABLE
+    if not _table_exists(cursor, counts):
+        cursor.execute(f"""
+            CREATE TABLE {counts} (batch_id TEXT, status TEXT, count INTEGER, PRIMARY KEY (batch_id, status))
+        """)
+        # Sessions created before the counters existed start from their current rows
+        cursor.execute(f"""
+            INSERT INTO {counts} (batch_id, status, count)
+            SELECT batch_id, COALESCE(result, ''), COUNT(*) FROM {quote(session_table)} GROUP BY 1, 2
+        """)
+    for trigger in _count_triggers(session_table, counts, 'batch_id', 'result'):
+        cursor.execute(trigger)
+
+
+def get_result_counts(cursor, batch_id: str) -> Dict[str, int]:
+    cursor.execute(f"SELECT status, count FROM {Constants.RESULT_COUNT_TABLE} WHERE batch_id=?", (batch_id,))
+    return dict(cursor.fetchall())
+
+
+def create_upload_counters(cursor):
+    counts = Constants.FILE_STATUS_COUNT_TABLE
+    if not _table_exists(cursor, counts):
+        cursor.execute(f"CREATE TABLE {counts} (status TEXT PRIMARY KEY, count INTEGER)")
+        cursor.execute(f"""
+            INSERT INTO {counts} (status, count)
+            SELECT COALESCE(UPLOAD_STATUS, ''), COUNT(*) FROM {Constants.FILE_STORE_TABLE} GROUP BY 1
+        """)
+    for trigger in _count_triggers(Constants.FILE_STORE_TABLE, counts, None, 'UPLOAD_STATUS'):
+        cursor.execute(trigger)
+
+
+def get_upload_counts(cursor) -> Dict[str, int]:
+    cursor.execute(f"SELECT status, count FROM {Constants.FILE_STATUS_COUNT_TABLE}")
+    return dict(cursor.fetchall())
@@ -1,7 +1,164 @@
+import os
 import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
 
+from app.constants import Constants
 
-def connect_to_db(db_name:str):
-    conn = sqlite3.connect(db_name + '.db')
-    cursor = conn.cursor()
-    return conn, cursor
\ No newline at end of file
+# Applied to every pooled connection. WAL lets status polls read while a job writes;
+# synchronous=NORMAL is durable across application crashes in WAL mode.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA cache_size=-{Constants.DB_CACHE_KB}",
+    f"PRAGMA mmap_size={Constants.DB_MMAP_BYTES}",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def quote(identifier: str) -> str:
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+
+def partition_of(partitions: int, *values) -> int:
+    # Stable across processes, unlike hash(); used to split a job into key partitions
+    key = "\x1f".join(str(value) for value in values)
+    return zlib.crc32(key.encode()) % partitions
+
+
+def open_connection(db_name: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_name + '.db', timeout=Constants.DB_BUSY_TIMEOUT, check_same_thread=False)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    conn.create_function("partition_of", -1, partition_of, deterministic=True)
+    return conn
+
+
+class ConnectionPool:
+    # Pool of SQLite connections per database name. A thread that takes a connection it
+    # already holds gets the same one back, and when idle connections are available a
+    # thread gets the one it used last.
+
+    def __init__(self, max_connections: int = Constants.DB_POOL_SIZE):
+        self.max_connections = max_connections
+        self.__condition = threading.Condition()
+        self.__local = threading.local()
+        self.__reset()
+
+    def __reset(self):
+        self.__idle = {}
+        self.__open = {}
+        self.__owners = {}
+        self.__stats = {"hits": 0, "misses": 0, "waits": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+    def __held(self) -> dict:
+        if not hasattr(self.__local, "held"):
+            self.__local.held = {}
+            self.__local.last = {}
+        return self.__local.held
+
+    def acquire(self, db_name: str) -> sqlite3.Connection:
+        held = self.__held()
+        if db_name in held:
+            conn, depth = held[db_name]
+            held[db_name] = (conn, depth + 1)
+            with self.__condition:
+                self.__stats["hits"] += 1
+            return conn
+        with self.__condition:
+            idle = self.__idle.setdefault(db_name, [])
+            waited = None
+            while not idle and self.__open.get(db_name, 0) >= self.max_connections:
+                waited = waited or time.perf_counter()
+                self.__condition.wait()
+            if waited:
+                wait = time.perf_counter() - waited
+                self.__stats["waits"] += 1
+                self.__stats["wait_seconds"] += wait
+                self.__stats["max_wait_seconds"] = max(self.__stats["max_wait_seconds"], wait)
+            conn = None
+            if idle:
+                last = self.__local.last.get(db_name)
+                conn = last if last in idle else idle[-1]
+                idle.remove(conn)
+                self.__stats["hits"] += 1
+            else:
+                self.__open[db_name] = self.__open.get(db_name, 0) + 1
+                self.__stats["misses"] += 1
+        if conn is None:
+            try:
+                conn = open_connection(db_name)
+            except Exception:
+                with self.__condition:
+                    self.__open[db_name] -= 1
+                    self.__condition.notify()
+                raise
+        held[db_name] = (conn, 1)
+        self.__local.last[db_name] = conn
+        return conn
+
+    def release(self, db_name: str):
+        held = self.__held()
+        conn, depth = held[db_name]
+        if depth > 1:
+            held[db_name] = (conn, depth - 1)
+            return
+        del held[db_name]
+        # Match sqlite3's close(): uncommitted work is discarded, not left for the next user
+        if conn.in_transaction:
+            conn.rollback()
+        with self.__condition:
+            self.__idle.setdefault(db_name, []).append(conn)
+            self.__condition.notify()
+
+    def stats(self) -> dict:
+        with self.__condition:
+            return {
+                **self.__stats,
+                "wait_seconds": round(self.__stats["wait_seconds"], 6),
+                "max_wait_seconds": round(self.__stats["max_wait_seconds"], 6),
+                "open_connections": dict(self.__open),
+                "idle_connections": {db_name: len(idle) for db_name, idle in self.__idle.items()},
+            }
+
+    def after_fork(self):
+        # Connections must not be shared with a forked child
+        self.__condition = threading.Condition()
+        self.__local = threading.local()
+        self.__reset()
+
+
+pool = ConnectionPool()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=pool.after_fork)
+
+
+def iter_keyset(fetch_page, after=None):
+    # Follows fetch_page(after) -> (rows, next_after) until next_after is None. Each page takes
+    # its own connection, so nothing is held open between pages of a streamed response.
+    while True:
+        rows, after = fetch_page(after)
+        yield from rows
+        if after is None:
+            return
+
+
+@contextmanager
+def attached(cursor, db_name: str, alias: str):
+    # ATTACH another database file on a pooled connection for the duration of the block
+    cursor.execute(f"ATTACH DATABASE ? AS {alias}", (db_name + '.db',))
+    try:
+        yield
+    finally:
+        cursor.execute(f"DETACH DATABASE {alias}")
+
+
+@contextmanager
+def db_connection(db_name: str):
+    conn = pool.acquire(db_name)
+    try:
+        yield conn, conn.cursor()
+    finally:
+        pool.release(db_name)
@@ -0,0 +1,110 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from app.constants import Constants
+from app.database import db_connection
+from app.metrics import job_phase, observe, set_gauge
+
+
+class InlineWriter:
+    # Runs each write immediately on the caller's connection
+
+    def __init__(self, conn, cursor):
+        self.conn, self.cursor = conn, cursor
+
+    def submit(self, fn) -> Future:
+        future = Future()
+        future.set_result(fn(self.cursor, self.conn))
+        return future
+
+
+class DatabaseWriter:
+    # Single writer thread per database. Parsers submit write callables fn(cursor, conn);
+    # the bounded queue applies backpressure when the database falls behind.
+
+    def __init__(self, db_name: str, max_pending: int = 16):
+        self.db_name = db_name
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self.__run, args=(db_name,), daemon=True)
+        self.thread.start()
+
+    def submit(self, fn) -> Future:
+        future = Future()
+        self.queue.put((fn, future))
+        set_gauge("db_writer_queue_depth", self.queue.qsize(), db=self.db_name)
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        set_gauge("db_writer_queue_depth", 0, db=self.db_name)
+
+    def __run(self, db_name: str):
+        with db_connection(db_name) as (conn, cursor):
+            while (item := self.queue.get()) is not None:
+                fn, future = item
+                start = time.perf_counter()
+                try:
+                    future.set_result(fn(cursor, conn))
+                except Exception as e:
+                    conn.rollback()
+                    future.set_exception(e)
+                observe("db_writer_write_seconds", time.perf_counter() - start, db=db_name)
+                set_gauge("db_writer_queue_depth", self.queue.qsize(), db=db_name)
+
+
+class ResultWriter:
+    # Write-behind buffer for compare results. Differences and (result, id) updates are
+    # collected and written in one transaction once `batch_rows` results are pending or
+    # `flush_seconds` have passed, so a job commits per batch instead of per key.
+    # on_flush(count) runs after each commit, which keeps job progress in step with the database.
+    # With flush_fails, results are also flushed once that many Fails were written or are pending,
+    # so a failAfter limit is checked on the result that reaches it.
+
+    def __init__(self, conn, cursor, db_name: str, on_flush=None, batch_rows: int = Constants.RESULT_BATCH_ROWS,
+                 flush_seconds: float = Constants.RESULT_FLUSH_SECONDS, flush_fails: int = None):
+        self.conn, self.cursor = conn, cursor
+        self.db_name = db_name
+        self.on_flush = on_flush
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.flush_fails = flush_fails
+        self.fails, self.pending_fails = 0, 0
+        self.differences, self.results = [], []
+        self.last_flush = time.monotonic()
+
+    def add(self, differences, results):
+        self.differences.extend(differences)
+        self.results.extend(results)
+        if self.flush_fails is not None:
+            self.pending_fails += sum(1 for result, _ in results if result == "Fail")
+        if len(self.results) >= self.batch_rows or time.monotonic() - self.last_flush >= self.flush_seconds or \
+                (self.flush_fails is not None and self.fails + self.pending_fails >= self.flush_fails):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.results:
+            return
+        differences, results = self.differences, self.results
+        self.differences, self.results = [], []
+        self.fails, self.pending_fails = self.fails + self.pending_fails, 0
+        with job_phase("write", len(results)):
+            self.cursor.executemany("""
+                INSERT INTO differences (run_id, row_index, column_name, old_value, new_value)
+                VALUES (?, ?, ?, ?, ?)
+            """, differences)
+            self.cursor.executemany(f"UPDATE {self.db_name} SET result = ? WHERE id = ?", results)
+            self.conn.commit()
+        if self.on_flush:
+            self.on_flush(len(results))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # On error the buffered rows are dropped; they stay pending and are redone on resume
+        if exc_type is None:
+            self.flush()
@@ -0,0 +1,94 @@
+from dataclasses import dataclass
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Marker written to `differences.column_name` when a row exists on one side only
+MISSING_ROW = "__row__"
+NULL_TOKENS = ('Null', 'NULL', 'null', 'None', 'NaN', 'nan', '')
+
+
+class Difference(NamedTuple):
+    # Field order matches the `differences` insert, so records can be passed to executemany as is
+    run_id: int
+    row_index: int
+    column_name: str
+    old_value: str
+    new_value: str
+
+
+@dataclass(frozen=True)
+class DiffOptions:
+    # None compares values as stored; a number treats numeric values within it as equal
+    numeric_tolerance: Optional[float] = None
+    # Treat NULL and the NULL_TOKENS strings ('Null' is what ingestion writes for blanks) as one value
+    normalize_nulls: bool = False
+    trim_whitespace: bool = False
+
+    @property
+    def is_exact(self) -> bool:
+        return self.numeric_tolerance is None and not self.normalize_nulls and not self.trim_whitespace
+
+
+def _normalize(values: np.ndarray, options: DiffOptions) -> pd.Series:
+    column = pd.Series(values, dtype=object)
+    if options.trim_whitespace:
+        is_text = column.map(type).eq(str)
+        column = column.where(~is_text, column[is_text].str.strip())
+    if options.normalize_nulls:
+        column = column.where(~column.isin(NULL_TOKENS) & column.notna(), None)
+    return column
+
+
+def changed_cells(source_values: np.ndarray, target_values: np.ndarray, options: DiffOptions = DiffOptions()):
+    # Boolean (rows x columns) mask of cells that differ between two aligned 2-D object arrays.
+    # Normalisation can only turn unequal cells into equal ones, so it runs on those cells only.
+    changed = source_values != target_values
+    if options.is_exact or source_values.size == 0 or not changed.any():
+        return changed
+    for col in range(source_values.shape[1]):
+        rows = np.nonzero(changed[:, col])[0]
+        if not rows.size:
+            continue
+        source = _normalize(source_values[rows, col], options)
+        target = _normalize(target_values[rows, col], options)
+        both_null = (source.isna() & target.isna()).to_numpy()
+        equal = (source.to_numpy() == target.to_numpy()) | both_null
+        if options.numeric_tolerance is not None:
+            source_numbers = pd.to_numeric(source, errors='coerce').to_numpy(dtype=float)
+            target_numbers = pd.to_numeric(target, errors='coerce').to_numpy(dtype=float)
+            with np.errstate(invalid='ignore'):
+                equal |= np.abs(source_numbers - target_numbers) <= options.numeric_tolerance
+        changed[rows, col] = ~equal
+    return changed
+
+
+def diff_aligned(run_ids: np.ndarray, ordinals: np.ndarray, source_values: np.ndarray, target_values: np.ndarray,
+                 columns: List[str], options: DiffOptions = DiffOptions()) -> List[Difference]:
+    # Rows i of source_values and target_values are the same record (run_ids[i], ordinals[i])
+    rows, cols = np.nonzero(changed_cells(source_values, target_values, options))
+    return [Difference(int(run_ids[row]), int(ordinals[row]), columns[col],
+                       str(source_values[row, col]), str(target_values[row, col]))
+            for row, col in zip(rows, cols)]
+
+
+def missing_rows(run_id, first_ordinal: int, count: int, in_source: bool) -> List[Difference]:
+    old_value, new_value = ("present", "missing") if in_source else ("missing", "present")
+    return [Difference(int(run_id), ordinal, MISSING_ROW, old_value, new_value)
+            for ordinal in range(first_ordinal, first_ordinal + count)]
+
+
+def diff_record_groups(run_id, source_rows: List[Tuple], target_rows: List[Tuple], columns: List[str],
+                       options: DiffOptions = DiffOptions()) -> List[Difference]:
+    # Diff all rows of one key: rows pair up in storage order, unpaired rows are reported missing
+    paired = min(len(source_rows), len(target_rows))
+    differences = []
+    if paired:
+        differences = diff_aligned(np.full(paired, run_id), np.arange(paired),
+                                   np.array(source_rows[:paired], dtype=object).reshape(paired, len(columns)),
+                                   np.array(target_rows[:paired], dtype=object).reshape(paired, len(columns)),
+                                   columns, options)
+    differences.extend(missing_rows(run_id, paired, len(source_rows) - paired, True))
+    differences.extend(missing_rows(run_id, paired, len(target_rows) - paired, False))
+    return differences
@@ -1,100 +1,356 @@
-import itertools
+import multiprocessing
+import os
+import queue
 import sqlite3
+import threading
+import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
+import openpyxl
 import pandas as pd
-from io import BytesIO
-from typing import List, Dict
-import dask.dataframe as dd
+import psutil
+from typing import List, Dict, Optional
 
-from app.database import connect_to_db
-import numpy as np
+from app.connectors import open_connector, table_columns
+from app.constants import Constants
+from app.counters import create_result_counters, get_result_counts
+from app.database import db_connection, quote, attached, iter_keyset
+from app.db_writer import DatabaseWriter, InlineWriter
+from app.indexes import create_compare_indexes
+from app.metrics import inc, observe
+from app.partitions import create_partition_table
+from app.snapshots import ARROW, column_chunk, write_snapshot_part, add_snapshot_part, unregister_snapshot, \
+    list_snapshots, get_snapshot, snapshot_frame, float_text
 
-def read_excel_in_chunks(excel_file_content, sheet_name):
-    df = pd.read_excel(excel_file_content, sheet_name=sheet_name, engine='openpyxl')
-    return dd.from_pandas(df, npartitions=5)
+# Rows per executemany/commit; bounds ingestion memory independently of the sheet size
+INSERT_CHUNK_SIZE = 10000
+# Parsed chunks a parser process may run ahead of the writer
+PARSED_CHUNKS_AHEAD = 2
 
-def process_sheet(sheet_name, excel_file_content, cursor, conn):
-    try:
-        dask_df = read_excel_in_chunks(excel_file_content, sheet_name)
-        df = dask_df.compute()
-        df.replace({np.nan: 'Null'}, inplace=True)
-        # Ensure DataFrame has columns
-        if df.empty or df.columns.empty:
-            print(f"Warning: Sheet '{sheet_name}' is empty. Skipping...")
-            return
-        # Create a table for the sheet (if it doesn't already exist)
-        columns = ', '.join([f'"{col}" TEXT' for col in df.columns])
-        cursor.execute(f"CREATE TABLE IF NOT EXISTS {sheet_name} ({columns})")
+_parsers = None
+_parsers_lock = threading.Lock()
+
+
+def sheet_column_names(header) -> List[str]:
+    # Same naming pandas.read_excel used: blank headers become "Unnamed: i", repeats get ".n"
+    columns = []
+    for idx, value in enumerate(header):
+        name = f"Unnamed: {idx}" if value is None else str(value)
+        candidate, n = name, 1
+        while candidate in columns:
+            candidate = f"{name}.{n}"
+            n += 1
+        columns.append(candidate)
+    return columns
+
+
+def iter_row_chunks(rows, width: int, chunk_size: int = INSERT_CHUNK_SIZE, blank='Null', floats_as_text: bool = False):
+    # floats_as_text renders floats with float_text, so a TEXT column holds what snapshots and
+    # external tables render for them
+    chunk = []
+    for row in rows:
+        if all(value is None for value in row):
+            continue
+        row = tuple(blank if value is None else float_text(value) if floats_as_text and isinstance(value, float)
+                    else value for value in row[:width])
+        if len(row) < width:
+            row = row + (blank,) * (width - len(row))
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-        # Insert data from the DataFrame into the corresponding table
-        for idx, row in enumerate(df.itertuples(index=False, name=None), start=1):
+
+def insert_chunk(sheet_name, insert_sql, chunk, cursor, conn):
+    try:
+        cursor.executemany(insert_sql, chunk)
+    except sqlite3.Error:
+        # Fall back to row by row so one bad row does not drop the whole chunk
+        conn.rollback()
+        for row in chunk:
             try:
-                placeholders = ', '.join(['?' for _ in row])
-                cursor.execute(f"INSERT INTO {sheet_name} VALUES ({placeholders})", row)
+                cursor.execute(insert_sql, row)
             except Exception as e:
-                print(f"Error inserting row {idx} in sheet '{sheet_name}': {e}")
+                print(f"Error inserting row in sheet '{sheet_name}': {e}")
                 print(f"Problematic row data: {row}")  # Print the actual row data
+    conn.commit()
 
-        # Commit each insert operation
-        conn.commit()
-        print(f"Sheet {sheet_name} processed successfully")
-    except Exception as e:
-        print(f"Sheet {sheet_name} cannot be processed: {e}")
+
+def parse_sheet(sheet_name, worksheet, chunk_size: int = INSERT_CHUNK_SIZE, db_name: str = None,
+                storage: str = Constants.SHEET_STORAGE):
+    # Yields the sheet's column names, then one payload per row chunk: the rows for SQLite storage,
+    # or (path, rows) of the snapshot part written for Arrow storage. Yields nothing for an empty sheet.
+    rows = worksheet.iter_rows(values_only=True)
+    header = next(rows, None)
+    # Ensure the sheet has columns
+    if header is None or all(value is None for value in header):
+        return
+    columns = sheet_column_names(header)
+    yield columns
+    if storage == ARROW:
+        # Columnar snapshot: typed columns with real nulls, one part file per chunk
+        for chunk in iter_row_chunks(rows, len(columns), chunk_size, blank=None):
+            yield write_snapshot_part(db_name, sheet_name, columns,
+                                      [column_chunk(list(values)) for values in zip(*chunk)]), len(chunk)
+    else:
+        yield from iter_row_chunks(rows, len(columns), chunk_size, floats_as_text=True)
+
+
+def store_sheet(sheet_name, parsed, writer, db_name: str = None, storage: str = Constants.SHEET_STORAGE):
+    # Submits what parse_sheet yields to the database's writer and returns the sheet's stats. The
+    # peak RSS is this process's; parser processes are not included.
+    process = psutil.Process()
+    peak_rss = process.memory_info().rss
+    start = time.perf_counter()
+    columns = next(parsed, None)
+    if columns is None:
+        print(f"Warning: Sheet '{sheet_name}' is empty. Skipping...")
+        return None
+    row_count = 0
+    if storage == ARROW:
+        # Parts are registered in the database catalog
+        writes = []
+        for path, rows in parsed:
+            if writes and writes[0].done() and writes[0].exception() is not None:
+                os.remove(path)
+                break
+            writes.append(writer.submit(lambda cursor, conn, path=path, rows=rows: add_snapshot_part(
+                cursor, conn, db_name, sheet_name, columns, path, rows)))
+            row_count += rows
+            peak_rss = max(peak_rss, process.memory_info().rss)
+    else:
+        # Create a table for the sheet (if it doesn't already exist)
+        column_defs = ', '.join([f'{quote(col)} TEXT' for col in columns])
+        create = writer.submit(lambda cursor, conn: cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {quote(sheet_name)} ({column_defs})"))
+        writes = [create, writer.submit(lambda cursor, conn: unregister_snapshot(cursor, conn, sheet_name))]
+        insert_sql = f"INSERT INTO {quote(sheet_name)} VALUES ({', '.join(['?'] * len(columns))})"
+
+        def insert_rows(cursor, conn, chunk):
+            # Chunks queued before a failed CREATE was seen fail with it instead of going row by row
+            create.result()
+            insert_chunk(sheet_name, insert_sql, chunk, cursor, conn)
+
+        for chunk in parsed:
+            if create.done() and create.exception() is not None:
+                break
+            writes.append(writer.submit(lambda cursor, conn, chunk=chunk: insert_rows(cursor, conn, chunk)))
+            row_count += len(chunk)
+            peak_rss = max(peak_rss, process.memory_info().rss)
+    # Stops the parser of a sheet that already failed
+    parsed.close()
+    # Surface any write failure of this sheet to the caller
+    for write in writes:
+        write.result()
+
+    elapsed = time.perf_counter() - start
+    observe("ingest_sheet_seconds", elapsed, storage=storage)
+    inc("ingest_rows_total", row_count, storage=storage)
+    stats = {
+        "sheet": sheet_name,
+        "rows": row_count,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(row_count / elapsed, 1) if elapsed else None,
+        "peak_rss_mb": round(peak_rss / (1024 * 1024), 1)
+    }
+    print(f"Sheet {sheet_name} processed successfully: {stats}")
+    return stats
+
+
+def process_sheet(sheet_name, worksheet, writer, chunk_size: int = INSERT_CHUNK_SIZE, db_name: str = None,
+                  storage: str = Constants.SHEET_STORAGE):
+    return store_sheet(sheet_name, parse_sheet(sheet_name, worksheet, chunk_size, db_name, storage), writer,
+                       db_name, storage)
 
 # Function to convert Excel file to SQLite DB
-def excel_to_db(excel_file_content, db_file_path):
+def excel_to_db(excel_file_content, db_file_path) -> List[Dict]:
     try:
 
         # Open the SQLite database (or create one if it doesn't exist)
-        conn, cursor = connect_to_db(db_file_path)
+        with db_connection(db_file_path) as (conn, cursor):
 
-        # Read the Excel file into a pandas ExcelFile object
-        excel_file = pd.ExcelFile(excel_file_content)
+            # Read-only mode streams rows from the archive instead of loading the workbook
+            workbook = openpyxl.load_workbook(excel_file_content, read_only=True, data_only=True)
 
-        # Iterate over each sheet in the Excel file
-        for sheet_name in excel_file.sheet_names:
-            # Read the sheet into a DataFrame
-            # df = excel_file.parse(sheet_name)
-            df = read_excel_in_chunks(excel_file_content, sheet_name)
+            # Iterate over each sheet in the Excel file
+            sheet_stats = []
+            for worksheet in workbook.worksheets:
+                stats = process_sheet(worksheet.title, worksheet, InlineWriter(conn, cursor), db_name=db_file_path)
+                if stats:
+                    sheet_stats.append(stats)
+            workbook.close()
+        return sheet_stats
+    except Exception as e:
+        raise Exception("Failed to Process the File")
 
-            # Create a table for the sheet (if it doesn't already exist)
-            columns = ', '.join([f'"{col}" TEXT' for col in df.columns])
-            cursor.execute(f"CREATE TABLE IF NOT EXISTS {sheet_name} ({columns})")
 
-            # Insert data from the DataFrame into the corresponding table
-            for row in df.itertuples(index=False, name=None):
-                placeholders = ', '.join(['?' for _ in row])
-                cursor.execute(f"INSERT INTO {sheet_name} VALUES ({placeholders})", row)
+def get_parsers():
+    # Parser processes shared by every upload, and the manager whose queues bring their chunks back.
+    # spawn, not fork: the API process holds open SQLite connections and threads.
+    global _parsers
+    with _parsers_lock:
+        if _parsers is None:
+            context = multiprocessing.get_context("spawn")
+            _parsers = (ProcessPoolExecutor(max_workers=Constants.UPLOAD_PARSERS, mp_context=context),
+                        context.Manager())
+    return _parsers
 
-            # Commit each insert operation
-            conn.commit()
 
-        # Close the connection to the database
-        conn.close()
+def _parse_in_process(file_path: str, sheet_name: str, db_name: str, storage: str, messages, stop):
+    # Runs in a parser process: puts ("item", ...) for everything parse_sheet yields, then ("done", None)
+    # or ("error", message)
+    try:
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            for item in parse_sheet(sheet_name, workbook[sheet_name], INSERT_CHUNK_SIZE, db_name, storage):
+                messages.put(("item", item))
+                if stop.is_set():
+                    break
+        finally:
+            workbook.close()
     except Exception as e:
-        raise Exception("Failed to Process the File")
+        messages.put(("error", f"{type(e).__name__}: {e}"))
+    else:
+        messages.put(("done", None))
+
+
+def _discard_parsers(pool):
+    # A parser process that died (e.g. out of memory) breaks its pool; the next upload starts a new one
+    global _parsers
+    with _parsers_lock:
+        if _parsers is not None and _parsers[0] is pool:
+            _parsers = None
+            pool.shutdown(wait=False)
+
+
+def _next_message(messages, future, pool):
+    while True:
+        try:
+            return messages.get(timeout=1)
+        except queue.Empty:
+            # Puts are synchronous, so a finished parser has nothing left in the queue
+            if future.done():
+                try:
+                    future.result()
+                except BrokenProcessPool:
+                    _discard_parsers(pool)
+                    raise
+                return "error", "the parser process exited without finishing the sheet"
+
+
+def parse_sheet_in_process(file_path: str, sheet_name: str, db_name: str, storage: str):
+    # parse_sheet run in a parser process, so sheets parse in parallel without sharing the GIL
+    pool, manager = get_parsers()
+    messages, stop = manager.Queue(maxsize=PARSED_CHUNKS_AHEAD), manager.Event()
+    future = pool.submit(_parse_in_process, file_path, sheet_name, db_name, storage, messages, stop)
+    finished = False
+    try:
+        while True:
+            kind, value = _next_message(messages, future, pool)
+            if kind == "item":
+                yield value
+                continue
+            finished = True
+            if kind == "error":
+                raise RuntimeError(f"Sheet {sheet_name} cannot be parsed: {value}")
+            return
+    finally:
+        if not finished:
+            # The sheet was given up on: stop its parser and drop the parts it already wrote
+            stop.set()
+            while True:
+                kind, value = _next_message(messages, future, pool)
+                if kind != "item":
+                    break
+                if storage == ARROW and isinstance(value, tuple):
+                    os.remove(value[0])
+
+
+def _load_sheet(file_path: str, sheet_name: str, writer, db_name: str, storage: str):
+    if Constants.UPLOAD_PARSERS > 1:
+        return store_sheet(sheet_name, parse_sheet_in_process(file_path, sheet_name, db_name, storage), writer,
+                           db_name, storage)
+    # A single parser gains nothing from a process of its own
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        return process_sheet(sheet_name, workbook[sheet_name], writer, db_name=db_name, storage=storage)
+    finally:
+        workbook.close()
+
+
+def files_to_db(files, db_name: str, on_file_done, max_parsers: int = Constants.UPLOAD_PARSERS,
+                storage: str = Constants.SHEET_STORAGE):
+    # files: (file_name, file_path) pairs. Sheets are parsed in parser processes, at most max_parsers
+    # of this call's at a time, and all rows go through one DatabaseWriter, so SQLite only ever sees
+    # a single writer.
+    # on_file_done(file_name, "pass" | "fail") is called as soon as each file finishes.
+    writer = DatabaseWriter(db_name)
+    try:
+        with ThreadPoolExecutor(max_workers=max_parsers) as pool:
+            futures, remaining, failed = {}, {}, set()
+            for file_name, file_path in files:
+                try:
+                    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+                    sheet_names = workbook.sheetnames
+                    workbook.close()
+                except Exception as e:
+                    print(f"File {file_name} cannot be processed: {e}")
+                    on_file_done(file_name, "fail")
+                    continue
+                if not sheet_names:
+                    on_file_done(file_name, "pass")
+                    continue
+                remaining[file_name] = len(sheet_names)
+                for sheet_name in sheet_names:
+                    futures[pool.submit(_load_sheet, file_path, sheet_name, writer, db_name, storage)] = file_name
+
+            for future in as_completed(futures):
+                file_name = futures[future]
+                if future.exception() is not None:
+                    print(f"File {file_name} cannot be processed: {future.exception()}")
+                    failed.add(file_name)
+                remaining[file_name] -= 1
+                if remaining[file_name] == 0:
+                    on_file_done(file_name, "fail" if file_name in failed else "pass")
+    finally:
+        writer.close()
 
 def get_list_tables(db_name: str) -> List[str]:
-    conn, cursor = connect_to_db(db_name)
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    tables = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return tables
+    with db_connection(db_name) as (conn, cursor):
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT IN (?, ?)",
+                       (Constants.SNAPSHOT_TABLE, Constants.SNAPSHOT_PART_TABLE))
+        tables = [row[0] for row in cursor.fetchall()]
+    return tables + [sheet for sheet in list_snapshots(db_name) if sheet not in tables]
 
 def get_col_names_from_db(sheet_name: str) -> List[str]:
-    conn, cursor = connect_to_db('source')
-
-    cursor.execute(f"PRAGMA table_info({sheet_name})")
-    columns = [row[1] for row in cursor.fetchall()]
-    conn.close()
+    snapshot = get_snapshot('source', sheet_name)
+    if snapshot:
+        return snapshot["columns"]
+    with db_connection('source') as (conn, cursor):
+        cursor.execute(f"PRAGMA table_info({quote(sheet_name)})")
+        columns = [row[1] for row in cursor.fetchall()]
     return columns
 
-def create_batch_job_setup(db_name: str, table_name: str, primary_col: List[str]):
-    col_name = "TEXT, ".join(primary_col)
+def create_batch_job_setup(db_name: str, table_name: str, primary_col: List[str], target_table: str = None,
+                           include_target_keys: bool = False, dry_run: bool = False, source_url: str = None,
+                           target_url: str = None):
     table = db_name.replace(" ", "_")
-    conn, cursor = connect_to_db(table)
+    target_table = target_table or table_name
+    check_key_columns(table_name, primary_col, target_table, source_url, target_url)
+    if dry_run:
+        return count_unique_combinations(table_name, primary_col, target_table, include_target_keys, source_url,
+                                         target_url)
+    timings = {}
+    start = time.perf_counter()
+    with db_connection(table) as (conn, cursor):
+        session_keys = [col for col in table_columns(cursor, table) if col not in ['id', 'batch_id', 'result']]
+    if session_keys and set(session_keys) != set(primary_col):
+        raise ValueError(f"Session {db_name} was set up with key columns {session_keys}, not {primary_col}")
+    col_name = ", ".join(f"{quote(col)} TEXT" for col in primary_col)
     sql = f"""
     CREATE TABLE IF NOT EXISTS {table} (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -103,77 +359,199 @@ def create_batch_job_setup(db_name: str, table_name: str, primary_col: List[str]
         result TEXT
     )
     """
-    cursor.execute(sql)
-    conn.commit()
-    # Create a table to store differences
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS differences (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            run_id INTEGER,
-            row_index INTEGER,
-            column_name TEXT,
-            old_value TEXT,
-            new_value TEXT
-        )
-    """)
-    conn.commit()
-    conn.close()
-    return generate_unique_combinarions(table, table_name, primary_col)
+    with db_connection(table) as (conn, cursor):
+        cursor.execute(sql)
+        conn.commit()
+        # Create a table to store differences
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS differences (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id INTEGER,
+                row_index INTEGER,
+                column_name TEXT,
+                old_value TEXT,
+                new_value TEXT
+            )
+        """)
+        create_partition_table(cursor)
+        create_result_counters(cursor, table)
+        conn.commit()
+    timings["tables"] = time.perf_counter() - start
+    start = time.perf_counter()
+    # Tables of external databases are indexed by their owners, not by us
+    index_timings = create_compare_indexes(table, None if source_url else table_name,
+                                           None if target_url else target_table, primary_col)
+    timings["indexes"] = time.perf_counter() - start
+    start = time.perf_counter()
+    setup = generate_unique_combinarions(table, table_name, primary_col, target_table, include_target_keys,
+                                         source_url, target_url)
+    timings["session_keys"] = time.perf_counter() - start
+    for phase, seconds in timings.items():
+        observe("setup_seconds", seconds, phase=phase)
+    inc("setup_keys_total", setup["total_combinations"])
+    return {**setup, "index_seconds": round(timings["indexes"], 3), "indexes": index_timings,
+            "timings": {phase: round(seconds, 3) for phase, seconds in timings.items()}}
 
-def generate_unique_combinarions(db_name: str, table_name: str, primary_col: List[str]):
-    col_name = ", ".join(primary_col)
 
-    query = f"""
-    SELECT DISTINCT {col_name} FROM {table_name}
-    """
-    conn, cursor = connect_to_db('source')
-    cursor.execute(query)
-    results = cursor.fetchall()
-    combinations = list(itertools.combinations(results, len(primary_col)))
-    conn.close()
-    conn, cursor = connect_to_db(db_name)
+def check_key_columns(table_name: str, primary_col: List[str], target_table: str, source_url: str = None,
+                      target_url: str = None):
+    # Key columns are quoted into SQL, and SQLite reads an unknown double-quoted name as a string
+    # literal, so a misspelled key would silently become one constant key
+    for db_name, table, url in (('source', table_name, source_url), ('target', target_table, target_url)):
+        with open_connector(db_name, table, url) as connector:
+            columns = connector.columns()
+        missing = [col for col in primary_col if col not in columns]
+        if missing:
+            raise ValueError(f"{db_name.capitalize()} table {table} has no column {', '.join(missing)}")
+
+
+def unique_keys_sql(table_name: str, primary_col: List[str], target_table: str = None,
+                    include_target_keys: bool = False) -> str:
+    # Distinct key tuples of the attached source (and optionally target) table
+    col_name = ", ".join(quote(col) for col in primary_col)
+    if include_target_keys:
+        return f"""
+            SELECT {col_name} FROM src.{quote(table_name)}
+            UNION
+            SELECT {col_name} FROM tgt.{quote(target_table)}
+        """
+    return f"SELECT DISTINCT {col_name} FROM src.{quote(table_name)}"
+
+
+def connector_keys(table_name: str, primary_col: List[str], target_table: str = None,
+                   include_target_keys: bool = False, source_url: str = None, target_url: str = None):
+    # Snapshot sheets and external tables cannot be attached to SQL, so when one is involved the
+    # distinct keys are built in pandas from their connectors instead. Returns None when every
+    # side is a local SQLite table.
+    sides = [('source', table_name, source_url)]
+    if include_target_keys:
+        sides.append(('target', target_table or table_name, target_url))
+    if not any(url or get_snapshot(db_name, table) for db_name, table, url in sides):
+        return None
+    frames = []
+    for db_name, table, url in sides:
+        with open_connector(db_name, table, url) as connector:
+            frames.append(connector.distinct_keys(primary_col))
+    return pd.concat(frames, ignore_index=True).drop_duplicates(ignore_index=True)
+
+
+def count_unique_combinations(table_name: str, primary_col: List[str], target_table: str = None,
+                              include_target_keys: bool = False, source_url: str = None, target_url: str = None):
+    keys = connector_keys(table_name, primary_col, target_table, include_target_keys, source_url, target_url)
+    if keys is not None:
+        return {"jobId": None, "total_combinations": len(keys), "dryRun": True}
+    keys_sql = unique_keys_sql(table_name, primary_col, target_table, include_target_keys)
+    with db_connection('source') as (conn, cursor), attached(cursor, 'source', 'src'), \
+            attached(cursor, 'target', 'tgt'):
+        cursor.execute(f"SELECT COUNT(*) FROM ({keys_sql})")
+        total = cursor.fetchone()[0]
+    return {"jobId": None, "total_combinations": total, "dryRun": True}
+
+
+def generate_unique_combinarions(db_name: str, table_name: str, primary_col: List[str], target_table: str = None,
+                                 include_target_keys: bool = False, source_url: str = None,
+                                 target_url: str = None):
+    # The distinct keys are copied with one INSERT ... SELECT inside SQLite, so no key ever
+    # has to be materialised in Python
+    col_name = ", ".join(quote(col) for col in primary_col)
+    keys_sql = unique_keys_sql(table_name, primary_col, target_table or table_name, include_target_keys)
     batch_id = str(uuid.uuid4())
-    placeholders = ", ".join(["?"] * (len(primary_col) + 2))
-    for combo in combinations:
-        flattened_combo = [item if isinstance(item, str) else item[0] for item in combo]
-        values = (batch_id, *flattened_combo, "")
-        cursor.execute(
-            f"""INSERT INTO {db_name} (batch_id, {col_name}, result) 
-                VALUES ({placeholders})""",
-            values
-        )
-    conn.commit()
-    conn.close()
-    return {"jobId": batch_id, "total_combinations": len(combinations)}
+    keys = connector_keys(table_name, primary_col, target_table, include_target_keys, source_url, target_url)
+    if keys is not None:
+        with db_connection(db_name) as (conn, cursor):
+            cursor.executemany(f"INSERT INTO {db_name} (batch_id, {col_name}, result) "
+                               f"VALUES (?, {', '.join(['?'] * len(primary_col))}, '')",
+                               [(batch_id, *key) for key in keys.itertuples(index=False)])
+            conn.commit()
+        return {"jobId": batch_id, "total_combinations": len(keys)}
+    with db_connection(db_name) as (conn, cursor), attached(cursor, 'source', 'src'), \
+            attached(cursor, 'target', 'tgt'):
+        cursor.execute(f"""
+            INSERT INTO main.{db_name} (batch_id, {col_name}, result)
+            SELECT ?, {col_name}, '' FROM ({keys_sql})
+        """, (batch_id,))
+        total = cursor.rowcount
+        conn.commit()
+    return {"jobId": batch_id, "total_combinations": total}
+
+
+def add_new_keys(db_name: str, batch_id: str, table_name: str, key_columns: List[str], target_table: str = None,
+                 include_target_keys: bool = False, source_url: str = None, target_url: str = None) -> int:
+    # Adds session rows for keys that appeared in the sheets after the session was set up
+    col_name = ", ".join(quote(col) for col in key_columns)
+    keys_sql = unique_keys_sql(table_name, key_columns, target_table or table_name, include_target_keys)
+    known = ' AND '.join(f"s.{quote(col)} = k.{quote(col)}" for col in key_columns)
+    keys = connector_keys(table_name, key_columns, target_table, include_target_keys, source_url, target_url)
+    if keys is not None:
+        with db_connection(db_name) as (conn, cursor):
+            cursor.execute(f"SELECT {col_name} FROM {db_name} WHERE batch_id=?", (batch_id,))
+            existing = pd.DataFrame(cursor.fetchall(), columns=key_columns)
+            new = keys.merge(existing, how='left', indicator=True).query("_merge == 'left_only'")[key_columns]
+            cursor.executemany(f"INSERT INTO {db_name} (batch_id, {col_name}, result) "
+                               f"VALUES (?, {', '.join(['?'] * len(key_columns))}, '')",
+                               [(batch_id, *key) for key in new.itertuples(index=False)])
+            conn.commit()
+        return len(new)
+    with db_connection(db_name) as (conn, cursor), attached(cursor, 'source', 'src'), \
+            attached(cursor, 'target', 'tgt'):
+        cursor.execute(f"""
+            INSERT INTO main.{db_name} (batch_id, {col_name}, result)
+            SELECT ?, {col_name}, '' FROM ({keys_sql}) k
+            WHERE NOT EXISTS (SELECT 1 FROM main.{db_name} s WHERE s.batch_id = ? AND {known})
+        """, (batch_id, batch_id))
+        added = cursor.rowcount
+        conn.commit()
+    return added
 
 
 def get_status_job_id(db_name: str, job_id: str):
-    sql = f"""
-        SELECT 
-            COUNT(CASE WHEN result = 'Pass' THEN 1 END) AS pass_count,
-            COUNT(CASE WHEN result = 'Fail' THEN 1 END) AS fail_count,
-            COUNT(CASE WHEN result IS NULL OR result = '' THEN 1 END) AS blank_count
-        FROM {db_name} where batch_id=?;
-        """
-    conn, cursor = connect_to_db(db_name)
-    cursor.execute(sql, (job_id,))
-    pass_count, fail_count, blank_count = cursor.fetchone()
-    conn.close()
-    return pass_count, fail_count, blank_count
+    # Counters are maintained by triggers on the session table (see app.counters)
+    with db_connection(db_name) as (conn, cursor):
+        try:
+            counts = get_result_counts(cursor, job_id)
+        except sqlite3.OperationalError:
+            # Session set up before the counters existed
+            create_result_counters(cursor, db_name)
+            conn.commit()
+            counts = get_result_counts(cursor, job_id)
+    return counts.get('Pass', 0), counts.get('Fail', 0), counts.get('', 0)
 
-def get_data_from_sheet_db(sheet_name: str, db_name:str) -> List[Dict]:
-    conn, cursor = connect_to_db(db_name)
-    cursor.execute(f"SELECT * FROM {sheet_name}")
-    rows = cursor.fetchall()
+def reset_job_results(db_name: str, job_id: str):
+    with db_connection(db_name) as (conn, cursor):
+        cursor.execute(f"DELETE FROM differences WHERE run_id IN (SELECT id FROM {db_name} WHERE batch_id=?)",
+                       (job_id,))
+        cursor.execute(f"UPDATE {db_name} SET result='' WHERE batch_id=?", (job_id,))
+        conn.commit()
+
+def get_sheet_page(sheet_name: str, db_name: str, after: Optional[int] = None, limit: int = Constants.PAGE_SIZE):
+    # One page of sheet rows after the `after` cursor; returns (rows, cursor of the next page or None).
+    # The cursor is the rowid for SQLite sheets and the row position for (immutable) snapshots.
+    snapshot = get_snapshot(db_name, sheet_name)
+    if snapshot:
+        start = after or 0
+        # Typed values; blanks come back as None instead of 'Null'
+        frame = snapshot_frame(snapshot, as_text=False, offset=start, length=limit).astype(object)
+        data = frame.where(frame.notna(), None).to_dict(orient="records")
+        return data, (start + len(data) if start + len(data) < snapshot["rows"] else None)
+    with db_connection(db_name) as (conn, cursor):
+        cursor.execute(f"SELECT rowid, * FROM {quote(sheet_name)} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                       (after or 0, limit))
+        rows = cursor.fetchall()
 
-    # Get column names
-    columns = [description[0] for description in cursor.description]
+        # Get column names
+        columns = [description[0] for description in cursor.description][1:]
 
     # Convert rows into a list of dictionaries
-    data = [dict(zip(columns, row)) for row in rows]
+    data = [dict(zip(columns, row[1:])) for row in rows]
+    return data, (rows[-1][0] if len(rows) == limit else None)
 
-    conn.close()
-    return data
+
+def iter_sheet_rows(sheet_name: str, db_name: str, after: Optional[int] = None):
+    return iter_keyset(lambda cursor: get_sheet_page(sheet_name, db_name, cursor), after)
+
+
+def get_data_from_sheet_db(sheet_name: str, db_name:str) -> List[Dict]:
+    return list(iter_sheet_rows(sheet_name, db_name))
 
 # # Example Usage
 # excel_file_path = "example.xlsx"
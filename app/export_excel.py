@@ -1,38 +1,111 @@
-import pandas as pd
+import csv
 import io
+import os
+import tempfile
+import zlib
 
+from openpyxl import Workbook
 from starlette.responses import StreamingResponse
 
-from app.database import connect_to_db
+from app.concurrency import iterate_ingest
+from app.database import db_connection, quote
+from app.metrics import inc, timed
 
+# Session rows per query; the export never holds more than one chunk in memory
+EXPORT_CHUNK_SIZE = 5000
+FILE_CHUNK_SIZE = 1024 * 1024
+DIFFERENCE_COLUMNS = ['row_index', 'column_name', 'old_value', 'new_value']
 
-def export_to_excel(db_name:str) :
-    result = get_all_data_from_table(db_name, db_name)
-    differences = get_all_data_from_table(db_name, 'differences')
-    combined_df = pd.merge(result, differences, how='left', left_on='id', right_on='run_id')
-    # Drop the `run_id` column if you don't want it in the final result
-    combined_df.drop('run_id', axis=1, inplace=True)
-    # Export to Excel
-    # combined_df.to_excel('Result.xlsx', index=False)
-    # Save DataFrame to an in-memory buffer
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        combined_df.to_excel(writer, index=False, sheet_name="Combined Data")
 
-    output.seek(0)  # Reset buffer position to the beginning
+def export_to_excel(db_name: str, job_id: str = None, result: str = None, file_format: str = "xlsx",
+                    compress: bool = False):
+    inc("exports_total", format=file_format, gzip=str(compress).lower())
+    rows = iter_result_rows(db_name, job_id, result)
+    if file_format == "csv":
+        content, media_type, file_name = iter_csv(rows), "text/csv", "Result.csv"
+        if compress:
+            content, media_type, file_name = iter_gzip(content), "application/gzip", "Result.csv.gz"
+    else:
+        content, file_name = iter_xlsx(rows), "Result.xlsx"
+        media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    # Return file as a response; the rows are read and encoded under the ingest limiter
+    return StreamingResponse(iterate_ingest(content), media_type=media_type,
+                             headers={"Content-Disposition": f"attachment; filename={file_name}"})
 
-    # Return file as a response
-    return StreamingResponse(output, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                             headers={"Content-Disposition": "attachment; filename=Result.xlsx"})
 
+def iter_result_rows(db_name: str, job_id: str = None, result: str = None, chunk_size: int = EXPORT_CHUNK_SIZE):
+    # Header, then the session rows left-joined to their differences. Column names match the
+    # old pandas merge (id_x / id_y). Pages are fetched by id so no cursor stays open between
+    # chunks, which lets the response iterate this from any thread.
+    with db_connection(db_name) as (conn, cursor):
+        cursor.execute(f"PRAGMA table_info({quote(db_name)})")
+        session_columns = [row[1] for row in cursor.fetchall()]
+    yield ['id_x' if col == 'id' else col for col in session_columns] + ['id_y'] + DIFFERENCE_COLUMNS
 
-def get_all_data_from_table(db_name:str,table_name: str) :
-    conn, cursor = connect_to_db(db_name)
-    cursor.execute(f"SELECT * from {table_name}")
-    results = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
-    conn.close()
-    return pd.DataFrame(results, columns=columns)
+    filters, params = ["s.id > ?"], []
+    if job_id:
+        filters.append("s.batch_id = ?")
+        params.append(job_id)
+    if result:
+        filters.append("s.result = ?")
+        params.append(result)
+    select_list = ', '.join(f"s.{quote(col)}" for col in session_columns)
+    difference_list = ', '.join(f"d.{col}" for col in ['id'] + DIFFERENCE_COLUMNS)
+    sql = f"""
+        SELECT {select_list}, {difference_list}
+        FROM (SELECT * FROM {quote(db_name)} s WHERE {' AND '.join(filters)} ORDER BY s.id LIMIT ?) s
+        LEFT JOIN differences d ON d.run_id = s.id
+        ORDER BY s.id, d.id
+    """
+    last_id = -1
+    while True:
+        with timed("export_page_seconds"), db_connection(db_name) as (conn, cursor):
+            cursor.execute(sql, (last_id, *params, chunk_size))
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        inc("export_rows_total", len(rows))
+        yield from rows
+        last_id = rows[-1][0]
+
+
+def iter_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % 1000 == 0:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_xlsx(rows):
+    # xlsx is a zip archive, so it cannot be sent before it is complete. A write-only workbook
+    # spools rows to disk, and the finished file is streamed from disk, keeping memory flat.
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet("Combined Data")
+    for row in rows:
+        worksheet.append(row)
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        workbook.save(path)
+        with open(path, "rb") as f:
+            while chunk := f.read(FILE_CHUNK_SIZE):
+                yield chunk
+    finally:
+        os.remove(path)
 
 
 # # Connect to your SQLite database
@@ -1,17 +1,21 @@
 import sqlite3
-from typing import List
+from typing import List, Optional
 
-from app.database import connect_to_db
+from app.counters import create_upload_counters, get_upload_counts
+from app.database import db_connection, iter_keyset
 from app.constants import Constants
 
+FILES_DB = 'files_status'
+
+
 class FileHandler:
 
     def __init__(self):
-        self.conn, self.cursor = connect_to_db('files_status')
-        self.__create_table()
+        with db_connection(FILES_DB) as (conn, cursor):
+            self.__create_table(conn, cursor)
 
-    def __create_table(self):
-        self.cursor.execute(f"""
+    def __create_table(self, conn, cursor):
+        cursor.execute(f"""
                             CREATE TABLE IF NOT EXISTS {Constants.FILE_STORE_TABLE} (
                             id INTEGER PRIMARY KEY AUTOINCREMENT,
                             FileName TEXT,
@@ -19,58 +23,55 @@ class FileHandler:
                             UPLOAD_STATUS TEXT
                             )
                         """)
-        self.conn.commit()
+        create_upload_counters(cursor)
+        conn.commit()
 
     def save_files_names_to_database(self, files: List[str], db_source: str):
-        # conn, cursor = connect_to_db('files_status')
-        for file in files:
-            self.__insert_files_to_database(file, db_source)
-        self.conn.commit()
+        with db_connection(FILES_DB) as (conn, cursor):
+            for file in files:
+                self.__insert_files_to_database(cursor, file, db_source)
+            conn.commit()
 
-    def get_file_status(self):
-        sql=f"""SELECT * FROM {Constants.FILE_STORE_TABLE}"""
-        self.cursor.execute(sql)
-        result =  self.cursor.fetchall()
-        # Get column names
-        columns = [description[0] for description in self.cursor.description]
+    def get_file_status(self, after: Optional[int] = None, limit: int = Constants.PAGE_SIZE):
+        # One page of file rows with id > after; returns (rows, cursor of the next page or None)
+        sql=f"""SELECT * FROM {Constants.FILE_STORE_TABLE} WHERE id > ? ORDER BY id LIMIT ?"""
+        with db_connection(FILES_DB) as (conn, cursor):
+            cursor.execute(sql, (after or 0, limit))
+            result = cursor.fetchall()
+            # Get column names
+            columns = [description[0] for description in cursor.description]
         # Convert rows into a list of dictionaries
         data = [dict(zip(columns, row)) for row in result]
-        return data
+        return data, (data[-1]["id"] if len(data) == limit else None)
+
+    def iter_file_status(self, after: Optional[int] = None):
+        return iter_keyset(self.get_file_status, after)
 
     def get_distinct_sources(self):
-        try:
-            sql = f"""SELECT DISTINCT(SOURCE) from {Constants.FILE_STORE_TABLE}"""
-            self.cursor.execute(sql)
-            return self.cursor.fetchall()
-        except sqlite3.OperationalError as e:
-            if Constants.FILE_STORE_TABLE in str(e):
-                self.__create_table()
-            return []
+        with db_connection(FILES_DB) as (conn, cursor):
+            try:
+                sql = f"""SELECT DISTINCT(SOURCE) from {Constants.FILE_STORE_TABLE}"""
+                cursor.execute(sql)
+                return cursor.fetchall()
+            except sqlite3.OperationalError as e:
+                if Constants.FILE_STORE_TABLE in str(e):
+                    self.__create_table(conn, cursor)
+                return []
 
 
     def get_file_processing_status(self):
-        sql = f"""
-                SELECT 
-                    COUNT(CASE WHEN UPLOAD_STATUS = 'pass' THEN 1 END) AS pass_count,
-                    COUNT(CASE WHEN UPLOAD_STATUS = 'fail' THEN 1 END) AS fail_count,
-                    COUNT(CASE WHEN UPLOAD_STATUS IS NULL OR UPLOAD_STATUS = '' THEN 1 END) AS blank_count
-                FROM {Constants.FILE_STORE_TABLE};
-                """
-        self.cursor.execute(sql)
-        pass_count, fail_count, blank_count = self.cursor.fetchone()
-        return {"pass": pass_count, "fail": fail_count, "yet": blank_count}
+        # Read from the trigger-maintained counters instead of scanning every file row
+        with db_connection(FILES_DB) as (conn, cursor):
+            counts = get_upload_counts(cursor)
+        return {"pass": counts.get("pass", 0), "fail": counts.get("fail", 0), "yet": counts.get("", 0)}
 
     def update_file_upload_status(self, status, file_name):
         sql = f"""UPDATE {Constants.FILE_STORE_TABLE} SET UPLOAD_STATUS=? WHERE FileName=?"""
-        self.cursor.execute(sql, (status, file_name))
-        self.conn.commit()
+        with db_connection(FILES_DB) as (conn, cursor):
+            cursor.execute(sql, (status, file_name))
+            conn.commit()
 
 
-    def __insert_files_to_database(self, file: str, source: str):
+    def __insert_files_to_database(self, cursor, file: str, source: str):
         sql = f"""INSERT INTO {Constants.FILE_STORE_TABLE} (FileName, SOURCE) VALUES (?, ?)"""
-        self.cursor.execute(sql, (file, source))
-        self.conn.commit()
-
-    def __del__(self):
-        self.conn.commit()
-        self.conn.close()
\ No newline at end of file
+        cursor.execute(sql, (file, source))
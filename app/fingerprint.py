@@ -0,0 +1,175 @@
+from itertools import repeat
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from app.compare_engine import session_key_columns, compare_columns_for, PENDING
+from app.connectors import key_strings, open_connector
+from app.constants import Constants
+from app.database import db_connection, quote
+
+# Spreads the ordinal of a row within its key, so reordered duplicate rows change the key hash
+ORDINAL_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def create_fingerprint_table(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {Constants.KEY_HASH_TABLE} (
+            batch_id TEXT,
+            run_id INTEGER,
+            source_hash INTEGER,
+            target_hash INTEGER,
+            PRIMARY KEY (batch_id, run_id)
+        )
+    """)
+
+
+def create_bucket_table(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {Constants.BUCKET_TABLE} (
+            batch_id TEXT,
+            bucket INTEGER,
+            first_id INTEGER,
+            last_id INTEGER,
+            keys INTEGER,
+            source_hash INTEGER,
+            target_hash INTEGER,
+            PRIMARY KEY (batch_id, bucket)
+        )
+    """)
+
+
+def table_fingerprints(connector, key_columns: List[str], compare_columns: List[str]) -> pd.Series:
+    # One uint64 per key string, covering the compared columns of every row of the key in the
+    # connector's row order. Keys with no rows are absent; callers treat them as hash 0.
+    parts = []
+    for chunk, keys in connector.iter_key_groups(key_columns + compare_columns, key_columns):
+        if compare_columns:
+            # Categorizing first only pays off for columns with few distinct values
+            rows = pd.util.hash_pandas_object(chunk[compare_columns], index=False, categorize=False).to_numpy()
+        else:
+            rows = np.zeros(len(chunk), dtype=np.uint64)
+        ordinals = keys.groupby(keys).cumcount().to_numpy(dtype=np.uint64)
+        mixed = pd.util.hash_array(rows ^ ((ordinals + np.uint64(1)) * ORDINAL_MIX))
+        # uint64 sums wrap around, which is what we want for a combined hash
+        parts.append(pd.Series(mixed, index=keys.to_numpy()).groupby(level=0).sum())
+    if not parts:
+        return pd.Series(dtype=np.uint64)
+    return pd.concat(parts)
+
+
+def refresh_fingerprints(batch_id: str, config: dict, incremental: bool = False) -> dict:
+    # Hashes the current source and target rows of every session key and stores them for the next
+    # run. In incremental mode, keys whose hashes differ from the stored ones (or were never hashed)
+    # are reset to pending and lose their differences; all other keys keep their Pass/Fail result.
+    db_name = config["db_name"]
+    external = bool(config.get("source_url") or config.get("target_url"))
+    with open_connector('source', config["source_table"], config.get("source_url"), external) as source_side, \
+            open_connector('target', config["target_table"], config.get("target_url"), external) as target_side, \
+            db_connection(db_name) as (conn, cursor):
+        create_fingerprint_table(cursor)
+        key_columns = session_key_columns(cursor, db_name)
+        compare_columns = compare_columns_for(source_side, target_side, key_columns, config["excluded_column"])
+        cursor.execute(f"SELECT id, {', '.join(quote(col) for col in key_columns)} FROM {db_name} WHERE batch_id=?",
+                       (batch_id,))
+        session = pd.DataFrame(cursor.fetchall(), columns=['id', *key_columns])
+        keys = key_strings(session, key_columns)
+        source = table_fingerprints(source_side, key_columns, compare_columns)
+        target = table_fingerprints(target_side, key_columns, compare_columns)
+        current = pd.DataFrame({
+            "run_id": session['id'].to_numpy(),
+            # SQLite integers are signed, so the hashes are stored as their int64 bit pattern
+            "source_hash": source.reindex(keys, fill_value=0).to_numpy(dtype=np.uint64).view(np.int64),
+            "target_hash": target.reindex(keys, fill_value=0).to_numpy(dtype=np.uint64).view(np.int64),
+        })
+
+        changed = current["run_id"]
+        if incremental:
+            cursor.execute(f"SELECT run_id, source_hash, target_hash FROM {Constants.KEY_HASH_TABLE} WHERE batch_id=?",
+                           (batch_id,))
+            previous = pd.DataFrame(cursor.fetchall(), columns=["run_id", "source_hash", "target_hash"])
+            merged = current.merge(previous, on="run_id", how="left", suffixes=("", "_previous"))
+            unchanged = (merged["source_hash"] == merged["source_hash_previous"]) & \
+                        (merged["target_hash"] == merged["target_hash_previous"])
+            changed = merged.loc[~unchanged, "run_id"]
+            ids = [(int(run_id),) for run_id in changed]
+            cursor.executemany("DELETE FROM differences WHERE run_id=?", ids)
+            cursor.executemany(f"UPDATE {db_name} SET result='' WHERE id=?", ids)
+
+        cursor.execute(f"DELETE FROM {Constants.KEY_HASH_TABLE} WHERE batch_id=?", (batch_id,))
+        cursor.executemany(f"""
+            INSERT INTO {Constants.KEY_HASH_TABLE} (batch_id, run_id, source_hash, target_hash) VALUES (?, ?, ?, ?)
+        """, zip(repeat(batch_id), current["run_id"].tolist(), current["source_hash"].tolist(),
+                 current["target_hash"].tolist()))
+        conn.commit()
+    return {"keys": len(current), "changed": len(changed)}
+
+
+def clear_fingerprints(db_name: str, batch_id: str):
+    with db_connection(db_name) as (conn, cursor):
+        create_fingerprint_table(cursor)
+        cursor.execute(f"DELETE FROM {Constants.KEY_HASH_TABLE} WHERE batch_id=?", (batch_id,))
+        conn.commit()
+
+
+def precheck(batch_id: str, db_name: str, bucket_keys: int = Constants.PRECHECK_BUCKET_KEYS) -> dict:
+    # Merkle-style pre-comparison over the key hashes stored by refresh_fingerprints. Each key's
+    # hash is mixed with its session id, and the leaves are summed into buckets of `bucket_keys`
+    # consecutive session ids and then into one hash per table. Identical tables pass every
+    # pending key at once, matching buckets pass their key range, and in the other buckets only
+    # the keys whose own hashes match pass; the rest stay pending for the compare engines.
+    # Equal hashes mean equal stored values, which every DiffOptions setting treats as a Pass.
+    with db_connection(db_name) as (conn, cursor):
+        create_bucket_table(cursor)
+        cursor.execute(f"SELECT run_id, source_hash, target_hash FROM {Constants.KEY_HASH_TABLE} WHERE batch_id=? "
+                       f"ORDER BY run_id", (batch_id,))
+        hashes = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+        run_ids = hashes[:, 0]
+        # Without the id, keys swapping their rows would leave the sums unchanged
+        ids = pd.util.hash_array(run_ids.view(np.uint64))
+        source = pd.util.hash_array(hashes[:, 1].view(np.uint64) ^ ids)
+        target = pd.util.hash_array(hashes[:, 2].view(np.uint64) ^ ids)
+        starts = np.arange(0, len(run_ids), bucket_keys)
+        # uint64 sums wrap around, like the per-key hashes
+        source_buckets = np.add.reduceat(source, starts) if len(starts) else source[:0]
+        target_buckets = np.add.reduceat(target, starts) if len(starts) else target[:0]
+        ends = np.append(starts[1:], len(run_ids)) - 1
+        matching = source_buckets == target_buckets
+        identical = bool(source_buckets.sum() == target_buckets.sum())
+
+        cursor.execute(f"DELETE FROM {Constants.BUCKET_TABLE} WHERE batch_id=?", (batch_id,))
+        cursor.executemany(f"""
+            INSERT INTO {Constants.BUCKET_TABLE} (batch_id, bucket, first_id, last_id, keys, source_hash, target_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [(batch_id, bucket, int(run_ids[start]), int(run_ids[end]), int(end - start + 1), int(s_hash), int(t_hash))
+              for bucket, (start, end, s_hash, t_hash) in enumerate(zip(
+                  starts, ends, source_buckets.view(np.int64), target_buckets.view(np.int64)))])
+
+        if identical:
+            cursor.execute(f"UPDATE {db_name} SET result='Pass' WHERE batch_id=? AND {PENDING}", (batch_id,))
+            passed = cursor.rowcount
+        else:
+            cursor.executemany(f"UPDATE {db_name} SET result='Pass' WHERE batch_id=? AND id BETWEEN ? AND ? AND {PENDING}",
+                               [(batch_id, int(run_ids[start]), int(run_ids[end]))
+                                for start, end in zip(starts[matching], ends[matching])])
+            passed = cursor.rowcount
+            in_differing = np.repeat(~matching, ends - starts + 1)
+            equal = run_ids[in_differing & (source == target)]
+            cursor.executemany(f"UPDATE {db_name} SET result='Pass' WHERE id=? AND {PENDING}",
+                               [(int(run_id),) for run_id in equal])
+            passed += cursor.rowcount
+        conn.commit()
+    return {"identical": identical, "buckets": len(starts), "matchingBuckets": int(matching.sum()),
+            "keys": len(run_ids), "passed": passed}
+
+
+def precheck_summary(db_name: str, batch_id: str) -> dict:
+    with db_connection(db_name) as (conn, cursor):
+        create_bucket_table(cursor)
+        cursor.execute(f"""
+            SELECT COUNT(*), COUNT(CASE WHEN source_hash = target_hash THEN 1 END), SUM(keys)
+            FROM {Constants.BUCKET_TABLE} WHERE batch_id=?
+        """, (batch_id,))
+        buckets, matching, keys = cursor.fetchone()
+    return {"buckets": buckets, "matchingBuckets": matching, "keys": keys or 0}
@@ -0,0 +1,50 @@
+import re
+import sqlite3
+import time
+from typing import List
+
+from app.database import db_connection, quote
+
+
+def index_name(table: str, columns: List[str]) -> str:
+    return re.sub(r"\W", "_", f"idx_{table}_{'_'.join(columns)}")
+
+
+def create_index(db_name: str, table: str, columns: List[str]) -> float:
+    # CREATE INDEX IF NOT EXISTS, so calling it on every setup keeps the index in place;
+    # SQLite maintains it from then on as rows are ingested. Returns the build time.
+    start = time.perf_counter()
+    with db_connection(db_name) as (conn, cursor):
+        # SQLite reads an unknown double-quoted name as a string literal and would index a constant
+        cursor.execute(f"PRAGMA table_info({quote(table)})")
+        existing = {row[1] for row in cursor.fetchall()}
+        if not existing:
+            raise sqlite3.OperationalError(f"no such table: {table}")
+        missing = [col for col in columns if col not in existing]
+        if missing:
+            raise sqlite3.OperationalError(f"no such column: {', '.join(missing)}")
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS {quote(index_name(table, columns))}
+            ON {quote(table)} ({', '.join(quote(col) for col in columns)})
+        """)
+        conn.commit()
+    return time.perf_counter() - start
+
+
+def create_compare_indexes(session_table: str, source_table: str, target_table: str, primary_col: List[str]):
+    indexes = [
+        ('source', source_table, primary_col),
+        ('target', target_table, primary_col),
+        (session_table, session_table, ['batch_id', 'result']),
+        (session_table, 'differences', ['run_id']),
+    ]
+    timings = {}
+    for db_name, table, columns in indexes:
+        if table is None:
+            continue
+        try:
+            timings[f"{db_name}.{table}"] = round(create_index(db_name, table, columns), 3)
+        except sqlite3.OperationalError as e:
+            print(f"Index on {db_name}.{table} ({', '.join(columns)}) not created: {e}")
+            timings[f"{db_name}.{table}"] = None
+    return timings
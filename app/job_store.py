@@ -0,0 +1,197 @@
+import json
+import time
+from typing import Optional, List
+
+from app.constants import Constants
+from app.database import db_connection
+
+JOBS_DB = 'jobs'
+
+# Run modes: "full" compares every key, "incremental" only keys whose rows changed since the last run
+FULL, INCREMENTAL = "full", "incremental"
+MODES = (FULL, INCREMENTAL)
+
+CREATED, QUEUED, IN_PROGRESS = "created", "queued", "in_progress"
+COMPLETED, FAILED, CANCELLING, CANCELLED = "completed", "failed", "cancelling", "cancelled"
+# A fail-fast job that hit its failure limit before comparing every key
+STOPPED = "stopped"
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED, STOPPED)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobStopped(Exception):
+    pass
+
+
+class JobStore:
+    # Durable registry of compare jobs, shared by every API worker through jobs.db.
+    # Each job keeps the config captured at setup, so it no longer depends on process memory.
+
+    def __init__(self):
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {Constants.JOB_TABLE} (
+                    job_id TEXT PRIMARY KEY,
+                    session TEXT,
+                    config TEXT,
+                    state TEXT,
+                    partitions INTEGER,
+                    mode TEXT,
+                    owner TEXT,
+                    error TEXT,
+                    created_at REAL,
+                    updated_at REAL,
+                    heartbeat_at REAL
+                )
+            """)
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {Constants.JOB_TIMING_TABLE} (
+                    job_id TEXT,
+                    phase TEXT,
+                    seconds REAL,
+                    rows INTEGER,
+                    PRIMARY KEY (job_id, phase)
+                )
+            """)
+            cursor.execute(f"""
+                CREATE INDEX IF NOT EXISTS idx_{Constants.JOB_TABLE}_state
+                ON {Constants.JOB_TABLE} (state, created_at)
+            """)
+            conn.commit()
+
+    def create(self, job_id: str, session: str, config: dict):
+        now = time.time()
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.execute(f"""
+                INSERT INTO {Constants.JOB_TABLE} (job_id, session, config, state, partitions, mode, created_at, updated_at)
+                VALUES (?, ?, ?, ?, 1, ?, ?, ?)
+            """, (job_id, session, json.dumps(config), CREATED, FULL, now, now))
+            conn.commit()
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.execute(f"SELECT * FROM {Constants.JOB_TABLE} WHERE job_id=?", (job_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            job = dict(zip([description[0] for description in cursor.description], row))
+        job["config"] = json.loads(job["config"])
+        return job
+
+    def get_state(self, job_id: str) -> Optional[str]:
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.execute(f"SELECT state FROM {Constants.JOB_TABLE} WHERE job_id=?", (job_id,))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_config(self, job_id: str) -> dict:
+        return self.get(job_id)["config"]
+
+    def enqueue(self, job_id: str, partitions: int, mode: str = FULL) -> Optional[str]:
+        # Queue a job that is not already queued or running; returns the resulting state
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.execute(f"""
+                UPDATE {Constants.JOB_TABLE}
+                SET state=?, partitions=?, mode=?, owner=NULL, error=NULL, updated_at=?
+                WHERE job_id=? AND state IN ({', '.join(['?'] * (len(FINISHED_STATES) + 1))})
+            """, (QUEUED, partitions, mode, time.time(), job_id, CREATED, *FINISHED_STATES))
+            if cursor.rowcount:
+                # A new run gets a new timing breakdown; setup timings are kept
+                cursor.execute(f"DELETE FROM {Constants.JOB_TIMING_TABLE} WHERE job_id=? AND phase NOT LIKE 'setup.%'",
+                               (job_id,))
+            conn.commit()
+        return self.get_state(job_id)
+
+    def claim_next(self, owner: str, max_running: int = Constants.MAX_CONCURRENT_JOBS) -> Optional[dict]:
+        # Atomically move the oldest queued job to in_progress, unless the cluster-wide limit
+        # of running jobs is reached. BEGIN IMMEDIATE serialises claims across processes.
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(f"SELECT COUNT(*) FROM {Constants.JOB_TABLE} WHERE state IN (?, ?)",
+                           (IN_PROGRESS, CANCELLING))
+            if cursor.fetchone()[0] >= max_running:
+                conn.rollback()
+                return None
+            cursor.execute(f"""
+                SELECT job_id FROM {Constants.JOB_TABLE} WHERE state=? ORDER BY created_at LIMIT 1
+            """, (QUEUED,))
+            row = cursor.fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            now = time.time()
+            cursor.execute(f"""
+                UPDATE {Constants.JOB_TABLE} SET state=?, owner=?, updated_at=?, heartbeat_at=? WHERE job_id=?
+            """, (IN_PROGRESS, owner, now, now, row[0]))
+            conn.commit()
+        return self.get(row[0])
+
+    def heartbeat(self, job_ids: List[str], owner: str):
+        if not job_ids:
+            return
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.executemany(f"""
+                UPDATE {Constants.JOB_TABLE} SET heartbeat_at=? WHERE job_id=? AND owner=?
+            """, [(time.time(), job_id, owner) for job_id in job_ids])
+            conn.commit()
+
+    def requeue_stale(self, timeout: float = Constants.JOB_HEARTBEAT_TIMEOUT) -> int:
+        # Jobs whose worker stopped heartbeating (crash, restart) go back to the queue. Results
+        # are committed per chunk, so the rerun resumes from the rows that are still pending.
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.execute(f"""
+                UPDATE {Constants.JOB_TABLE}
+                SET state = CASE state WHEN ? THEN ? ELSE ? END, owner=NULL, updated_at=?
+                WHERE state IN (?, ?) AND heartbeat_at < ?
+            """, (CANCELLING, CANCELLED, QUEUED, time.time(), IN_PROGRESS, CANCELLING, time.time() - timeout))
+            conn.commit()
+            return cursor.rowcount
+
+    def finish(self, job_id: str, state: str, owner: str, error: str = None):
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.execute(f"""
+                UPDATE {Constants.JOB_TABLE} SET state=?, error=?, owner=NULL, updated_at=?
+                WHERE job_id=? AND owner=?
+            """, (state, error, time.time(), job_id, owner))
+            conn.commit()
+
+    def cancel(self, job_id: str) -> Optional[str]:
+        # Queued jobs are cancelled at once; running ones stop at their next progress checkpoint
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.execute(f"""
+                UPDATE {Constants.JOB_TABLE}
+                SET state = CASE state WHEN ? THEN ? ELSE ? END, updated_at=?
+                WHERE job_id=? AND state IN (?, ?, ?)
+            """, (IN_PROGRESS, CANCELLING, CANCELLED, time.time(), job_id, CREATED, QUEUED, IN_PROGRESS))
+            conn.commit()
+        return self.get_state(job_id)
+
+    def add_timings(self, job_id: str, phases: dict):
+        # phases: {phase: (seconds, rows)}; added to what earlier partitions or attempts recorded
+        if not phases:
+            return
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.executemany(f"""
+                INSERT INTO {Constants.JOB_TIMING_TABLE} (job_id, phase, seconds, rows) VALUES (?, ?, ?, ?)
+                ON CONFLICT (job_id, phase) DO UPDATE SET seconds = seconds + excluded.seconds,
+                                                          rows = rows + excluded.rows
+            """, [(job_id, phase, seconds, rows) for phase, (seconds, rows) in phases.items()])
+            conn.commit()
+
+    def get_timings(self, job_id: str) -> dict:
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.execute(f"SELECT phase, seconds, rows FROM {Constants.JOB_TIMING_TABLE} WHERE job_id=? ORDER BY phase",
+                           (job_id,))
+            return {phase: (seconds, rows) for phase, seconds, rows in cursor.fetchall()}
+
+    def state_counts(self) -> dict:
+        with db_connection(JOBS_DB) as (conn, cursor):
+            cursor.execute(f"SELECT state, COUNT(*) FROM {Constants.JOB_TABLE} GROUP BY state")
+            return dict(cursor.fetchall())
+
+    def check_cancelled(self, job_id: str):
+        if self.get_state(job_id) in (CANCELLING, CANCELLED):
+            raise JobCancelled(job_id)
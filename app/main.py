@@ -1,22 +1,59 @@
 import fileinput
-from io import BytesIO
+import json
 from typing import List
 
-from fastapi import FastAPI, File, UploadFile, Request
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+
+from fastapi import FastAPI, File, UploadFile, Request, HTTPException
 from starlette.background import BackgroundTasks
+from starlette.responses import StreamingResponse, PlainTextResponse
 
 from app.batch_processing import process_items
-from app.cache import put_value_to_cache
-from app.excel_to_db import excel_to_db, get_list_tables, get_col_names_from_db, create_batch_job_setup, \
-    get_status_job_id
+from app.concurrency import run_db, run_ingest, save_upload, upload_slots
+from app.constants import Constants
+from app.database import pool
+from app.diff import DiffOptions
+from app.excel_to_db import excel_to_db, files_to_db, get_list_tables, get_col_names_from_db, create_batch_job_setup, \
+    get_status_job_id, reset_job_results, get_sheet_page, iter_sheet_rows
 from app.export_excel import export_to_excel
 from app.file_handler import FileHandler
-from app.model import BatchRequest, job_store
+from app.fingerprint import precheck_summary
+from app.partitions import get_partition_status
+from app.progress import ProgressHub
+from app.sampling import sample_estimate
+from app.job_store import JobStore, FINISHED_STATES, FAILED, FULL, MODES
+from app import metrics
+from app.model import BatchRequest
+from app.scheduler import JobScheduler
 import os
 import io
-import aiofiles
 
-app = FastAPI()
+job_store = JobStore()
+scheduler = JobScheduler(process_items)
+
+
+def collect_metrics():
+    stats = pool.stats()
+    samples = [("db_pool_waits", {}, stats["waits"]), ("db_pool_wait_seconds", {}, stats["wait_seconds"]),
+               ("db_pool_max_wait_seconds", {}, stats["max_wait_seconds"])]
+    samples += [("db_pool_open_connections", {"db": db}, count) for db, count in stats["open_connections"].items()]
+    samples += [("jobs", {"state": state}, count) for state, count in job_store.state_counts().items()]
+    samples.append(("progress_subscribers", {}, progress_hub.subscribers()))
+    return samples
+
+
+metrics.add_collector(collect_metrics)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    scheduler.start()
+    yield
+    scheduler.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 file_handler = FileHandler()
 
 # @app.get("/batch/clearData")
@@ -37,89 +74,236 @@ file_handler = FileHandler()
 #             except Exception as e:
 #                 print(f"Error deleting {file_path}: {e}")
 
-def handle_files(files: List[UploadFile], db_source: str):
-    for file in files:
-        file_path = f"/tmp/{file.filename}"  # Save file temporarily
+def page_params(request: Request):
+    after = request.query_params.get("after")
+    limit = int(request.query_params.get("limit", Constants.PAGE_SIZE))
+    return (int(after) if after else None), min(max(limit, 1), Constants.MAX_PAGE_SIZE)
+
+
+def ndjson(rows):
+    # One JSON object per line, written as rows are read
+    return StreamingResponse((json.dumps(row, default=str) + "\n" for row in rows), media_type="application/x-ndjson")
+
+def uploads_busy():
+    return HTTPException(status_code=429, detail="Too many uploads in progress, retry later",
+                         headers={"Retry-After": "5"})
 
-        # Save file to disk
-        with open(file_path, "wb") as f:
-            f.write(file.file.read())  # Correct way to read file content
+def handle_files(saved, db_source: str):
+    # Parse files and sheets in parallel; each file's status is recorded as soon as it finishes
+    try:
+        files_to_db(saved, db_source,
+                    lambda file_name, status: file_handler.update_file_upload_status(status, file_name))
+    finally:
+        for _, file_path in saved:
+            if os.path.exists(file_path):
+                os.remove(file_path)
 
-        # Process file
-        with open(file_path, 'rb') as f:
-            status = "fail"
-            try:
-                excel_to_db(BytesIO(f.read()), db_source)
-                status = "pass"
-            except Exception as e:
-                status = "fail"
-            FileHandler().update_file_upload_status(status, file.filename)
+async def ingest_files(saved, db_source: str):
+    try:
+        await run_ingest(handle_files, saved, db_source)
+    finally:
+        upload_slots.release()
 
 @app.post("/batch/upload")
 async def update_to_database(request: Request, background_tasks: BackgroundTasks):
-    form = await request.form()  # Parse incoming form data
-    files: List[UploadFile] = form.getlist("file")  # Extract multiple files
-    db_source: str = form.get("db_source")  # Get db_source parameter
-    file_names = [file.filename for file in files]
-    file_handler.save_files_names_to_database(file_names, db_source)
-    background_tasks.add_task(handle_files, files, db_source)
+    if not upload_slots.try_acquire():
+        raise uploads_busy()
+    saved = []
+    try:
+        form = await request.form()  # Parse incoming form data
+        files: List[UploadFile] = form.getlist("file")  # Extract multiple files
+        db_source: str = form.get("db_source")  # Get db_source parameter
+        for file in files:
+            saved.append((file.filename, await save_upload(file)))
+        await run_db(file_handler.save_files_names_to_database, [name for name, _ in saved], db_source)
+    except BaseException:
+        for _, file_path in saved:
+            os.remove(file_path)
+        upload_slots.release()
+        raise
+    # The slot is held until the background parse is done
+    background_tasks.add_task(ingest_files, saved, db_source)
     return {"message": "started"}
 
 @app.get("/batch/upload-status")
-async def upload_status_files():
-    return {"filestatus":file_handler.get_file_status(), "status": file_handler.get_file_processing_status()}
+async def upload_status_files(request: Request):
+    after, limit = page_params(request)
+    if request.query_params.get("format") == "ndjson":
+        return ndjson(file_handler.iter_file_status(after))
+    files, next_cursor = await run_db(file_handler.get_file_status, after, limit)
+    status = await run_db(file_handler.get_file_processing_status)
+    return {"filestatus": files, "nextCursor": next_cursor, "status": status}
 
 @app.get("/batch/data-source")
 async def distinct_data_source():
-    return file_handler.get_distinct_sources()
+    return await run_db(file_handler.get_distinct_sources)
 
 @app.get("/batch/tables-list/{target}")
 async def get_list_of_tables(target: str):
-    return get_list_tables(target)
+    return await run_db(get_list_tables, target)
 
 @app.post("/batch/update/{target}")
 async def upload_excel(target: str, file: List[UploadFile] = File(...)):
-    for f in file:
-        async with aiofiles.open(file.filename, "wb") as f:
-            while chunk := await file.read(1024 * 1024):  # Read 1 MB at a time
-                await f.write(chunk)
-        with open(file.filename, "rb") as f:
-            excel_to_db(BytesIO(f.read()), target)
-    return get_list_tables(target)
+    if not upload_slots.try_acquire():
+        raise uploads_busy()
+    try:
+        for upload in file:
+            # The parser reads the spooled upload directly, without another copy on disk or in memory
+            await upload.seek(0)
+            await run_ingest(excel_to_db, upload.file, target)
+    finally:
+        upload_slots.release()
+    return await run_db(get_list_tables, target)
     # return JSONResponse(content={"message": "Excel file uploaded and data saved"}, status_code=200)
 
 @app.get("/batch/columns")
 async def retrieve_columns(request: Request):
     sheet_name = request.query_params.get("sheetName")
-    return get_col_names_from_db(sheet_name)
+    return await run_db(get_col_names_from_db, sheet_name)
+
+@app.get("/batch/data")
+async def sheet_data(request: Request):
+    sheet_name = request.query_params.get("sheetName")
+    db_name = request.query_params.get("dbSource", "source")
+    if db_name not in ("source", "target") or sheet_name not in await run_db(get_list_tables, db_name):
+        raise HTTPException(status_code=404, detail=f"Unknown sheet {sheet_name}")
+    after, limit = page_params(request)
+    if request.query_params.get("format") == "ndjson":
+        return ndjson(iter_sheet_rows(sheet_name, db_name, after))
+    rows, next_cursor = await run_db(get_sheet_page, sheet_name, db_name, after, limit)
+    return {"rows": rows, "nextCursor": next_cursor}
 
 @app.post("/batch/compare")
 async def setup_batch(batch_request: BatchRequest):
-    put_value_to_cache('source_table', batch_request.sourceTable)
-    put_value_to_cache('target_table', batch_request.targetTable)
-    put_value_to_cache('excluded_column', batch_request.excludedColumns)
-    put_value_to_cache('db_name', batch_request.compareSessionName.replace(" ", "_"))
-    return create_batch_job_setup(batch_request.compareSessionName, batch_request.sourceTable,batch_request.primaryColumns)
+    return await run_ingest(setup_job, batch_request)
+
+
+def setup_job(batch_request: BatchRequest):
+    db_name = batch_request.compareSessionName.replace(" ", "_")
+    try:
+        setup = create_batch_job_setup(batch_request.compareSessionName, batch_request.sourceTable,
+                                       batch_request.primaryColumns, batch_request.targetTable,
+                                       batch_request.includeTargetKeys, batch_request.dryRun,
+                                       batch_request.sourceUrl, batch_request.targetUrl)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if setup["jobId"]:
+        # The job keeps its own config, so concurrent sessions cannot overwrite each other
+        job_store.create(setup["jobId"], db_name, {
+            "source_table": batch_request.sourceTable,
+            "target_table": batch_request.targetTable,
+            "excluded_column": batch_request.excludedColumns,
+            "db_name": db_name,
+            "compare_engine": batch_request.compareEngine,
+            "include_target_keys": batch_request.includeTargetKeys,
+            "source_url": batch_request.sourceUrl,
+            "target_url": batch_request.targetUrl,
+            "sample_size": batch_request.sampleSize,
+            "sample_seed": batch_request.sampleSeed,
+            "confidence": batch_request.confidence,
+            "fail_after": batch_request.failAfter,
+            "max_mismatch_rate": batch_request.maxMismatchRate,
+            "precheck": batch_request.precheck,
+            "diff_options": asdict(DiffOptions(batch_request.numericTolerance, batch_request.normalizeNulls,
+                                               batch_request.trimWhitespace)),
+        })
+        # Setup phases join the job's timing breakdown in /batch/status
+        job_store.add_timings(setup["jobId"], {
+            f"setup.{phase}": (seconds, setup["total_combinations"] if phase == "session_keys" else 0)
+            for phase, seconds in setup["timings"].items()})
+    return setup
 
 
 @app.get("/batch/compare")
-async def trigger_batch(request: Request, background_tasks: BackgroundTasks):
+async def trigger_batch(request: Request):
     job_id = request.query_params.get("jobId")
-    job_store[job_id] = "in_progress"
-    background_tasks.add_task(process_items, job_id)
-    return {"jobId": job_id}
+    partitions = int(request.query_params.get("partitions", Constants.COMPARE_WORKERS))
+    mode = request.query_params.get("mode", FULL)
+    if mode not in MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(MODES)}")
+    state = await run_db(start_job, job_id, partitions, mode)
+    scheduler.wake()
+    return {"jobId": job_id, "ExecutionStatus": state}
+
+
+def start_job(job_id: str, partitions: int, mode: str):
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    if job["state"] in FINISHED_STATES and mode == FULL:
+        # A full run of a finished job starts it from scratch; incremental runs reset changed keys only
+        reset_job_results(job["session"], job_id)
+    config = job["config"]
+    if config.get("source_url") or config.get("target_url"):
+        # Every partition would stream the whole external table to keep its share of the keys
+        partitions = 1
+    return job_store.enqueue(job_id, max(partitions, 1), mode)
+
+
+@app.post("/batch/cancel")
+async def cancel_batch(request: Request):
+    job_id = request.query_params.get("jobId")
+    return {"jobId": job_id, "ExecutionStatus": await run_db(job_store.cancel, job_id) or FAILED}
 
 
 @app.get("/batch/status")
 async def get_status(request: Request):
     job_id = request.query_params.get("jobId")
     session_id = request.query_params.get("sessionName")
-    pass_count, fail_count, blank_count = get_status_job_id(session_id.replace(" ", "_"), job_id)
-    status = job_store.get(job_id, "failed")
-    return {"jobId": job_id, "ExecutionStatus": status, "Pass": pass_count,
-                "Fail": fail_count, "Pending": blank_count}
+    return await run_db(job_status, job_id, session_id.replace(" ", "_"))
+
+
+def job_progress(job_id: str, db_name: str):
+    pass_count, fail_count, blank_count = get_status_job_id(db_name, job_id)
+    job = job_store.get(job_id)
+    progress = {"ExecutionStatus": job["state"] if job else FAILED, "Pass": pass_count, "Fail": fail_count,
+                "Pending": blank_count}
+    if job and job["config"].get("sample_size"):
+        # Pending also counts the keys outside the sample; Remaining is what the job still compares
+        progress["Remaining"] = sum(partition["total"] - partition["processed"]
+                                    for partition in get_partition_status(db_name, job_id))
+    return progress
+
+
+progress_hub = ProgressHub(job_progress)
+
+
+def job_status(job_id: str, db_name: str):
+    timings = {phase: {"seconds": round(seconds, 3), "rows": rows,
+                       "rowsPerSec": round(rows / seconds, 1) if rows and seconds else None}
+               for phase, (seconds, rows) in job_store.get_timings(job_id).items()}
+    status = {"jobId": job_id, **job_progress(job_id, db_name),
+              "Partitions": get_partition_status(db_name, job_id), "Timings": timings}
+    job = job_store.get(job_id)
+    if job and job["config"].get("sample_size"):
+        # Pending counts the keys outside the sample; the estimate covers the whole session
+        status["Sample"] = sample_estimate(db_name, job_id, job["config"].get("confidence", 0.95))
+    elif job and job["config"].get("precheck", False):
+        status["Precheck"] = precheck_summary(db_name, job_id)
+    return status
+
+@app.get("/batch/events")
+async def job_events(request: Request):
+    # Server-sent progress events of one job, instead of polling /batch/status
+    job_id = request.query_params.get("jobId")
+    session_id = request.query_params.get("sessionName")
+    if await run_db(job_store.get, job_id) is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return StreamingResponse(progress_hub.events(job_id, session_id.replace(" ", "_")),
+                             media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(await run_db(metrics.render), media_type="text/plain; version=0.0.4")
+
+@app.get("/batch/db-pool")
+async def db_pool_stats():
+    return pool.stats()
 
 @app.get("/batch/download")
 async def download_excel(request: Request):
     session_id = request.query_params.get("sessionName")
-    return export_to_excel(session_id.replace(" ", "_"))
\ No newline at end of file
+    params = request.query_params
+    return export_to_excel(session_id.replace(" ", "_"), job_id=params.get("jobId"), result=params.get("result"),
+                           file_format=params.get("format", "xlsx"),
+                           compress=params.get("gzip", "false").lower() == "true")
\ No newline at end of file
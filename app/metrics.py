@@ -0,0 +1,206 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict
+
+from app.constants import Constants
+
+# In-process metrics in the Prometheus text format, without a client library. Counters and
+# summaries (count + sum) are updated on the hot paths; gauges that are cheaper to read than to
+# track (pool, queue and job counts) are collected when /metrics is rendered.
+PREFIX = "ptf_"
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_summaries = {}
+_collectors = []
+_job = threading.local()
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, seconds: float, **labels):
+    with _lock:
+        key = _key(name, labels)
+        count, total = _summaries.get(key, (0, 0.0))
+        _summaries[key] = (count + 1, total + seconds)
+
+
+def add_collector(collect):
+    # collect() returns (name, labels, value) gauge samples, read at render time
+    _collectors.append(collect)
+
+
+@contextmanager
+def timed(name: str, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def job_phase(phase: str, rows: int = 0):
+    # Adds the block's duration (and rows) to the tracked job of this thread, if any. Job phases
+    # reach /metrics when the job finishes, since partitions may run in other processes.
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = getattr(_job, "timings", None)
+        if timings is not None:
+            timings.add(phase, time.perf_counter() - start, rows)
+
+
+def job_phase_iter(phase: str, iterable):
+    # Time spent producing each item (e.g. reading the next chunk) counts toward `phase`
+    iterator = iter(iterable)
+    while True:
+        with job_phase(phase):
+            item = next(iterator, _END)
+        if item is _END:
+            return
+        yield item
+
+
+_END = object()
+
+
+def job_rows(phase: str, rows: int):
+    timings = getattr(_job, "timings", None)
+    if timings is not None:
+        timings.add(phase, 0.0, rows)
+
+
+class JobTimings:
+    # Seconds and rows per phase of one job, accumulated in memory and saved by track_job
+
+    def __init__(self):
+        self.phases: Dict[str, list] = {}
+
+    def add(self, phase: str, seconds: float, rows: int = 0):
+        totals = self.phases.setdefault(phase, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += rows
+
+
+@contextmanager
+def track_job(save):
+    # Collects the timings of the current thread's work; save(phases) runs at the end, also on errors
+    previous = getattr(_job, "timings", None)
+    _job.timings = JobTimings()
+    try:
+        yield _job.timings
+    finally:
+        timings, _job.timings = _job.timings, previous
+        save(timings.phases)
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in labels) + "}"
+
+
+def render() -> str:
+    gauges = []
+    for collect in _collectors:
+        try:
+            gauges.extend(collect())
+        except Exception as e:
+            print(f"Metrics collector failed: {e}")
+    with _lock:
+        counters, summaries = dict(_counters), dict(_summaries)
+        gauges = list(_gauges.items()) + [(_key(name, labels), value) for name, labels, value in gauges]
+    lines = []
+    for kind, samples in (("counter", counters.items()), ("gauge", gauges)):
+        declared = set()
+        for (name, labels), value in sorted(samples, key=lambda sample: sample[0]):
+            if name not in declared:
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                declared.add(name)
+            lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+    declared = set()
+    for (name, labels), (count, total) in sorted(summaries.items()):
+        if name not in declared:
+            lines.append(f"# TYPE {PREFIX}{name} summary")
+            declared.add(name)
+        lines.append(f"{PREFIX}{name}_count{_labels(labels)} {count}")
+        lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {round(total, 6)}")
+    return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    # Samples one thread's stack every `interval` seconds and writes the counts in the folded
+    # format flame graph tools read ("outer;inner count" per line). Opt-in with PROFILE_JOBS.
+
+    def __init__(self, path: str, interval: float = Constants.PROFILE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.stacks = Counter()
+        self.__thread_id = threading.get_ident()
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__sample, name="profiler", daemon=True)
+
+    def __enter__(self):
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.__stop.set()
+        self.__thread.join()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def __sample(self):
+        while not self.__stop.wait(self.interval):
+            frame = sys._current_frames().get(self.__thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+def profile_path(job_id: str, part: str = None) -> str:
+    name = f"{job_id}.{part}.folded" if part else f"{job_id}.folded"
+    return os.path.join(Constants.PROFILE_DIR, name)
+
+
+def merge_profiles(path: str, parts):
+    # Sums the partition profiles of a job into one file and removes them
+    stacks = Counter()
+    for part in parts:
+        if not os.path.exists(part):
+            continue
+        with open(part) as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                stacks[stack] += int(count)
+        os.remove(part)
+    if stacks:
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
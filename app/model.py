@@ -1,6 +1,6 @@
 # Define request body schema
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
 
 
 class BatchRequest(BaseModel):
@@ -9,5 +9,27 @@ class BatchRequest(BaseModel):
     primaryColumns: List[str]
     excludedColumns: List[str]
     compareSessionName: str
-
-job_store = {}
\ No newline at end of file
+    # "hash" streams both tables once; "row" is the original per-row lookup engine
+    compareEngine: Literal["hash", "row"] = "hash"
+    # Also seed the session with keys that exist only in the target table
+    includeTargetKeys: bool = False
+    # Only report how many keys the session would hold; nothing is created
+    dryRun: bool = False
+    # Value normalisation applied before comparing; see app.diff.DiffOptions
+    numericTolerance: Optional[float] = None
+    normalizeNulls: bool = False
+    trimWhitespace: bool = False
+    # SQLAlchemy URLs to read sourceTable/targetTable from instead of the uploaded sheets
+    sourceUrl: Optional[str] = None
+    targetUrl: Optional[str] = None
+    # Smoke checks. sampleSize compares a stratified random sample of that many keys and reports
+    # the estimated mismatch rate with a `confidence` interval; failAfter / maxMismatchRate stop
+    # the job once that many keys failed / the mismatch rate so far is exceeded
+    sampleSize: Optional[int] = Field(None, ge=1)
+    sampleSeed: Optional[int] = None
+    confidence: float = Field(0.95, gt=0, lt=1)
+    failAfter: Optional[int] = Field(None, ge=1)
+    maxMismatchRate: Optional[float] = Field(None, ge=0, le=1)
+    # Pass keys whose source and target rows hash the same before comparing; see app.fingerprint.precheck.
+    # Hashing a key costs about as much as the hash engine's diff, so this pays off with the row engine.
+    precheck: bool = False
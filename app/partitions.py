@@ -0,0 +1,78 @@
+import sqlite3
+from typing import List, Dict
+
+from app.constants import Constants
+from app.database import db_connection, quote
+from app.sampling import sample_filter
+
+
+def create_partition_table(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {Constants.PARTITION_TABLE} (
+            batch_id TEXT,
+            partition INTEGER,
+            partitions INTEGER,
+            status TEXT,
+            processed INTEGER,
+            total INTEGER,
+            PRIMARY KEY (batch_id, partition)
+        )
+    """)
+
+
+def partition_filter(key_columns: List[str], partition):
+    # SQL predicate (and its parameters) selecting one hash partition of the key columns
+    if partition is None:
+        return "1 = 1", ()
+    index, partitions = partition
+    columns = ', '.join(quote(col) for col in key_columns)
+    return f"partition_of(?, {columns}) = ?", (partitions, index)
+
+
+def setup_partitions(db_name: str, batch_id: str, key_columns: List[str], partitions: int, sampled: bool = False):
+    # A sampled job's partitions only count its sample keys
+    sample, sample_params = sample_filter(batch_id if sampled else None)
+    with db_connection(db_name) as (conn, cursor):
+        create_partition_table(cursor)
+        cursor.execute(f"DELETE FROM {Constants.PARTITION_TABLE} WHERE batch_id=?", (batch_id,))
+        # Rows that already have a result (a resumed job) count as processed
+        counts = "COUNT(*), COUNT(CASE WHEN result IN ('Pass', 'Fail') THEN 1 END)"
+        if partitions == 1:
+            cursor.execute(f"SELECT 0, {counts} FROM {db_name} WHERE batch_id=? AND {sample}",
+                           (batch_id, *sample_params))
+        else:
+            columns = ', '.join(quote(col) for col in key_columns)
+            cursor.execute(f"""
+                SELECT partition_of(?, {columns}), {counts} FROM {db_name}
+                WHERE batch_id=? AND {sample} GROUP BY 1
+            """, (partitions, batch_id, *sample_params))
+        totals = {index: (0, 0) for index in range(partitions)}
+        totals.update({index: (total, processed) for index, total, processed in cursor.fetchall()})
+        cursor.executemany(f"""
+            INSERT INTO {Constants.PARTITION_TABLE} (batch_id, partition, partitions, status, processed, total)
+            VALUES (?, ?, ?, 'queued', ?, ?)
+        """, [(batch_id, index, partitions, processed, total) for index, (total, processed) in totals.items()])
+        conn.commit()
+
+
+def update_partition(db_name: str, batch_id: str, partition: int, status: str = None, processed: int = 0):
+    with db_connection(db_name) as (conn, cursor):
+        cursor.execute(f"""
+            UPDATE {Constants.PARTITION_TABLE}
+            SET status = COALESCE(?, status), processed = processed + ?
+            WHERE batch_id=? AND partition=?
+        """, (status, processed, batch_id, partition))
+        conn.commit()
+
+
+def get_partition_status(db_name: str, batch_id: str) -> List[Dict]:
+    with db_connection(db_name) as (conn, cursor):
+        try:
+            cursor.execute(f"""
+                SELECT partition, status, processed, total FROM {Constants.PARTITION_TABLE}
+                WHERE batch_id=? ORDER BY partition
+            """, (batch_id,))
+        except sqlite3.OperationalError:
+            return []
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import time
+
+from app.concurrency import run_db
+from app.constants import Constants
+from app.job_store import FINISHED_STATES
+
+# Job progress pushed to clients as server-sent events. Each watched job and session has one poller
+# reading its trigger-maintained counters every PROGRESS_INTERVAL seconds, however many clients
+# watch it.
+# Subscribers hold only the latest snapshot, so a slow client skips updates instead of queueing
+# them, and every subscriber costs one queue slot.
+
+
+class ProgressHub:
+
+    def __init__(self, read_progress, interval: float = Constants.PROGRESS_INTERVAL,
+                 keepalive: float = Constants.PROGRESS_KEEPALIVE):
+        # read_progress(job_id, db_name) -> {"ExecutionStatus", "Pass", "Fail", "Pending"}, blocking, plus
+        # "Remaining" when the job will not compare every pending key (sampled jobs)
+        self.read_progress = read_progress
+        self.interval = interval
+        self.keepalive = keepalive
+        self.__watches = {}
+
+    def subscribers(self) -> int:
+        return sum(len(watch["queues"]) for watch in list(self.__watches.values()))
+
+    async def events(self, job_id: str, db_name: str):
+        # Yields SSE messages until the job finishes or the client goes away
+        queue = asyncio.Queue(maxsize=1)
+        # Counters are read from the session's database, so a job id under another session is another watch
+        key = (job_id, db_name)
+        watch = self.__watches.get(key)
+        if watch is None:
+            watch = self.__watches[key] = {"queues": set(), "last": None}
+            watch["task"] = asyncio.create_task(self.__poll(job_id, db_name, watch))
+        watch["queues"].add(queue)
+        if watch["last"] is not None:
+            queue.put_nowait(watch["last"])
+        sent = None
+        try:
+            while True:
+                try:
+                    snapshot = await asyncio.wait_for(queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if snapshot is None:
+                    return
+                # Deltas are against what this client last received, so skipped updates still add up
+                snapshot = dict(snapshot, Delta={name: snapshot[name] - (sent or {}).get(name, 0)
+                                                 for name in ("Pass", "Fail", "Pending")})
+                sent = snapshot
+                yield f"event: progress\ndata: {json.dumps(snapshot)}\n\n"
+                if snapshot["ExecutionStatus"] in FINISHED_STATES:
+                    return
+        finally:
+            watch["queues"].discard(queue)
+            if not watch["queues"]:
+                watch["task"].cancel()
+                if self.__watches.get(key) is watch:
+                    del self.__watches[key]
+
+    async def __poll(self, job_id: str, db_name: str, watch: dict):
+        previous, rate = None, None
+        try:
+            while True:
+                progress = await run_db(self.read_progress, job_id, db_name)
+                now = time.monotonic()
+                if previous is not None:
+                    done = (progress["Pass"] + progress["Fail"]) - (previous[1]["Pass"] + previous[1]["Fail"])
+                    current = max(done, 0) / (now - previous[0])
+                    # Smoothed, so one slow flush does not swing the ETA
+                    rate = current if rate is None else 0.3 * current + 0.7 * rate
+                if previous is None or progress != previous[1]:
+                    remaining = progress.get("Remaining", progress["Pending"])
+                    finished = progress["ExecutionStatus"] in FINISHED_STATES
+                    snapshot = dict(jobId=job_id, **progress,
+                                    rowsPerSec=round(rate, 1) if rate is not None else None,
+                                    etaSeconds=round(remaining / rate, 1) if rate and not finished else None)
+                    self.__publish(watch, snapshot)
+                previous = (now, progress)
+                if progress["ExecutionStatus"] in FINISHED_STATES:
+                    return
+                await asyncio.sleep(self.interval)
+        except Exception as e:
+            print(f"Progress poller for job {job_id} failed: {e}")
+            if self.__watches.get((job_id, db_name)) is watch:
+                del self.__watches[(job_id, db_name)]
+            self.__publish(watch, None)
+
+    @staticmethod
+    def __publish(watch: dict, snapshot):
+        watch["last"] = snapshot
+        for queue in watch["queues"]:
+            # Keep only the newest snapshot for a client that has not read the previous one yet
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(snapshot)
@@ -0,0 +1,107 @@
+import math
+import zlib
+from statistics import NormalDist
+from typing import Optional
+
+import numpy as np
+
+from app.constants import Constants
+from app.database import db_connection
+
+# Sampled compare jobs check a stratified random subset of the session keys and report the
+# mismatch rate of the whole session as an estimate with a confidence interval. Strata are
+# contiguous ranges of session ids, i.e. of the key order the session was built in, so a block
+# of bad keys (one load, one ID range) is represented in proportion to its size.
+
+
+def create_sample_tables(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {Constants.SAMPLE_TABLE} (
+            batch_id TEXT,
+            run_id INTEGER,
+            stratum INTEGER,
+            PRIMARY KEY (batch_id, run_id)
+        )
+    """)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {Constants.STRATA_TABLE} (
+            batch_id TEXT,
+            stratum INTEGER,
+            keys INTEGER,
+            sampled INTEGER,
+            PRIMARY KEY (batch_id, stratum)
+        )
+    """)
+
+
+def sample_filter(batch_id: Optional[str]):
+    # SQL predicate on session rows selecting the job's sample; everything when batch_id is None
+    if batch_id is None:
+        return "1 = 1", ()
+    return f"id IN (SELECT run_id FROM {Constants.SAMPLE_TABLE} WHERE batch_id=?)", (batch_id,)
+
+
+def draw_sample(db_name: str, batch_id: str, size: int, seed: int = None,
+                strata: int = Constants.SAMPLE_STRATA) -> int:
+    # Proportional allocation, at least one key per stratum. Without a seed the job id seeds the
+    # draw, so a resumed or repeated run compares the same keys. Returns the sample size.
+    with db_connection(db_name) as (conn, cursor):
+        create_sample_tables(cursor)
+        cursor.execute(f"SELECT id FROM {db_name} WHERE batch_id=? ORDER BY id", (batch_id,))
+        ids = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+        rng = np.random.default_rng(seed if seed is not None else zlib.crc32(batch_id.encode()))
+        samples, sizes = [], []
+        for stratum, keys in enumerate(np.array_split(ids, max(min(strata, len(ids)), 1))):
+            count = min(len(keys), max(1, round(size * len(keys) / len(ids)))) if len(keys) else 0
+            chosen = rng.choice(keys, count, replace=False) if count else keys[:0]
+            samples.extend((batch_id, int(run_id), stratum) for run_id in chosen)
+            sizes.append((batch_id, stratum, len(keys), count))
+        cursor.execute(f"DELETE FROM {Constants.SAMPLE_TABLE} WHERE batch_id=?", (batch_id,))
+        cursor.execute(f"DELETE FROM {Constants.STRATA_TABLE} WHERE batch_id=?", (batch_id,))
+        cursor.executemany(f"INSERT INTO {Constants.SAMPLE_TABLE} (batch_id, run_id, stratum) VALUES (?, ?, ?)",
+                           samples)
+        cursor.executemany(f"INSERT INTO {Constants.STRATA_TABLE} (batch_id, stratum, keys, sampled) "
+                           f"VALUES (?, ?, ?, ?)", sizes)
+        conn.commit()
+    return len(samples)
+
+
+def sample_estimate(db_name: str, batch_id: str, confidence: float = 0.95) -> Optional[dict]:
+    # Stratified estimate of the session's mismatch rate from the sample keys compared so far.
+    # The interval is a Wilson score interval on the effective sample size, so it stays inside
+    # [0, 1] and is not empty when no sampled key failed.
+    with db_connection(db_name) as (conn, cursor):
+        create_sample_tables(cursor)
+        cursor.execute(f"""
+            SELECT st.keys, COUNT(CASE WHEN t.result = 'Fail' THEN 1 END),
+                   COUNT(CASE WHEN t.result IN ('Pass', 'Fail') THEN 1 END)
+            FROM {Constants.STRATA_TABLE} st
+            LEFT JOIN {Constants.SAMPLE_TABLE} s ON s.batch_id = st.batch_id AND s.stratum = st.stratum
+            LEFT JOIN {db_name} t ON t.id = s.run_id
+            WHERE st.batch_id=? GROUP BY st.stratum
+        """, (batch_id,))
+        strata = cursor.fetchall()
+    if not strata:
+        return None
+    keys = sum(size for size, _, _ in strata)
+    failed = sum(fails for _, fails, _ in strata)
+    compared = sum(done for _, _, done in strata)
+    estimate = {"keys": keys, "compared": compared, "failed": failed, "confidence": confidence,
+                "mismatchRate": None, "lower": None, "upper": None, "estimatedFailures": None}
+    # Strata without compared keys yet are left out and the others reweighted
+    covered = [(size, fails, done) for size, fails, done in strata if done]
+    if not covered:
+        return estimate
+    total = sum(size for size, _, _ in covered)
+    rate, variance = 0.0, 0.0
+    for size, fails, done in covered:
+        weight, p = size / total, fails / done
+        rate += weight * p
+        variance += weight ** 2 * p * (1 - p) / max(done - 1, 1) * (1 - done / size)
+    n = rate * (1 - rate) / variance if variance > 0 else compared
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    center = (rate + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * math.sqrt(rate * (1 - rate) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    estimate.update({"mismatchRate": round(rate, 6), "lower": round(max(center - half, 0.0), 6),
+                     "upper": round(min(center + half, 1.0), 6), "estimatedFailures": round(rate * keys)})
+    return estimate
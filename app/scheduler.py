@@ -0,0 +1,71 @@
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from app.constants import Constants
+from app.job_store import JobStore, FAILED
+
+
+class JobScheduler:
+    # Pulls queued jobs from the JobStore and runs at most MAX_CONCURRENT_JOBS of them at a time.
+    # Every API worker runs one; the store arbitrates so each job is claimed exactly once.
+
+    def __init__(self, run_job, max_jobs: int = Constants.MAX_CONCURRENT_JOBS,
+                 poll_seconds: float = Constants.SCHEDULER_POLL_SECONDS):
+        self.run_job = run_job
+        self.max_jobs = max_jobs
+        self.poll_seconds = poll_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.__running = {}
+        self.__wake = threading.Event()
+        self.__stop = threading.Event()
+        self.__pool = None
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is not None:
+            return
+        self.__stop.clear()
+        self.__pool = ThreadPoolExecutor(max_workers=self.max_jobs, thread_name_prefix="compare-job")
+        self.__thread = threading.Thread(target=self.__loop, name="job-scheduler", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            return
+        self.__stop.set()
+        self.__wake.set()
+        self.__thread.join()
+        self.__pool.shutdown(wait=False)
+        self.__thread = None
+
+    def wake(self):
+        self.__wake.set()
+
+    def __loop(self):
+        job_store = JobStore()
+        while not self.__stop.is_set():
+            try:
+                job_store.requeue_stale()
+                self.__running = {job_id: future for job_id, future in self.__running.items() if not future.done()}
+                job_store.heartbeat(list(self.__running), self.owner)
+                while len(self.__running) < self.max_jobs:
+                    job = job_store.claim_next(self.owner)
+                    if job is None:
+                        break
+                    self.__running[job["job_id"]] = self.__pool.submit(self.__run, job_store, job)
+            except Exception as e:
+                print(f"Job scheduler error: {e}")
+            self.__wake.wait(self.poll_seconds)
+            self.__wake.clear()
+
+    def __run(self, job_store: JobStore, job: dict):
+        try:
+            state, error = self.run_job(job["job_id"], job["partitions"], job["mode"]), None
+        except Exception as e:
+            print(f"Job {job['job_id']} failed: {e}")
+            state, error = FAILED, str(e)
+        job_store.finish(job["job_id"], state, self.owner, error)
+        self.__wake.set()
@@ -0,0 +1,216 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from app.constants import Constants
+from app.database import db_connection
+
+# Sheets can be stored as Arrow IPC files instead of SQLite tables (SHEET_STORAGE=arrow).
+# Every row chunk of an upload is written as a part file of its own as soon as it is parsed, so
+# uploads append parts instead of rewriting the sheet, and reads memory-map the parts they need.
+# The database keeps a catalog of the sheets and their parts. pyarrow is only needed when
+# snapshots are used.
+ARROW = "arrow"
+
+
+def create_catalog(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {Constants.SNAPSHOT_TABLE} (
+            sheet TEXT PRIMARY KEY,
+            path TEXT,
+            columns TEXT,
+            rows INTEGER,
+            created_at REAL
+        )
+    """)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {Constants.SNAPSHOT_PART_TABLE} (
+            id INTEGER PRIMARY KEY,
+            sheet TEXT,
+            path TEXT,
+            rows INTEGER
+        )
+    """)
+
+
+def snapshot_path(db_name: str, sheet_name: str) -> str:
+    # The directory holding the sheet's parts
+    return os.path.join(Constants.SNAPSHOT_DIR, db_name, sheet_name)
+
+
+def column_chunk(values: list):
+    # Typed from the sheet values; a chunk mixing types that Arrow cannot hold in one column is kept as text
+    import pyarrow as pa
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if value is None else str(value) for value in values], pa.string())
+
+
+def _common_type(types):
+    # One type per column: the chunks' common type, float for mixed numbers, otherwise text
+    import pyarrow as pa
+    types = {kind for kind in types if not pa.types.is_null(kind)}
+    if not types:
+        return pa.null()
+    if len(types) == 1:
+        return types.pop()
+    if all(pa.types.is_integer(kind) or pa.types.is_floating(kind) for kind in types):
+        return pa.float64()
+    return pa.string()
+
+
+def _unify(chunks: list, kind):
+    import pyarrow as pa
+    if pa.types.is_string(kind):
+        return pa.chunked_array([text_array(chunk) for chunk in chunks], kind)
+    return pa.chunked_array([chunk.cast(kind) for chunk in chunks], kind)
+
+
+def float_text(value: float) -> str:
+    # How every storage renders a float: whole numbers like the int openpyxl reads for them, others
+    # as the shortest repr. SQLite ingestion stores floats this way too; left to SQLite itself, a
+    # float in a TEXT column keeps only 15 digits ('0.3' for 0.1 + 0.2, '1.0e+20' for 1e20).
+    if value.is_integer() and abs(value) < 2 ** 53:
+        return str(int(value))
+    return str(value)
+
+
+def text_array(column):
+    # Renders values as the SQLite ingestion stores them (str() of the value) and keeps nulls
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    kind = column.type
+    if pa.types.is_string(kind) or pa.types.is_large_string(kind):
+        return column
+    if pa.types.is_floating(kind):
+        # float_text, vectorised: numpy prints floats like str() does. Whole numbers are printed without
+        # ".0": openpyxl reads them as int, and a column only turns float when they are mixed with decimals.
+        values = column.to_numpy(zero_copy_only=False)
+        text = values.astype(str).astype(object)
+        whole = np.isfinite(values) & (np.abs(values) < 2 ** 53) & (values == np.round(values))
+        text[whole] = values[whole].astype(np.int64).astype(str)
+        return pa.array(text, pa.string(), mask=np.isnan(values))
+    if pa.types.is_boolean(kind):
+        column = column.cast(pa.int8())
+    if pa.types.is_timestamp(kind):
+        return pc.strftime(column.cast(pa.timestamp("s"), safe=False), format="%Y-%m-%d %H:%M:%S")
+    return column.cast(pa.string())
+
+
+def write_snapshot_part(db_name: str, sheet_name: str, columns: List[str], arrays: list) -> str:
+    # arrays: the per-column arrays of one row chunk (see column_chunk). Parts are only read once
+    # add_snapshot_part registered them, so nobody sees one half written.
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    table = pa.table(arrays, names=columns)
+    path = os.path.join(snapshot_path(db_name, sheet_name), f"{uuid.uuid4().hex}.arrow")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with pa.OSFile(path, "wb") as sink, ipc.new_file(sink, table.schema) as out:
+        out.write_table(table)
+    return path
+
+
+def add_snapshot_part(cursor, conn, db_name: str, sheet_name: str, columns: List[str], path: str, rows: int):
+    # Runs on the database's writer, so parts of concurrent uploads of a sheet are appended one at a
+    # time, the way SQLite storage appends rows to the sheet's table
+    create_catalog(cursor)
+    cursor.execute(f"SELECT columns FROM {Constants.SNAPSHOT_TABLE} WHERE sheet=?", (sheet_name,))
+    row = cursor.fetchone()
+    if row is not None and json.loads(row[0]) != columns:
+        os.remove(path)
+        raise ValueError(f"Sheet {sheet_name} has columns {json.loads(row[0])}, the upload has {columns}")
+    if row is None:
+        cursor.execute(f"INSERT INTO {Constants.SNAPSHOT_TABLE} VALUES (?, ?, ?, 0, ?)",
+                       (sheet_name, snapshot_path(db_name, sheet_name), json.dumps(columns), time.time()))
+    cursor.execute(f"INSERT INTO {Constants.SNAPSHOT_PART_TABLE} (sheet, path, rows) VALUES (?, ?, ?)",
+                   (sheet_name, path, rows))
+    cursor.execute(f"UPDATE {Constants.SNAPSHOT_TABLE} SET rows = rows + ? WHERE sheet=?", (rows, sheet_name))
+    conn.commit()
+
+
+def unregister_snapshot(cursor, conn, sheet_name: str):
+    # A sheet loaded into SQLite again is read from its table, not from an older snapshot
+    create_catalog(cursor)
+    cursor.execute(f"SELECT path FROM {Constants.SNAPSHOT_PART_TABLE} WHERE sheet=?", (sheet_name,))
+    paths = [row[0] for row in cursor.fetchall()]
+    cursor.execute(f"DELETE FROM {Constants.SNAPSHOT_TABLE} WHERE sheet=?", (sheet_name,))
+    cursor.execute(f"DELETE FROM {Constants.SNAPSHOT_PART_TABLE} WHERE sheet=?", (sheet_name,))
+    conn.commit()
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_snapshot(db_name: str, sheet_name: str) -> Optional[dict]:
+    with db_connection(db_name) as (conn, cursor):
+        try:
+            cursor.execute(f"SELECT path, columns, rows FROM {Constants.SNAPSHOT_TABLE} WHERE sheet=?", (sheet_name,))
+        except sqlite3.OperationalError:
+            # No snapshot was ever written to this database
+            return None
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        try:
+            cursor.execute(f"SELECT path, rows FROM {Constants.SNAPSHOT_PART_TABLE} WHERE sheet=? ORDER BY id",
+                           (sheet_name,))
+            parts = cursor.fetchall()
+        except sqlite3.OperationalError:
+            parts = []
+    path, columns, rows = row
+    if os.path.isfile(path):
+        # A snapshot written as one file before sheets were split into parts
+        parts = [(path, rows - sum(part_rows for _, part_rows in parts))] + parts
+    return {"path": path, "columns": json.loads(columns), "rows": rows, "parts": parts}
+
+
+def list_snapshots(db_name: str) -> List[str]:
+    with db_connection(db_name) as (conn, cursor):
+        try:
+            cursor.execute(f"SELECT sheet FROM {Constants.SNAPSHOT_TABLE}")
+        except sqlite3.OperationalError:
+            return []
+        return [row[0] for row in cursor.fetchall()]
+
+
+def read_snapshot(snapshot: dict, columns: List[str] = None, offset: int = 0, length: int = None):
+    # Memory-mapped, so only the selected columns and rows are paged in and nothing is parsed. Parts
+    # outside the rows asked for are not read, but every part's schema decides the column types, so
+    # a page has the same types as the whole sheet.
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    columns = columns if columns is not None else snapshot["columns"]
+    end = None if length is None else offset + length
+    schemas, tables, first = [], [], 0
+    for path, rows in snapshot["parts"]:
+        with pa.memory_map(path) as source:
+            reader = ipc.open_file(source)
+            schemas.append(reader.schema)
+            if first + rows > offset and (end is None or first < end):
+                start = max(offset - first, 0)
+                stop = rows if end is None else min(end - first, rows)
+                tables.append(reader.read_all().select(columns).slice(start, stop - start))
+        first += rows
+    return pa.table([_unify([chunk for table in tables for chunk in table.column(name).chunks],
+                            _common_type(schema.field(name).type for schema in schemas)) for name in columns],
+                    names=columns)
+
+
+def snapshot_frame(snapshot: dict, columns: List[str] = None, as_text: bool = True, offset: int = 0,
+                   length: int = None) -> pd.DataFrame:
+    # as_text gives the same values a SQLite-stored sheet would ('Null' for blanks), so compare
+    # results do not depend on how each side was stored. Otherwise values keep their types and nulls.
+    table = read_snapshot(snapshot, columns, offset, length)
+    if not as_text:
+        return table.to_pandas()
+    return pd.DataFrame({name: text_array(table.column(name)).fill_null('Null').to_pandas()
+                         for name in table.column_names}, columns=table.column_names)
@@ -0,0 +1,74 @@
+# Micro-benchmark: the old per-row DeepDiff comparison against app.diff.
+#
+#   python -m benchmarks.bench_diff --rows 20000 --columns 10 --mismatch-rate 0.05
+#
+# DeepDiff is only needed here: pip install -r benchmarks/requirements.txt, or pass --skip-deepdiff.
+import argparse
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+from app.diff import DiffOptions, diff_aligned
+
+
+def make_rows(rows: int, columns: int, mismatch_rate: float, seed: int):
+    rng = random.Random(seed)
+    names = [f"col_{i}" for i in range(columns)]
+    source = np.array([[f"v{r}_{c}" for c in range(columns)] for r in range(rows)], dtype=object)
+    target = source.copy()
+    for r in range(rows):
+        if rng.random() < mismatch_rate:
+            target[r, rng.randrange(columns)] = "changed"
+    return names, source, target
+
+
+def deepdiff_path(names, source, target):
+    # What process_items used to do for every key: one-row DataFrames -> records -> DeepDiff
+    from deepdiff import DeepDiff
+    differences = 0
+    for r in range(len(source)):
+        s_data = pd.DataFrame([source[r]], columns=names).to_dict(orient="records")
+        t_data = pd.DataFrame([target[r]], columns=names).to_dict(orient="records")
+        differences += len(DeepDiff(s_data, t_data, ignore_order=True).get("values_changed", {}))
+    return differences
+
+
+def vectorized_path(names, source, target, options: DiffOptions):
+    run_ids = np.arange(len(source))
+    return len(diff_aligned(run_ids, np.zeros(len(source), dtype=int), source, target, names, options))
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--mismatch-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--skip-deepdiff", action="store_true")
+    args = parser.parse_args()
+
+    names, source, target = make_rows(args.rows, args.columns, args.mismatch_rate, args.seed)
+    runs = [("vectorized", vectorized_path, (names, source, target, DiffOptions())),
+            ("vectorized+normalize", vectorized_path,
+             (names, source, target, DiffOptions(numeric_tolerance=0.0, normalize_nulls=True, trim_whitespace=True)))]
+    if not args.skip_deepdiff:
+        runs.insert(0, ("deepdiff", deepdiff_path, (names, source, target)))
+
+    baseline = None
+    for name, fn, fn_args in runs:
+        found, seconds = timed(fn, *fn_args)
+        baseline = baseline or seconds
+        print(f"{name:<22} {found:>8} differences  {seconds:8.3f}s  {args.rows / seconds:>12,.0f} rows/s"
+              f"  x{baseline / seconds:,.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+# End-to-end benchmark: generated workbooks go through the real routes (upload, setup, compare,
+# status, data pages, export) in-process, and each step's time, throughput and peak memory is
+# written to a JSON results file. Compare two result files with benchmarks.compare.
+#
+#   python -m benchmarks.bench_suite --rows 100000 --columns 10 --mismatch-rate 0.01 \
+#       --engine hash --partitions 4 --storage sqlite
+#
+# The pre-check pays off where comparing a key costs more than hashing it, e.g. with the row engine:
+#   --rows 20000 --engine row --mismatch-rate 0.01 --missing-rate 0, with and without --precheck
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import psutil
+
+from benchmarks.generate import KEY, SHEET, add_arguments, generate
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SESSION = "bench"
+RUNNING = ("created", "queued", "in_progress", "cancelling")
+
+
+class PeakMemory:
+    # Largest RSS of this process plus its children (process pool workers) seen while sampling
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0
+        self.__process = psutil.Process()
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__sample, name="peak-memory", daemon=True)
+
+    def __enter__(self):
+        self.__measure()
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.__stop.set()
+        self.__thread.join()
+        self.__measure()
+
+    def __measure(self):
+        rss = self.__process.memory_info().rss
+        for child in self.__process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak = max(self.peak, rss)
+
+    def __sample(self):
+        while not self.__stop.wait(self.interval):
+            self.__measure()
+
+
+class Steps:
+
+    def __init__(self):
+        self.results = {}
+
+    @contextmanager
+    def step(self, name: str, rows: int = 0):
+        # Yields a dict the step can add fields to (e.g. latency percentiles)
+        extra = {}
+        start = time.perf_counter()
+        with PeakMemory() as memory:
+            yield extra
+        seconds = time.perf_counter() - start
+        self.results[name] = {"seconds": round(seconds, 4), "rows": rows,
+                              "rowsPerSec": round(rows / seconds, 1) if rows and seconds else None,
+                              "peakRssMb": round(memory.peak / 2 ** 20, 1), **extra}
+        print(f"{name:<16} {seconds:>9.3f}s {self.results[name]['rowsPerSec'] or '':>12} rows/s "
+              f"{self.results[name]['peakRssMb']:>9.1f} MB")
+
+
+def percentiles(latencies: list) -> dict:
+    values = np.array(latencies) * 1000
+    return {"p50Ms": round(float(np.percentile(values, 50)), 3), "p95Ms": round(float(np.percentile(values, 95)), 3),
+            "p99Ms": round(float(np.percentile(values, 99)), 3), "requests": len(latencies)}
+
+
+def wait_for(poll, done, timeout: float, interval: float = 0.05):
+    deadline = time.time() + timeout
+    while True:
+        result = poll()
+        if done(result):
+            return result
+        if time.time() > deadline:
+            raise TimeoutError(f"Gave up waiting after {timeout}s: {result}")
+        time.sleep(interval)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run(args) -> dict:
+    paths = generate(os.path.join(args.workdir, "input"), args.rows, args.columns, args.key_cardinality,
+                     args.mismatch_rate, args.missing_rate, args.seed)
+    # The app reads its settings when imported and keeps its databases in the working directory
+    os.environ["SHEET_STORAGE"] = args.storage
+    os.environ["COMPARE_EXECUTOR"] = args.executor
+    os.environ["SCHEDULER_POLL_SECONDS"] = "0.1"
+    os.chdir(args.workdir)
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    steps = Steps()
+    with TestClient(app) as client:
+        with steps.step("upload", 2 * args.rows):
+            for db_source in ("source", "target"):
+                with open(paths[db_source], "rb") as f:
+                    response = client.post("/batch/upload", data={"db_source": db_source},
+                                           files={"file": (f"{db_source}.xlsx", f)})
+                response.raise_for_status()
+            wait_for(lambda: client.get("/batch/upload-status").json()["status"], lambda status: not status["yet"],
+                     args.timeout)
+
+        with steps.step("setup", args.rows):
+            setup = client.post("/batch/compare", json={
+                "compareSessionName": SESSION, "sourceTable": SHEET, "targetTable": SHEET,
+                "primaryColumns": [KEY], "excludedColumns": [], "compareEngine": args.engine,
+                "precheck": args.precheck}).json()
+        job_id = setup["jobId"]
+
+        status_params = {"jobId": job_id, "sessionName": SESSION}
+        with steps.step("compare", args.rows) as extra:
+            client.get("/batch/compare", params={"jobId": job_id, "partitions": args.partitions}).raise_for_status()
+            status = wait_for(lambda: client.get("/batch/status", params=status_params).json(),
+                              lambda status: status["ExecutionStatus"] not in RUNNING, args.timeout)
+            extra.update({"state": status["ExecutionStatus"], "pass": status["Pass"], "fail": status["Fail"],
+                          "phases": status["Timings"]})
+
+        latencies = []
+        with steps.step("status", 0) as extra:
+            for _ in range(args.polls):
+                start = time.perf_counter()
+                client.get("/batch/status", params=status_params).raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            extra.update(percentiles(latencies))
+
+        latencies, after = [], None
+        with steps.step("data_pages", args.rows) as extra:
+            while True:
+                start = time.perf_counter()
+                params = {"sheetName": SHEET, "dbSource": "source", "limit": args.page_size}
+                if after is not None:
+                    params["after"] = after
+                page = client.get("/batch/data", params=params).json()
+                latencies.append(time.perf_counter() - start)
+                after = page["nextCursor"]
+                if after is None:
+                    break
+            extra.update(percentiles(latencies))
+
+        for file_format in ("csv", "xlsx"):
+            with steps.step(f"export_{file_format}", args.rows) as extra:
+                response = client.get("/batch/download", params={"sessionName": SESSION, "jobId": job_id,
+                                                                  "format": file_format})
+                response.raise_for_status()
+                extra["bytes"] = len(response.content)
+
+    return {
+        "meta": {"commit": git_commit(), "python": sys.version.split()[0], "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                 "params": {name: value for name, value in vars(args).items() if name not in ("output", "workdir")}},
+        "results": steps.results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument("--engine", choices=["hash", "row"], default="hash")
+    parser.add_argument("--partitions", type=int, default=1)
+    parser.add_argument("--storage", choices=["sqlite", "arrow"], default="sqlite")
+    parser.add_argument("--executor", choices=["process", "dask"], default="process")
+    parser.add_argument("--precheck", action="store_true", help="pass keys whose rows hash the same before comparing")
+    parser.add_argument("--polls", type=int, default=200, help="status requests timed for the latency percentiles")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--timeout", type=float, default=3600)
+    parser.add_argument("--workdir", help="where the generated files and databases go (default: a temporary directory)")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<timestamp>.json)")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output or os.path.join(REPO, "benchmarks", "results",
+                                                         time.strftime("%Y%m%d-%H%M%S") + ".json"))
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        args.workdir = os.path.abspath(args.workdir)
+        results = run(args)
+    else:
+        with tempfile.TemporaryDirectory(prefix="ptf-bench-") as workdir:
+            args.workdir = workdir
+            results = run(args)
+            os.chdir(REPO)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# Compares two bench_suite result files step by step and exits with 1 when a step got slower
+# (or used more memory) than the threshold allows.
+#
+#   python -m benchmarks.compare benchmarks/results/baseline.json benchmarks/results/latest.json --threshold 0.1
+import argparse
+import json
+import sys
+
+# Lower is better for all of these
+METRICS = ["seconds", "p95Ms", "peakRssMb"]
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    # Returns (step, metric, baseline, current, change, regressed) for the metrics both runs have
+    rows = []
+    for step, before in baseline["results"].items():
+        after = current["results"].get(step)
+        if after is None:
+            continue
+        for metric in METRICS:
+            if before.get(metric) is None or after.get(metric) is None:
+                continue
+            change = (after[metric] - before[metric]) / before[metric] if before[metric] else 0.0
+            rows.append((step, metric, before[metric], after[metric], change, change > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed relative increase, 0.1 = 10%%")
+    args = parser.parse_args()
+
+    baseline, current = load(args.baseline), load(args.current)
+    if baseline["meta"]["params"] != current["meta"]["params"]:
+        print(f"Warning: runs used different parameters\n  {baseline['meta']['params']}\n  {current['meta']['params']}")
+    rows = compare(baseline, current, args.threshold)
+    print(f"{'step':<16} {'metric':<10} {'baseline':>12} {'current':>12} {'change':>9}")
+    for step, metric, before, after, change, regressed in rows:
+        print(f"{step:<16} {metric:<10} {before:>12} {after:>12} {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+    sys.exit(1 if any(row[-1] for row in rows) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# Synthetic source/target data for the benchmarks, as workbooks or as ready-made SQLite databases.
+#
+#   python -m benchmarks.generate --out /tmp/bench --rows 100000 --columns 10 --key-cardinality 1.0 \
+#       --mismatch-rate 0.01 --missing-rate 0.001 --format xlsx
+import argparse
+import os
+import random
+import sqlite3
+
+from openpyxl import Workbook
+
+from app.database import quote
+
+SHEET = "Data"
+KEY = "KEY"
+
+
+def column_names(columns: int):
+    return [KEY] + [f"COL_{index}" for index in range(1, columns)]
+
+
+def iter_rows(rows: int, columns: int, key_cardinality: float, seed: int):
+    # key_cardinality is distinct keys / rows: 1.0 gives unique keys, 0.5 two rows per key on average.
+    # Values mix text, integers and decimals the way spreadsheets usually do.
+    rng = random.Random(seed)
+    keys = max(1, int(rows * key_cardinality))
+    for row in range(rows):
+        key = f"K{row if row < keys else rng.randrange(keys):09d}"
+        values = [key]
+        for column in range(1, columns):
+            kind = column % 3
+            if kind == 0:
+                values.append(f"text-{rng.randrange(1000)}")
+            elif kind == 1:
+                values.append(rng.randrange(1_000_000))
+            else:
+                values.append(round(rng.random() * 10_000, 2))
+        yield values
+
+
+def mutate(rows, mismatch_rate: float, missing_rate: float, seed: int):
+    # Target side: drops missing_rate of the rows and changes one cell in mismatch_rate of the rest
+    rng = random.Random(seed + 1)
+    for values in rows:
+        if rng.random() < missing_rate:
+            continue
+        if len(values) > 1 and rng.random() < mismatch_rate:
+            values = list(values)
+            column = rng.randrange(1, len(values))
+            values[column] = f"changed-{values[column]}"
+        yield values
+
+
+def write_workbook(path: str, names, rows):
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(SHEET)
+    sheet.append(names)
+    for values in rows:
+        sheet.append(values)
+    workbook.save(path)
+
+
+def write_database(path: str, names, rows):
+    # Same layout as the SQLite ingestion: one TEXT table per sheet
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute(f"CREATE TABLE {SHEET} ({', '.join(f'{quote(name)} TEXT' for name in names)})")
+    conn.executemany(f"INSERT INTO {SHEET} VALUES ({', '.join(['?'] * len(names))})", rows)
+    conn.commit()
+    conn.close()
+
+
+def generate(out: str, rows: int, columns: int, key_cardinality: float = 1.0, mismatch_rate: float = 0.01,
+             missing_rate: float = 0.0, seed: int = 7, file_format: str = "xlsx") -> dict:
+    # Returns the paths of the source and target files
+    os.makedirs(out, exist_ok=True)
+    names = column_names(columns)
+    write = write_workbook if file_format == "xlsx" else write_database
+    extension = "xlsx" if file_format == "xlsx" else "db"
+    paths = {"source": os.path.join(out, f"source.{extension}"), "target": os.path.join(out, f"target.{extension}")}
+    write(paths["source"], names, iter_rows(rows, columns, key_cardinality, seed))
+    write(paths["target"], names, mutate(iter_rows(rows, columns, key_cardinality, seed), mismatch_rate,
+                                         missing_rate, seed))
+    return paths
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--key-cardinality", type=float, default=1.0)
+    parser.add_argument("--mismatch-rate", type=float, default=0.01)
+    parser.add_argument("--missing-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=7)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--format", choices=["xlsx", "db"], default="xlsx")
+    add_arguments(parser)
+    args = parser.parse_args()
+    paths = generate(args.out, args.rows, args.columns, args.key_cardinality, args.mismatch_rate,
+                     args.missing_rate, args.seed, args.format)
+    print(paths)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
+import multiprocessing
+
 import uvicorn
 from app.main import app  # Import FastAPI app from app/main.py
 
 if __name__ == "__main__":
+    # Compare partitions run in spawned worker processes, which needs this in a frozen build
+    multiprocessing.freeze_support()
     uvicorn.run(app, host="127.0.0.1", port=8000)
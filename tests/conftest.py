@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import time
+
+import pytest
+from openpyxl import Workbook
+
+# The app reads its settings at import time and keeps every database in the working directory
+os.environ.setdefault("SCHEDULER_POLL_SECONDS", "0.05")
+os.environ.setdefault("COMPARE_WORKERS", "2")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def workdir(tmp_path_factory):
+    # One directory for the whole run: pooled connections stay open on the files they were opened on
+    path = tmp_path_factory.mktemp("work")
+    cwd = os.getcwd()
+    os.chdir(path)
+    yield path
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope="session")
+def client(workdir):
+    from fastapi.testclient import TestClient
+    from app.main import app
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def write_workbook(path: str, sheet: str, names, rows) -> str:
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(sheet)
+    worksheet.append(names)
+    for values in rows:
+        worksheet.append(values)
+    workbook.save(path)
+    return path
+
+
+def upload_sheet(db_name: str, sheet: str, names, rows, storage: str = "sqlite"):
+    # Ingests rows the way /batch/upload does, as a workbook with one sheet
+    from app.excel_to_db import files_to_db
+    path = write_workbook(f"{db_name}-{sheet}-{storage}.xlsx", sheet, names, rows)
+    done = {}
+    files_to_db([(path, path)], db_name, done.__setitem__, storage=storage)
+    assert done == {path: "pass"}
+
+
+def write_table(path: str, table: str, columns, rows):
+    # An external database: a typed SQLite table, columns given as (name, type) pairs
+    conn = sqlite3.connect(path)
+    conn.execute(f"DROP TABLE IF EXISTS {table}")
+    conn.execute(f"CREATE TABLE {table} ({', '.join(f'{name} {kind}' for name, kind in columns)})")
+    conn.executemany(f"INSERT INTO {table} VALUES ({', '.join(['?'] * len(columns))})", rows)
+    conn.commit()
+    conn.close()
+    return f"sqlite:///{os.path.abspath(path)}"
+
+
+def run_compare(client, session: str, source_table: str, target_table: str, key_columns, partitions: int = 1,
+                timeout: float = 60, **options) -> dict:
+    # Sets up and runs one compare job, returning its final /batch/status
+    body = dict(compareSessionName=session, sourceTable=source_table, targetTable=target_table,
+                primaryColumns=key_columns, excludedColumns=[], **options)
+    response = client.post("/batch/compare", json=body)
+    assert response.status_code == 200, response.text
+    job_id = response.json()["jobId"]
+    client.get("/batch/compare", params={"jobId": job_id, "partitions": partitions})
+    deadline = time.time() + timeout
+    while True:
+        status = client.get("/batch/status", params={"jobId": job_id, "sessionName": session}).json()
+        if status["ExecutionStatus"] not in ("created", "queued", "in_progress"):
+            return status
+        assert time.time() < deadline, status
+        time.sleep(0.05)
+
+
+def differences(session: str) -> int:
+    conn = sqlite3.connect(f"{session}.db")
+    try:
+        return conn.execute("SELECT COUNT(*) FROM differences").fetchone()[0]
+    finally:
+        conn.close()
@@ -0,0 +1,83 @@
+import random
+
+import pytest
+
+from conftest import upload_sheet, write_table, run_compare
+
+NAMES = ["KEY", "NUM", "AMOUNT", "NAME"]
+TYPES = [("KEY", "TEXT"), ("NUM", "INTEGER"), ("AMOUNT", "REAL"), ("NAME", "TEXT")]
+
+
+def rows_with_duplicates():
+    # 80 keys holding 2-3 rows each, stored in descending value order
+    return [[f"K{index % 80:03d}", 1000 - index, 1000.25 - index, f"name-{index % 7}"] for index in range(200)]
+
+
+def target_rows(rows):
+    rows = [list(row) for row in rows]
+    rows[5][3] = "changed"
+    rows[90][1] = -1
+    del rows[150]
+    return rows
+
+
+@pytest.fixture(scope="module")
+def tables(workdir):
+    source = rows_with_duplicates()
+    target = target_rows(source)
+    upload_sheet("source", "Dup19", NAMES, source)
+    upload_sheet("target", "Dup19", NAMES, target)
+    # The external copies hold typed values in another storage order
+    shuffled_source, shuffled_target = source[::-1], random.Random(3).sample(target, len(target))
+    return {"source": write_table("ext-source19.db", "dup19", TYPES, shuffled_source),
+            "target": write_table("ext-target19.db", "dup19", TYPES, shuffled_target),
+            "rows": shuffled_target}
+
+
+@pytest.mark.parametrize("engine", ["hash", "row"])
+@pytest.mark.parametrize("external", ["none", "source", "target", "both"])
+def test_external_and_uploaded_sides_agree(client, tables, engine, external):
+    options = {}
+    if external in ("source", "both"):
+        options["sourceUrl"] = tables["source"]
+    if external in ("target", "both"):
+        options["targetUrl"] = tables["target"]
+    status = run_compare(client, f"ext19_{engine}_{external}", "Dup19" if "sourceUrl" not in options else "dup19",
+                         "Dup19" if "targetUrl" not in options else "dup19", ["KEY"], compareEngine=engine,
+                         precheck=False, **options)
+    # Keys 005, 010 (row 90) and 070 (row 150) differ whichever way duplicate rows are paired
+    assert (status["ExecutionStatus"], status["Pass"], status["Fail"], status["Pending"]) == ("completed", 77, 3, 0)
+
+
+def test_duckdb_table(client, tables):
+    duckdb = pytest.importorskip("duckdb")
+    pytest.importorskip("duckdb_engine")
+    path = "ext-target19.duckdb"
+    conn = duckdb.connect(path)
+    conn.execute("DROP TABLE IF EXISTS dup19")
+    conn.execute("CREATE TABLE dup19 (KEY VARCHAR, NUM INTEGER, AMOUNT DOUBLE, NAME VARCHAR)")
+    conn.executemany("INSERT INTO dup19 VALUES (?, ?, ?, ?)", tables["rows"])
+    conn.close()
+    status = run_compare(client, "ext19_duckdb", "Dup19", "dup19", ["KEY"], targetUrl=f"duckdb:///{path}")
+    assert (status["ExecutionStatus"], status["Pass"], status["Fail"]) == ("completed", 77, 3)
+
+
+def test_key_groups_ignore_a_case_insensitive_collation(workdir):
+    from app.connectors import open_connector
+    # Rows of "k1" and "K1" interleave in NOCASE order; chunks of 3 rows split them across batches
+    rows = [(key, index) for index in range(6) for key in ("k1", "K1")] + [("k2", 9)]
+    url = write_table("ext-nocase19.db", "nocase19", [("KEY", "TEXT COLLATE NOCASE"), ("NUM", "INTEGER")], rows)
+    with open_connector("source", "nocase19", url) as connector:
+        groups = [keys.unique().tolist() for _, keys in connector.iter_key_groups(["KEY", "NUM"], ["KEY"],
+                                                                               chunk_size=3)]
+    keys = [key for group in groups for key in group]
+    assert sorted(keys) == ["K1", "k1", "k2"]
+
+
+def test_external_jobs_run_as_one_partition(client, tables):
+    from app.job_store import JobStore
+    status = run_compare(client, "ext19_parts", "dup19", "Dup19", ["KEY"], partitions=4, precheck=False,
+                         sourceUrl=tables["source"])
+    assert (status["ExecutionStatus"], status["Pass"], status["Fail"]) == ("completed", 77, 3)
+    job = JobStore().get(status["jobId"])
+    assert job["partitions"] == 1
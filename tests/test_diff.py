@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from app.diff import DiffOptions, MISSING_ROW, changed_cells, diff_record_groups
+
+
+def cells(source, target, options=DiffOptions()):
+    return changed_cells(np.array(source, dtype=object).reshape(len(source), -1),
+                         np.array(target, dtype=object).reshape(len(target), -1), options).ravel().tolist()
+
+
+def test_exact_compare():
+    assert DiffOptions().is_exact
+    assert cells(["1", "a", None, " a"], ["1", "b", None, "a"]) == [False, True, False, True]
+    # Values are compared as stored
+    assert cells(["1"], ["1.0"]) == [True]
+
+
+@pytest.mark.parametrize("source, target, changed", [
+    ("1.000", "1.005", False),
+    ("1", "1.02", True),
+    ("-2.5", "-2.509", False),
+    ("abc", "abd", True),
+    ("1", "one", True),
+])
+def test_numeric_tolerance(source, target, changed):
+    assert cells([source], [target], DiffOptions(numeric_tolerance=0.01)) == [changed]
+
+
+@pytest.mark.parametrize("source, target, changed", [
+    ("Null", None, False),
+    ("NaN", "", False),
+    ("null", "None", False),
+    ("Null", "x", True),
+    (None, "0", True),
+])
+def test_null_tokens(source, target, changed):
+    assert cells([source], [target], DiffOptions(normalize_nulls=True)) == [changed]
+    assert cells([source], [target]) == [source != target]
+
+
+def test_whitespace():
+    options = DiffOptions(trim_whitespace=True)
+    assert cells([" a ", "a b", "1"], ["a", "a  b", 1], options) == [False, True, True]
+
+
+def test_options_combine():
+    options = DiffOptions(numeric_tolerance=0.5, normalize_nulls=True, trim_whitespace=True)
+    assert cells([" 1.2 ", " Null", "x"], ["1.5", None, " y"], options) == [False, False, True]
+
+
+def test_record_groups_pair_duplicates_in_order():
+    columns = ["A", "B"]
+    source = [("1", "x"), ("2", "y"), ("3", "z")]
+    target = [("1", "x"), ("2", "changed")]
+    differences = diff_record_groups(7, source, target, columns)
+    assert [(d.run_id, d.row_index, d.column_name, d.old_value, d.new_value) for d in differences] == [
+        (7, 1, "B", "y", "changed"),
+        (7, 2, MISSING_ROW, "present", "missing"),
+    ]
+    extra = diff_record_groups(8, source[:1], source, columns)
+    assert [(d.row_index, d.old_value) for d in extra] == [(1, "missing"), (2, "missing")]
+    assert diff_record_groups(9, source, list(source), columns) == []
@@ -0,0 +1,87 @@
+import random
+import sqlite3
+
+import pytest
+
+from conftest import upload_sheet, run_compare
+
+NAMES = ["KEY", "REGION", "VALUE", "NOTE"]
+
+
+def build_tables():
+    # Two-column keys with 1-3 rows each; the target changes, drops, reorders and adds rows
+    rng = random.Random(11)
+    source = [[f"K{rng.randrange(150):03d}", rng.choice(["north", "south"]), rng.randrange(1000), f"n{index % 5}"]
+              for index in range(400)]
+    target = [list(row) for row in source]
+    for index in rng.sample(range(len(target)), 20):
+        target[index][2] = -target[index][2] - 1
+    for index in sorted(rng.sample(range(len(target)), 10), reverse=True):
+        del target[index]
+    target[3], target[4] = target[4], target[3]
+    target += [["K999", "north", 1, "only in target"], [source[0][0], source[0][1], 5, "extra duplicate"]]
+    return source, target
+
+
+def expected_results(source, target, include_target_keys: bool):
+    # Rows of a key pair up in storage order, so a key passes when its row lists are equal
+    def groups(rows):
+        keyed = {}
+        for row in rows:
+            keyed.setdefault(tuple(str(value) for value in row[:2]), []).append([str(value) for value in row[2:]])
+        return keyed
+    source_groups, target_groups = groups(source), groups(target)
+    keys = set(source_groups) | (set(target_groups) if include_target_keys else set())
+    fails = sum(source_groups.get(key) != target_groups.get(key) for key in keys)
+    return len(keys) - fails, fails
+
+
+def differences_by_key(session: str):
+    conn = sqlite3.connect(f"{session}.db")
+    try:
+        return sorted(conn.execute(f"""
+            SELECT s.KEY, s.REGION, d.row_index, d.column_name, d.old_value, d.new_value
+            FROM differences d JOIN {session} s ON s.id = d.run_id
+        """).fetchall())
+    finally:
+        conn.close()
+
+
+@pytest.fixture(scope="module")
+def tables(workdir):
+    source, target = build_tables()
+    upload_sheet("source", "Engines1", NAMES, source)
+    upload_sheet("target", "Engines1", NAMES, target)
+    return source, target
+
+
+@pytest.mark.parametrize("include_target_keys", [False, True])
+def test_hash_and_row_engines_agree(client, tables, include_target_keys):
+    expected = expected_results(*tables, include_target_keys)
+    results = {}
+    for engine in ("hash", "row"):
+        for partitions in (1, 3):
+            for precheck in (False, True):
+                session = f"engines1_{engine}_{partitions}_{int(precheck)}_{int(include_target_keys)}"
+                status = run_compare(client, session, "Engines1", "Engines1", ["KEY", "REGION"], partitions,
+                                     compareEngine=engine, includeTargetKeys=include_target_keys, precheck=precheck)
+                assert status["ExecutionStatus"] == "completed"
+                assert (status["Pass"], status["Fail"], status["Pending"]) == (*expected, 0), session
+                results[session] = differences_by_key(session)
+    first = next(iter(results.values()))
+    assert first
+    assert all(differences == first for differences in results.values())
+    assert any(column == "__row__" for _, _, _, column, _, _ in first)
+
+
+def test_diff_options_reach_the_engines(client, workdir):
+    source = [["A", "1.00", "x"], ["B", "Null", " y "], ["C", "3", "z"]]
+    target = [["A", "1.004", "x"], ["B", None, "y"], ["C", "4", "z"]]
+    upload_sheet("source", "Options1", ["KEY", "NUM", "TEXT"], source)
+    upload_sheet("target", "Options1", ["KEY", "NUM", "TEXT"], target)
+    for engine in ("hash", "row"):
+        exact = run_compare(client, f"options1_exact_{engine}", "Options1", "Options1", ["KEY"], compareEngine=engine)
+        assert (exact["Pass"], exact["Fail"]) == (0, 3)
+        relaxed = run_compare(client, f"options1_relaxed_{engine}", "Options1", "Options1", ["KEY"],
+                              compareEngine=engine, numericTolerance=0.01, normalizeNulls=True, trimWhitespace=True)
+        assert (relaxed["Pass"], relaxed["Fail"]) == (2, 1)
@@ -0,0 +1,43 @@
+import csv
+import io
+
+import pytest
+from openpyxl import load_workbook
+
+from app import concurrency
+from conftest import upload_sheet, run_compare
+
+
+@pytest.fixture(scope="module")
+def session(client):
+    rows = [[f"K{index}", index] for index in range(50)]
+    upload_sheet("source", "Export17", ["KEY", "VALUE"], rows)
+    upload_sheet("target", "Export17", ["KEY", "VALUE"], rows[:-1] + [["K49", -1]])
+    return run_compare(client, "export17", "Export17", "Export17", ["KEY"])["jobId"]
+
+
+@pytest.fixture
+def ingest_calls(monkeypatch):
+    calls = []
+    run_ingest = concurrency.run_ingest
+
+    async def counted(func, *args, **kwargs):
+        calls.append(func)
+        return await run_ingest(func, *args, **kwargs)
+    monkeypatch.setattr(concurrency, "run_ingest", counted)
+    return calls
+
+
+def test_csv_export_runs_on_the_ingest_limiter(client, session, ingest_calls):
+    response = client.get("/batch/download", params={"sessionName": "export17", "jobId": session, "format": "csv"})
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert len(rows) == 51
+    assert [(row[-2], row[-1]) for row in rows if row[-1]][1:] == [("49", "-1")]
+    assert ingest_calls
+
+
+def test_xlsx_export(client, session, ingest_calls):
+    response = client.get("/batch/download", params={"sessionName": "export17", "jobId": session, "result": "Fail"})
+    rows = list(load_workbook(io.BytesIO(response.content), read_only=True).active.iter_rows(values_only=True))
+    assert len(rows) == 2
+    assert ingest_calls
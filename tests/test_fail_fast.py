@@ -0,0 +1,51 @@
+import pytest
+
+from conftest import upload_sheet, run_compare
+
+NAMES = ["KEY", "VALUE"]
+
+
+@pytest.fixture(scope="module")
+def tables(workdir):
+    # 3,000 keys, every 10th one differs, the last key included
+    source = [[f"K{index:05d}", index] for index in range(3000)]
+    target = [[key, value + 1 if index % 10 == 9 else value] for index, (key, value) in enumerate(source)]
+    upload_sheet("source", "Fast20", NAMES, source)
+    upload_sheet("target", "Fast20", NAMES, target)
+
+
+@pytest.mark.parametrize("option", [{"confidence": 1.0}, {"confidence": 0}, {"sampleSize": 0}, {"failAfter": 0},
+                                    {"maxMismatchRate": 1.5}, {"maxMismatchRate": -0.1}])
+def test_options_are_validated(client, option):
+    body = dict(compareSessionName="invalid20", sourceTable="Fast20", targetTable="Fast20", primaryColumns=["KEY"],
+                excludedColumns=[], **option)
+    assert client.post("/batch/compare", json=body).status_code == 422
+
+
+def test_fail_after_stops_at_the_limit_row_engine(client, tables):
+    status = run_compare(client, "fast20_row", "Fast20", "Fast20", ["KEY"], compareEngine="row", failAfter=5,
+                         precheck=False)
+    assert (status["ExecutionStatus"], status["Fail"]) == ("stopped", 5)
+    assert status["Pending"] > 2000
+
+
+def test_fail_after_stops_at_chunk_hash_engine(client, tables):
+    status = run_compare(client, "fast20_hash", "Fast20", "Fast20", ["KEY"], failAfter=5, precheck=False)
+    assert status["ExecutionStatus"] == "stopped"
+    assert status["Pending"] > 0
+
+
+def test_limit_reached_on_the_last_key_completes(client, tables):
+    status = run_compare(client, "fast20_all", "Fast20", "Fast20", ["KEY"], compareEngine="row", failAfter=300,
+                         precheck=False)
+    assert (status["ExecutionStatus"], status["Pass"], status["Fail"], status["Pending"]) == ("completed", 2700, 300, 0)
+
+
+def test_sample_estimate(client, tables):
+    status = run_compare(client, "sample20", "Fast20", "Fast20", ["KEY"], sampleSize=500, confidence=0.9,
+                         sampleSeed=1)
+    sample = status["Sample"]
+    assert (status["ExecutionStatus"], status["Pass"] + status["Fail"], sample["compared"]) == ("completed", 500, 500)
+    assert sample["lower"] <= 0.1 <= sample["upper"]
+    # Pending counts the keys outside the sample, Remaining only the sample keys left
+    assert (status["Pending"], status["Remaining"]) == (2500, 0)
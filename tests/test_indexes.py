@@ -0,0 +1,23 @@
+import sqlite3
+
+from app.indexes import create_compare_indexes
+from conftest import upload_sheet
+
+
+def indexes(db_name: str, table: str):
+    conn = sqlite3.connect(f"{db_name}.db")
+    try:
+        return [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=?",
+                                               (table,))]
+    finally:
+        conn.close()
+
+
+def test_unknown_key_column_is_not_indexed(workdir, capsys):
+    upload_sheet("source", "Index6", ["KEY", "VALUE"], [[f"K{index}", index] for index in range(10)])
+    timings = create_compare_indexes("index6", "Index6", None, ["NOPE"])
+    assert timings["source.Index6"] is None
+    assert "no such column: NOPE" in capsys.readouterr().out
+    assert indexes("source", "Index6") == []
+    create_compare_indexes("index6", "Index6", None, ["KEY"])
+    assert indexes("source", "Index6") == ["idx_Index6_KEY"]
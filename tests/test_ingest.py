@@ -0,0 +1,26 @@
+import sqlite3
+
+from app.excel_to_db import files_to_db
+from conftest import upload_sheet, write_workbook, run_compare
+
+NAMES = ["KEY", "VALUE"]
+ROWS = [[f"K{index}", index] for index in range(2000)]
+
+
+def test_sheet_names_are_quoted(client):
+    upload_sheet("source", "My Data", NAMES, ROWS)
+    upload_sheet("target", "My Data", NAMES, ROWS)
+    conn = sqlite3.connect("source.db")
+    assert conn.execute('SELECT COUNT(*) FROM "My Data"').fetchone()[0] == 2000
+    conn.close()
+    status = run_compare(client, "quoted3", "My Data", "My Data", ["KEY"], precheck=False)
+    assert (status["ExecutionStatus"], status["Pass"], status["Fail"]) == ("completed", 2000, 0)
+
+
+def test_sheet_whose_table_cannot_be_created_fails_at_once(workdir, capsys):
+    # SQLite reserves sqlite_* names, so the CREATE fails
+    path = write_workbook("reserved3.xlsx", "sqlite_data", NAMES, ROWS)
+    done = {}
+    files_to_db([(path, path)], "source", done.__setitem__)
+    assert done == {path: "fail"}
+    assert "Error inserting row" not in capsys.readouterr().out
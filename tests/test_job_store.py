@@ -0,0 +1,136 @@
+import sqlite3
+import threading
+import time
+import uuid
+
+import pytest
+
+from conftest import upload_sheet
+
+NAMES = ["KEY", "VALUE"]
+
+
+@pytest.fixture
+def store(workdir):
+    # A jobs database of its own, with the app's scheduler paused so it claims nothing from it
+    from app import job_store
+    from app.main import scheduler
+    scheduler.stop()
+    jobs_db = job_store.JOBS_DB
+    job_store.JOBS_DB = f"jobs-{uuid.uuid4().hex[:8]}"
+    try:
+        yield job_store.JobStore()
+    finally:
+        job_store.JOBS_DB = jobs_db
+        scheduler.start()
+
+
+def queued(store, count: int):
+    job_ids = [f"job-{index}-{uuid.uuid4().hex[:6]}" for index in range(count)]
+    for job_id in job_ids:
+        store.create(job_id, "session", {})
+        store.enqueue(job_id, 1)
+    return job_ids
+
+
+def wait_for(predicate, timeout: float = 10):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline
+        time.sleep(0.02)
+
+
+def test_cancel(store):
+    from app.job_store import JobCancelled, COMPLETED
+    created = f"job-{uuid.uuid4().hex[:6]}"
+    store.create(created, "session", {})
+    assert store.cancel(created) == "cancelled"
+    waiting, running, finished = queued(store, 3)
+    assert store.cancel(waiting) == "cancelled"
+    assert [store.claim_next("worker")["job_id"] for _ in range(2)] == [running, finished]
+    # A running job is only flagged; its worker stops at the next progress checkpoint
+    assert store.cancel(running) == "cancelling"
+    with pytest.raises(JobCancelled):
+        store.check_cancelled(running)
+    store.finish(finished, COMPLETED, "worker")
+    assert store.cancel(finished) == "completed"
+
+
+def test_claim_limit(store):
+    from app.job_store import COMPLETED
+    first, second, third = queued(store, 3)
+    assert [store.claim_next("a", max_running=2)["job_id"] for _ in range(2)] == [first, second]
+    assert store.claim_next("b", max_running=2) is None
+    # Jobs still cancelling hold their slot until their worker lets go
+    store.cancel(first)
+    assert store.claim_next("b", max_running=2) is None
+    store.finish(second, COMPLETED, "a")
+    assert store.claim_next("b", max_running=2)["job_id"] == third
+    assert store.get(third)["owner"] == "b"
+
+
+def test_requeue_stale(store):
+    running, cancelling, alive = queued(store, 3)
+    for _ in range(3):
+        store.claim_next("crashed", max_running=3)
+    store.cancel(cancelling)
+    time.sleep(0.05)
+    store.heartbeat([alive], "crashed")
+    assert store.requeue_stale(timeout=0.04) == 2
+    assert (store.get(running)["state"], store.get(running)["owner"]) == ("queued", None)
+    assert store.get(cancelling)["state"] == "cancelled"
+    assert store.get(alive)["state"] == "in_progress"
+    assert store.claim_next("restarted", max_running=3)["job_id"] == running
+
+
+def test_scheduler_runs_at_most_max_jobs(store):
+    from app.scheduler import JobScheduler
+    release, running = threading.Event(), []
+
+    def run_job(job_id, partitions, mode):
+        running.append(job_id)
+        release.wait(10)
+        return "completed"
+
+    job_ids = queued(store, 3)
+    scheduler = JobScheduler(run_job, max_jobs=2, poll_seconds=0.02)
+    scheduler.start()
+    try:
+        wait_for(lambda: len(running) == 2)
+        time.sleep(0.1)
+        assert running == job_ids[:2]
+        assert store.get(job_ids[2])["state"] == "queued"
+        release.set()
+        wait_for(lambda: all(store.get(job_id)["state"] == "completed" for job_id in job_ids))
+    finally:
+        release.set()
+        scheduler.stop()
+
+
+def test_stale_job_resumes_from_pending_rows(client):
+    source = [[f"K{index:03d}", index] for index in range(50)]
+    target = [[key, value + 1 if value in (10, 20) else value] for key, value in source]
+    upload_sheet("source", "Resume10", NAMES, source)
+    upload_sheet("target", "Resume10", NAMES, target)
+    body = dict(compareSessionName="resume10", sourceTable="Resume10", targetTable="Resume10", primaryColumns=["KEY"],
+                excludedColumns=[], precheck=False)
+    job_id = client.post("/batch/compare", json=body).json()["jobId"]
+    # The job's worker died after committing the result of K010 and before reaching K020
+    conn = sqlite3.connect("resume10.db")
+    conn.execute("UPDATE resume10 SET result='Pass' WHERE batch_id=? AND \"KEY\"='K010'", (job_id,))
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect("jobs.db")
+    conn.execute("UPDATE compare_jobs SET state='in_progress', owner='crashed', partitions=1, mode='full', heartbeat_at=0 "
+                 "WHERE job_id=?", (job_id,))
+    conn.commit()
+    conn.close()
+    deadline = time.time() + 30
+    while True:
+        status = client.get("/batch/status", params={"jobId": job_id, "sessionName": "resume10"}).json()
+        if status["ExecutionStatus"] == "completed":
+            break
+        assert time.time() < deadline, status
+        time.sleep(0.05)
+    # Only the pending keys were compared again, so the committed result stands
+    assert (status["Pass"], status["Fail"], status["Pending"]) == (49, 1, 0)
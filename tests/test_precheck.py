@@ -0,0 +1,104 @@
+import sqlite3
+import time
+
+import pytest
+
+from app.fingerprint import precheck, refresh_fingerprints
+from app.job_store import JobStore
+from conftest import upload_sheet, run_compare
+
+NAMES = ["KEY", "VALUE", "NOTE"]
+SOURCE = [[f"K{index:03d}", index, "note"] for index in range(100)]
+
+
+def changed(*indexes, excluded_only=False):
+    rows = [list(row) for row in SOURCE]
+    for index in indexes:
+        if excluded_only:
+            rows[index][2] = "changed note"
+        else:
+            rows[index][1] = -1
+    return rows
+
+
+@pytest.fixture(scope="module")
+def tables(workdir):
+    upload_sheet("source", "Pre21", NAMES, SOURCE)
+    upload_sheet("target", "Pre21", NAMES, SOURCE)
+    upload_sheet("target", "Pre21Diff", NAMES, changed(5, 57))
+    upload_sheet("target", "Pre21Note", NAMES, changed(5, 57, excluded_only=True))
+    swapped = [list(row) for row in SOURCE]
+    swapped[1][1], swapped[2][1] = swapped[2][1], swapped[1][1]
+    upload_sheet("target", "Pre21Swap", NAMES, swapped)
+
+
+def set_up(client, session, target_table, excluded=()):
+    body = dict(compareSessionName=session, sourceTable="Pre21", targetTable=target_table, primaryColumns=["KEY"],
+                excludedColumns=list(excluded), precheck=True)
+    job_id = client.post("/batch/compare", json=body).json()["jobId"]
+    config = JobStore().get_config(job_id)
+    refresh_fingerprints(job_id, config)
+    return job_id, config
+
+
+def status(client, session, job_id):
+    return client.get("/batch/status", params={"jobId": job_id, "sessionName": session}).json()
+
+
+def test_identical_tables_pass_every_key(client, tables):
+    job_id, config = set_up(client, "pre21_same", "Pre21")
+    checked = precheck(job_id, config["db_name"], bucket_keys=10)
+    assert checked == {"identical": True, "buckets": 10, "matchingBuckets": 10, "keys": 100, "passed": 100}
+    assert (status(client, "pre21_same", job_id)["Pass"], status(client, "pre21_same", job_id)["Pending"]) == (100, 0)
+
+
+def test_only_differing_keys_are_left_to_compare(client, tables):
+    job_id, config = set_up(client, "pre21_diff", "Pre21Diff")
+    checked = precheck(job_id, config["db_name"], bucket_keys=10)
+    assert checked == {"identical": False, "buckets": 10, "matchingBuckets": 8, "keys": 100, "passed": 98}
+    current = status(client, "pre21_diff", job_id)
+    assert (current["Pass"], current["Pending"], current["Precheck"]["matchingBuckets"]) == (98, 2, 8)
+
+
+def test_keys_swapping_rows_do_not_cancel_out(client, tables):
+    job_id, config = set_up(client, "pre21_swap", "Pre21Swap")
+    checked = precheck(job_id, config["db_name"], bucket_keys=10)
+    assert (checked["identical"], checked["matchingBuckets"], checked["passed"]) == (False, 9, 98)
+
+
+def test_excluded_columns_are_left_out(client, tables):
+    job_id, config = set_up(client, "pre21_note", "Pre21Note", excluded=["NOTE"])
+    assert precheck(job_id, config["db_name"], bucket_keys=10)["identical"]
+
+
+@pytest.mark.parametrize("target_table, expected", [("Pre21", (100, 0)), ("Pre21Diff", (98, 2))])
+def test_jobs_with_precheck_report_the_same_results(client, tables, target_table, expected):
+    for enabled in (True, False):
+        session = f"pre21_job_{target_table.lower()}_{int(enabled)}"
+        result = run_compare(client, session, "Pre21", target_table, ["KEY"], precheck=enabled)
+        assert (result["Pass"], result["Fail"], result["Pending"]) == (*expected, 0)
+        assert ("Precheck" in result) == enabled
+
+
+def hashed_keys(session, job_id):
+    conn = sqlite3.connect(f"{session}.db")
+    try:
+        return conn.execute("SELECT COUNT(*) FROM key_hashes WHERE batch_id=?", (job_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_only_incremental_and_prechecked_runs_hash_keys(client, tables):
+    body = dict(compareSessionName="pre21_hash", sourceTable="Pre21", targetTable="Pre21Diff", primaryColumns=["KEY"],
+                excludedColumns=[], precheck=False)
+    job_id = client.post("/batch/compare", json=body).json()["jobId"]
+    for mode, hashed in (("incremental", 100), ("full", 0), ("incremental", 100)):
+        client.get("/batch/compare", params={"jobId": job_id, "mode": mode})
+        deadline = time.time() + 30
+        while status(client, "pre21_hash", job_id)["ExecutionStatus"] != "completed":
+            assert time.time() < deadline
+            time.sleep(0.05)
+        result = status(client, "pre21_hash", job_id)
+        assert (result["Pass"], result["Fail"], result["Pending"]) == (98, 2, 0)
+        # A full run drops the stored hashes, so the next incremental run compares every key again
+        assert hashed_keys("pre21_hash", job_id) == hashed
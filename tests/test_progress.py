@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from app.progress import ProgressHub
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def reader(snapshots):
+    # read_progress returning the given snapshots in turn, then the last one
+    snapshots = iter(snapshots)
+    last = {}
+
+    def read_progress(job_id, db_name):
+        last.update(next(snapshots, last))
+        return dict(last)
+    return read_progress
+
+
+async def progress_events(hub, job_id, db_name="session"):
+    return [json.loads(message.split("data: ", 1)[1]) async for message in hub.events(job_id, db_name)
+            if message.startswith("event: progress")]
+
+
+@pytest.mark.anyio
+async def test_eta_uses_remaining_keys_and_clears_when_finished():
+    hub = ProgressHub(reader([
+        {"ExecutionStatus": "in_progress", "Pass": 0, "Fail": 0, "Pending": 1000, "Remaining": 100},
+        {"ExecutionStatus": "in_progress", "Pass": 50, "Fail": 0, "Pending": 950, "Remaining": 50},
+        {"ExecutionStatus": "completed", "Pass": 100, "Fail": 0, "Pending": 900, "Remaining": 0},
+    ]), interval=0.05, keepalive=5)
+    events = await progress_events(hub, "job18")
+    running = [event for event in events if event["rowsPerSec"] and event["ExecutionStatus"] == "in_progress"]
+    # The 900 keys outside the sample do not count towards the ETA
+    for event in running:
+        assert event["etaSeconds"] == pytest.approx(event["Remaining"] / event["rowsPerSec"], abs=0.1)
+    assert events[-1]["ExecutionStatus"] == "completed"
+    assert events[-1]["etaSeconds"] is None
+    assert hub.subscribers() == 0
+
+
+@pytest.mark.anyio
+async def test_watches_are_per_session():
+    def read_progress(job_id, db_name):
+        # The same job id under two sessions reads two different databases
+        return {"ExecutionStatus": "completed", "Pass": 1 if db_name == "first" else 2, "Fail": 0, "Pending": 0}
+
+    hub = ProgressHub(read_progress, interval=0.05, keepalive=5)
+    first = hub.events("job18", "first")
+    assert json.loads((await first.__anext__()).split("data: ", 1)[1])["Pass"] == 1
+    # Watched while the first session still is
+    assert [event["Pass"] for event in await progress_events(hub, "job18", "second")] == [2]
+    await first.aclose()
+    assert hub.subscribers() == 0
@@ -0,0 +1,32 @@
+import os
+
+from conftest import upload_sheet
+
+ROWS = [[f"K{index}", index % 3, index] for index in range(100)]
+
+
+def setup(client, session: str, key_columns, target_table: str = "Setup8"):
+    return client.post("/batch/compare", json=dict(compareSessionName=session, sourceTable="Setup8",
+                                                   targetTable=target_table, primaryColumns=key_columns,
+                                                   excludedColumns=[]))
+
+
+def test_unknown_key_columns_are_rejected(client):
+    upload_sheet("source", "Setup8", ["KEY", "GROUP", "VALUE"], ROWS)
+    upload_sheet("target", "Setup8", ["KEY", "GROUP", "VALUE"], ROWS)
+    upload_sheet("target", "Other8", ["KEY", "VALUE"], [[key, value] for key, _, value in ROWS])
+    response = setup(client, "setup8_nope", ["KEY", "NOPE"])
+    assert (response.status_code, response.json()["detail"]) == (400, "Source table Setup8 has no column NOPE")
+    response = setup(client, "setup8_target", ["GROUP"], target_table="Other8")
+    assert (response.status_code, response.json()["detail"]) == (400, "Target table Other8 has no column GROUP")
+    # Nothing was created for the rejected sessions
+    assert not os.path.exists("setup8_nope.db")
+
+
+def test_session_keys_cannot_change(client):
+    response = setup(client, "setup8_keys", ["KEY"])
+    assert (response.status_code, response.json()["total_combinations"]) == (200, 100)
+    response = setup(client, "setup8_keys", ["GROUP"])
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Session setup8_keys was set up with key columns ['KEY'], not ['GROUP']"
+    assert setup(client, "setup8_keys", ["KEY"]).status_code == 200
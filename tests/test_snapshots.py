@@ -0,0 +1,79 @@
+import os
+import sqlite3
+
+import pytest
+
+from app.excel_to_db import files_to_db
+from app.snapshots import ARROW, get_snapshot, snapshot_frame
+from conftest import upload_sheet, write_table, write_workbook, run_compare
+
+FLOATS = [0.1 + 0.7, 1e20, 1.5e-07, 3.25, float(2 ** 60), 1 / 3, -0.5, 1234567.0]
+
+
+@pytest.mark.parametrize("storage", ["sqlite", ARROW])
+def test_uploads_of_one_sheet_append(workdir, storage):
+    # Four workbooks parsed in parallel, all with the same sheet name
+    sheet = f"Append13{storage}"
+    files = [(f"file{index}", write_workbook(f"append13-{storage}-{index}.xlsx", sheet, ["KEY", "VALUE"],
+                                             [[f"K{index}-{row}", row] for row in range(1000)]))
+             for index in range(4)]
+    done = {}
+    files_to_db(files, "source", done.__setitem__, storage=storage)
+    assert done == {name: "pass" for name, _ in files}
+    if storage == ARROW:
+        snapshot = get_snapshot("source", sheet)
+        frame = snapshot_frame(snapshot)
+        assert snapshot["rows"] == 4000
+    else:
+        conn = sqlite3.connect("source.db")
+        frame = conn.execute(f"SELECT KEY FROM {sheet}").fetchall()
+        conn.close()
+    assert len(frame) == 4000
+
+
+@pytest.fixture(scope="module")
+def float_sheets(workdir):
+    rows = [[f"K{index}", value, str(value)] for index, value in enumerate(FLOATS)]
+    names = ["KEY", "AMOUNT", "LABEL"]
+    upload_sheet("source", "Floats13", names, rows)
+    upload_sheet("target", "Floats13", names, rows, storage=ARROW)
+    upload_sheet("target", "Floats13Sql", names, rows)
+    return write_table("ext-floats13.db", "floats13", [("KEY", "TEXT"), ("AMOUNT", "REAL"), ("LABEL", "TEXT")],
+                       rows)
+
+
+@pytest.mark.parametrize("target", ["sqlite", "arrow", "url"])
+def test_floats_render_alike_in_every_storage(client, float_sheets, target):
+    tables = {"sqlite": "Floats13Sql", "arrow": "Floats13", "url": "floats13"}
+    options = {"targetUrl": float_sheets} if target == "url" else {}
+    status = run_compare(client, f"floats13_{target}", "Floats13", tables[target], ["KEY"], precheck=False, **options)
+    assert (status["ExecutionStatus"], status["Pass"], status["Fail"]) == ("completed", len(FLOATS), 0)
+
+
+def test_uploads_add_parts_and_pages_keep_the_sheet_types(workdir):
+    from app.excel_to_db import get_sheet_page
+    names = ["KEY", "VALUE"]
+    upload_sheet("source", "Parts13", names, [[f"K{row}", row] for row in range(5)], storage=ARROW)
+    first = get_snapshot("source", "Parts13")["parts"]
+    modified = os.path.getmtime(first[0][0])
+    assert get_sheet_page("Parts13", "source", 0, 2)[0] == [{"KEY": "K0", "VALUE": 0}, {"KEY": "K1", "VALUE": 1}]
+    upload_sheet("source", "Parts13", names, [[f"T{row}", f"text-{row}"] for row in range(3)], storage=ARROW)
+    snapshot = get_snapshot("source", "Parts13")
+    # The second upload only added a part; the first one was not rewritten
+    assert (snapshot["rows"], snapshot["parts"][0]) == (8, first[0])
+    assert os.path.getmtime(first[0][0]) == modified
+    # Once the column holds text anywhere, every page renders it as text
+    assert get_sheet_page("Parts13", "source", 0, 2)[0] == [{"KEY": "K0", "VALUE": "0"}, {"KEY": "K1", "VALUE": "1"}]
+    assert get_sheet_page("Parts13", "source", 6, 5) == ([{"KEY": "T1", "VALUE": "text-1"},
+                                                          {"KEY": "T2", "VALUE": "text-2"}], None)
+
+
+def test_upload_with_other_columns_is_rejected(workdir):
+    upload_sheet("source", "Columns13", ["KEY", "VALUE"], [["K0", 0]], storage=ARROW)
+    before = get_snapshot("source", "Columns13")
+    path = write_workbook("columns13.xlsx", "Columns13", ["KEY", "OTHER"], [["K1", 1]])
+    done = {}
+    files_to_db([(path, path)], "source", done.__setitem__, storage=ARROW)
+    assert done == {path: "fail"}
+    assert get_snapshot("source", "Columns13") == before
+    assert os.listdir(before["path"]) == [os.path.basename(before["parts"][0][0])]